@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+import sys
+import os
+import time
+import random
+import shutil
+import argparse
+import tempfile
+from subprocess import check_call
+current_script_dir = os.path.dirname(os.path.realpath(__file__)).replace('/bin', '/python')
+if not os.path.exists(current_script_dir):
+    print 'WARNING current script dir %s doesn\'t exist, so python path may not be correctly set' % current_script_dir
+sys.path.insert(1, current_script_dir)
+
+import utils
+
+# ----------------------------------------------------------------------------------------
+# compare utils.stream_merge_csvs() (what PartitionDriver.merge_files() now uses) to the shell pipeline it replaced, on fake cache-style csv files
+parser = argparse.ArgumentParser()
+parser.add_argument('--n-files', type=int, default=20, help='number of files to merge (i.e. number of subprocs)')
+parser.add_argument('--n-lines', type=int, default=20000, help='lines per file')
+parser.add_argument('--seq-length', type=int, default=400, help='length of the fake naive seqs (which make up most of each line)')
+parser.add_argument('--duplicate-fraction', type=float, default=0.3, help='fraction of lines in each file that are copied from an earlier file')
+parser.add_argument('--workdir', default=tempfile.gettempdir() + '/partis-merge-benchmark')
+parser.add_argument('--seed', type=int, default=1)
+args = parser.parse_args()
+random.seed(args.seed)
+
+# ----------------------------------------------------------------------------------------
+def shell_merge(infnames, outfname, dereplicate):  # old version of PartitionDriver.merge_files() (with <outfname> not in <infnames>)
+    with open(infnames[0]) as headfile:
+        header = headfile.readline().strip()
+    check_call('echo ' + header + ' >' + outfname, shell=True)
+    check_call('cat ' + ' '.join(infnames) + ' | grep -v \'' + header + '\' >>' + outfname, shell=True)
+    if dereplicate:
+        tmpfname = outfname + '.tmp'
+        check_call('echo ' + header + ' >' + tmpfname, shell=True)
+        check_call('grep -v \'' + header + '\' ' + outfname + ' | sort | uniq >>' + tmpfname, shell=True)
+        check_call(['mv', tmpfname, outfname])
+
+# ----------------------------------------------------------------------------------------
+def write_files():
+    infnames = []
+    previous_lines = []
+    for ifile in range(args.n_files):
+        fname = '%s/in-%d.csv' % (args.workdir, ifile)
+        with open(fname, 'w') as infile:
+            infile.write(','.join(utils.partition_cachefile_headers) + '\n')
+            for iline in range(args.n_lines):
+                if len(previous_lines) > 0 and random.random() < args.duplicate_fraction:
+                    line = random.choice(previous_lines)
+                else:
+                    uids = ':'.join('%x' % random.randint(0, 2**40) for _ in range(random.choice([1, 1, 1, 2, 5])))
+                    naive_seq = ''.join(random.choice('ACGT') for _ in range(args.seq_length))
+                    line = '%s,%.12f,%s,,\n' % (uids, -random.uniform(100, 3000), naive_seq)
+                    if iline % 10 == 0:
+                        previous_lines.append(line)
+                infile.write(line)
+        infnames.append(fname)
+    return infnames
+
+# ----------------------------------------------------------------------------------------
+def sorted_lines(fname):
+    with open(fname) as outfile:
+        return outfile.readline(), sorted(outfile)
+
+# ----------------------------------------------------------------------------------------
+if os.path.exists(args.workdir):
+    shutil.rmtree(args.workdir)
+os.makedirs(args.workdir)
+infnames = write_files()
+print '  %d files with %d lines each (%.1f MB total)' % (args.n_files, args.n_lines, sum(os.path.getsize(fn) for fn in infnames) / 1e6)
+for dereplicate in [False, True]:
+    times = {}
+    for label, mfcn in [('shell', shell_merge), ('stream', lambda inf, outf, dr: utils.stream_merge_csvs(inf, outf, dereplicate=dr))]:
+        start = time.time()
+        mfcn(infnames, '%s/%s.csv' % (args.workdir, label), dereplicate)
+        times[label] = time.time() - start
+    shell_header, shell_lines = sorted_lines(args.workdir + '/shell.csv')
+    stream_header, stream_lines = sorted_lines(args.workdir + '/stream.csv')
+    if shell_header != stream_header or shell_lines != stream_lines:
+        raise Exception('merged files differ (dereplicate %s)' % dereplicate)
+    print '    %-14s  shell %6.2fs   stream %6.2fs   (%.1fx, %d lines)' % ('dereplicate' if dereplicate else 'no dereplicate', times['shell'], times['stream'], times['shell'] / times['stream'], len(stream_lines))
+shutil.rmtree(args.workdir)
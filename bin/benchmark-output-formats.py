@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+import sys
+import os
+import time
+import copy
+import shutil
+import argparse
+import tempfile
+current_script_dir = os.path.dirname(os.path.realpath(__file__)).replace('/bin', '/python')
+if not os.path.exists(current_script_dir):
+    print 'WARNING current script dir %s doesn\'t exist, so python path may not be correctly set' % current_script_dir
+sys.path.insert(1, current_script_dir)
+
+import utils
+
+# ----------------------------------------------------------------------------------------
+# compare file size and read/write times for the json (.yaml) and columnar (.npz) output formats, using the events from an existing output file
+partis_dir = os.path.dirname(os.path.realpath(__file__)).replace('/bin', '')
+parser = argparse.ArgumentParser()
+parser.add_argument('--infname', default=partis_dir + '/test/reference-results/multi-annotate-new-simu.yaml', help='partis output file from which to take events')
+parser.add_argument('--n-copies', type=int, default=10, help='write this many copies of each event (with new uids) to get bigger files. Note that since the copies have identical sequences, this makes the dictionary encoding in the .npz version look better than it would for real data.')
+parser.add_argument('--column-keys', default='v_gene:d_gene:j_gene:cdr3_length:mut_freqs', help='colon-separated list of keys to read with utils.read_npz_columns() (compared to reading the whole json file to get the same info)')
+parser.add_argument('--workdir', default=tempfile.gettempdir() + '/partis-output-format-benchmark')
+args = parser.parse_args()
+args.column_keys = utils.get_arg_list(args.column_keys)
+
+# ----------------------------------------------------------------------------------------
+def get_events():
+    glfo, annotation_list, cpath = utils.read_output(args.infname)
+    events = []
+    for icopy in range(args.n_copies):
+        for line in annotation_list:
+            if line['invalid']:
+                continue
+            newline = copy.deepcopy(line)
+            newline['unique_ids'] = ['%s-%d' % (u, icopy) for u in line['unique_ids']]
+            events.append(newline)
+    return glfo, events, cpath
+
+# ----------------------------------------------------------------------------------------
+def timeit(fcn):
+    start = time.time()
+    retval = fcn()
+    return time.time() - start, retval
+
+# ----------------------------------------------------------------------------------------
+if os.path.exists(args.workdir):
+    shutil.rmtree(args.workdir)
+os.makedirs(args.workdir)
+glfo, events, cpath = get_events()
+headers = utils.annotation_headers
+print '  %d events with %d sequences (%d cop%s of each event in %s)' % (len(events), sum(len(l['unique_ids']) for l in events), args.n_copies, 'y' if args.n_copies == 1 else 'ies', args.infname)
+print '    %-6s %9s %8s %16s %16s %14s' % ('format', 'size (MB)', 'write', 'read (no impl.)', 'read (w/ impl.)', 'read columns')
+annotation_lists = {}
+for suffix in ['.yaml', '.npz']:
+    fname = args.workdir + '/output' + suffix
+    write_time, _ = timeit(lambda: utils.write_annotations(fname, glfo, events, headers, partition_lines=cpath.get_partition_lines(True) if len(cpath.partitions) > 0 else None))
+    read_time, (_, annotation_lists[suffix], _) = timeit(lambda: utils.read_output(fname, dont_add_implicit_info=True))
+    implicit_read_time, _ = timeit(lambda: utils.read_output(fname))
+    if suffix == '.npz':
+        column_time, (_, colfo) = timeit(lambda: utils.read_npz_columns(fname, args.column_keys))
+        for key in args.column_keys:  # make sure we got the same values as from the full read
+            if colfo[key]['per-seq']:
+                json_vals = [v for l in annotation_lists['.yaml'] for v in l[key]]
+            else:
+                json_vals = [l[key] for l in annotation_lists['.yaml']]
+            if list(colfo[key]['values']) != json_vals:
+                raise Exception('column values for %s differ' % key)
+    else:
+        column_time = read_time  # have to read the whole file to get any of the columns
+    print '    %-6s %9.1f %7.2fs %15.2fs %15.2fs %13.3fs' % (suffix, os.path.getsize(fname) / 1e6, write_time, read_time, implicit_read_time, column_time)
+if annotation_lists['.yaml'] != annotation_lists['.npz']:
+    raise Exception('annotations read from .yaml and .npz files differ')
+shutil.rmtree(args.workdir)
@@ -24,7 +24,7 @@ if utils.getsuffix(args.fname) == '.csv':
     print '  reading deprecated csv format, so need to read germline info from somewhere else, using --glfo-dir %s, hopefully it works' % args.glfo_dir
     glfo = glutils.read_glfo(args.glfo_dir, locus=args.locus)
 
-glfo, annotation_list, cpath = utils.read_output(args.fname, glfo=glfo)
+glfo, annotation_list, cpath = utils.read_output(args.fname, glfo=glfo, lazy=True)  # <lazy>: for (json) yaml files, only read (and add implicit info to) the annotations that we actually access below (for csv files it reads all of them)
 
 if cpath is None or len(cpath.partitions) == 0:
     print 'no partitions read from %s, so just printing first annotation:' % args.fname
@@ -35,12 +35,16 @@ print utils.color('green', 'list of partitions:')
 cpath.print_partitions(abbreviate=True)  # 'abbreviate' print little 'o's instead of the full sequence ids
 
 # print annotations for the biggest cluster in the most likely partition
-annotations = {':'.join(adict['unique_ids']) : adict for adict in annotation_list}  # collect the annotations in a dictionary so they're easier to access
+if isinstance(annotation_list, utils.LazyAnnotationList):
+    get_annotation = annotation_list.get_annotation_for_cluster  # looks up the event for exactly this cluster, and only reads that one
+else:
+    annotations = {':'.join(adict['unique_ids']) : adict for adict in annotation_list}  # collect the annotations in a dictionary so they're easier to access
+    get_annotation = lambda cluster: annotations[':'.join(cluster)]
 most_likely_partition = cpath.partitions[cpath.i_best]  # a partition is represented as a list of lists of strings, with each string a sequence id
 sorted_clusters = sorted(most_likely_partition, key=len, reverse=True)
 print '\n%s' % utils.color('green', 'annotation for the biggest cluster:')
 for cluster in sorted_clusters:
-    cluster_annotation = annotations[':'.join(cluster)]
+    cluster_annotation = get_annotation(cluster)
     utils.print_reco_event(cluster_annotation)
     break
 
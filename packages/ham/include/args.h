@@ -28,6 +28,7 @@ public:
   string annotationfile() { return annotationfile_arg_.getValue(); }
   string input_cachefname() { return input_cachefname_arg_.getValue(); }
   string output_cachefname() { return output_cachefname_arg_.getValue(); }
+  string cache_server_socket() { return cache_server_socket_arg_.getValue(); }
   string locus() { return locus_arg_.getValue(); }
   float hamming_fraction_bound_lo() { return hamming_fraction_bound_lo_arg_.getValue(); }
   float hamming_fraction_bound_hi() { return hamming_fraction_bound_hi_arg_.getValue(); }
@@ -36,6 +37,7 @@ public:
   string algorithm() { return algorithm_arg_.getValue(); }
   string ambig_base() { return ambig_base_arg_.getValue(); }
   string seed_unique_id() { return seed_unique_id_arg_.getValue(); }
+  string seed_unique_id_fname() { return seed_unique_id_fname_arg_.getValue(); }
   int debug() { return debug_arg_.getValue(); }
   int naive_hamming_cluster() { return naive_hamming_cluster_arg_.getValue(); }
   int biggest_naive_seq_cluster_to_calculate() { return biggest_naive_seq_cluster_to_calculate_arg_.getValue(); }
@@ -44,6 +46,7 @@ public:
   unsigned n_final_clusters() { return n_final_clusters_arg_.getValue(); }
   unsigned min_largest_cluster_size() { return min_largest_cluster_size_arg_.getValue(); }
   unsigned max_cluster_size() { return max_cluster_size_arg_.getValue(); }
+  unsigned n_threads() { return n_threads_arg_.getValue(); }
   unsigned random_seed() { return random_seed_arg_.getValue(); }
   bool no_chunk_cache() { return no_chunk_cache_arg_.getValue(); }
   bool partition() { return partition_arg_.getValue(); }
@@ -58,10 +61,10 @@ public:
   vector<int> debug_ints_;
   ValuesConstraint<string> algo_vals_;
   ValuesConstraint<int> debug_vals_;
-  ValueArg<string> hmmdir_arg_, datadir_arg_, infile_arg_, outfile_arg_, annotationfile_arg_, input_cachefname_arg_, output_cachefname_arg_, locus_arg_, algorithm_arg_, ambig_base_arg_, seed_unique_id_arg_;
+  ValueArg<string> hmmdir_arg_, datadir_arg_, infile_arg_, outfile_arg_, annotationfile_arg_, input_cachefname_arg_, output_cachefname_arg_, cache_server_socket_arg_, locus_arg_, algorithm_arg_, ambig_base_arg_, seed_unique_id_arg_, seed_unique_id_fname_arg_;
   ValueArg<float> hamming_fraction_bound_lo_arg_, hamming_fraction_bound_hi_arg_, logprob_ratio_threshold_arg_, max_logprob_drop_arg_;
   ValueArg<int> debug_arg_, naive_hamming_cluster_arg_, biggest_naive_seq_cluster_to_calculate_arg_, biggest_logprob_cluster_to_calculate_arg_, n_partitions_to_write_arg_;
-  ValueArg<unsigned> n_final_clusters_arg_, min_largest_cluster_size_arg_, max_cluster_size_arg_, random_seed_arg_;
+  ValueArg<unsigned> n_final_clusters_arg_, min_largest_cluster_size_arg_, max_cluster_size_arg_, n_threads_arg_, random_seed_arg_;
   SwitchArg no_chunk_cache_arg_, partition_arg_, dont_rescale_emissions_arg_, cache_naive_seqs_arg_, cache_naive_hfracs_arg_, only_cache_new_vals_arg_, write_logprob_for_each_partition_arg_;
 
   // arguments read from csv input file
@@ -130,6 +130,18 @@ public:
   size_t vmin, dmin, vmax, dmax;
 };
 // ----------------------------------------------------------------------------------------
+class PackedSeq {  // 2-bit-per-base packing of a sequence, so hamming distances can be calculated with popcount over 64-bit words (32 bases at a time)
+public:
+  PackedSeq() : size_(0) {}
+  PackedSeq(string &seq, Track *track);  // ambiguous bases (according to <track>) are excluded from distances via <mask_>
+  void HammingDistance(PackedSeq &other, int &distance, int &len_excluding_ambigs);  // same convention as Glomerator::CalculateHfrac(): skip positions where either seq is ambiguous
+  size_t size() { return size_; }
+private:
+  size_t size_;  // number of bases
+  vector<uint64_t> bits_;  // two bits for each base's symbol index
+  vector<uint64_t> mask_;  // low bit of each base's two-bit slot is set if the base is *not* ambiguous
+};
+// ----------------------------------------------------------------------------------------
 class HMMHolder {
 public:
   HMMHolder(string hmm_dir, GermLines &gl, Track *track): hmm_dir_(hmm_dir), gl_(gl), track_(track) {}
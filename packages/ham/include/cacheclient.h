@@ -0,0 +1,37 @@
+#ifndef HAM_CACHECLIENT_H
+#define HAM_CACHECLIENT_H
+
+#include <cstdio>
+#include <cstdlib>
+#include <cstring>
+#include <string>
+#include <vector>
+#include <stdexcept>
+#include <sys/socket.h>
+#include <sys/un.h>
+#include <unistd.h>
+
+#include "text.h"
+
+using namespace std;
+namespace ham {
+
+// ----------------------------------------------------------------------------------------
+// Talks to the cache server that partitiondriver.py runs (python/hmmcacheserver.py), so that instead of each bcrham process reading (and writing) its own copy of the cache file, they all share the server's in-memory cache.
+// Protocol is one line per request:
+//   get <key1> <key2> ...  -->  one line per key: <logprob>,<naive_seq>,<naive_hfrac>,<errors> (all empty if the server doesn't have it)
+//   put <key>,<logprob>,<naive_seq>,<naive_hfrac>,<errors>  (no response)
+// i.e. the same columns as the cache file
+class CacheClient {
+public:
+  CacheClient(string socket_path);
+  ~CacheClient();
+  vector<vector<string> > Get(vector<string> &keys);  // returns the four non-key columns for each key
+  void Put(string cacheline);  // <cacheline> is a full line (including key and trailing newline), as written by Glomerator::WriteCacheLine()
+private:
+  string socket_path_;
+  FILE *rfile_, *wfile_;
+};
+
+}
+#endif
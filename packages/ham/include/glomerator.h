@@ -9,16 +9,22 @@
 #include <algorithm>
 #include <functional>
 #include <pthread.h>
+#include <thread>
+#include <atomic>
+#include <exception>
 
 #include "args.h"
 #include "dphandler.h"
 #include "clusterpath.h"
 #include "text.h"
+#include "cacheclient.h"
+#include "hmmcachefile.h"
 
 using namespace std;
 namespace ham {
 
 typedef pair<vector<string>, vector<string> > ClusterPair;
+typedef pair<string, string> KeyPair;  // pair of cluster keys, in the order in which the exhaustive double loop over the partition would have visited them
 
 // ----------------------------------------------------------------------------------------
 class Query {
@@ -76,8 +82,15 @@ public:
   void WriteAnnotations(ClusterPath &cp);
 private:
   void ReadCacheFile();
-  void WriteCacheLine(ofstream &ofs, string query);
+  void AddCacheInfo(string query, CacheEntry &entry);
+  CacheEntry GetCacheEntry(string query);
+  void WriteCacheLine(ostream &ofs, string query);
   void WriteCacheFile();
+  void FetchCachedInfo(vector<string> keys);
+  void FetchCachedInfo(string key);
+  vector<CacheEntry> LookUpCachedInfo(vector<string> &keys);
+  void PrefetchCachedInfo(vector<string> &keys);
+  void PublishToCacheServer(string key);
 
   void PrintPartition(Partition &clusters, string extrastr);
   string CacheSizeString();
@@ -93,9 +106,12 @@ private:
   string JoinNameStrings(vector<Sequence*> &strlist, string delimiter=":");
   string JoinSeqStrings(vector<Sequence*> &strlist, string delimiter=":");
   string PrintStr(string queries);
+  void ReadSeedUids();
+  bool HasSeed(string queries);
   bool SeedMissing(string queries);
 
-  double CalculateHfrac(string &seq_a, string &seq_b);
+  double CalculateHfrac(PackedSeq &pseq_a, PackedSeq &pseq_b);
+  PackedSeq &GetPackedNaiveSeq(string key);
   double NaiveHfrac(string key_a, string key_b);
 
   string ChooseSubsetOfNames(string queries, int n_max);
@@ -110,6 +126,9 @@ private:
   double GetLogProbRatio(string key_a, string key_b);
   string CalculateNaiveSeq(string key, RecoEvent *event=nullptr);
   double CalculateLogProb(string queries);
+  void PrecalculateLRatioLogProbs();  // with --n-threads, calculate (in parallel) all the log probs we'll need for the lratios of the current candidate pairs
+  void CalculateLogProbs(vector<string> &queries);
+  void LogProbWorker(HMMHolder *hmms, vector<Query*> &qrefs, vector<double> &scores, vector<char> &no_paths, atomic<size_t> &inext, exception_ptr &error);
 
   bool check_cache(string queries) {
     if(cachefo_.find(queries) != cachefo_.end())
@@ -136,6 +155,14 @@ private:
   pair<double, Query> FindLRatioMerge(ClusterPath *path);
   pair<double, Query> *ChooseRandomMerge(vector<pair<double, Query> > &potential_merges);
 
+  // candidate pair index (so each merge step only looks at pairs that could pass the hfrac bound, rather than at every pair in the partition)
+  void InitializePairIndex(Partition &partition);
+  void AddToPairIndex(string key);
+  void RemoveFromPairIndex(string key);
+  KeyPair OrderedKeyPair(string key_a, string key_b);
+  vector<size_t> &NaiveSeqSegments(string key);
+  bool PairCouldPassHfracBound(string key_a, string key_b);
+
   Track *track_;
   Args *args_;
   GermLines &gl_;
@@ -159,9 +186,18 @@ private:
   map<string, double> naive_hfracs_;  // NOTE since this uses the joint key, it assumes there's only *one* way to get to a given cluster (this is similar to, but not quite the same as, the situation for log probs and naive seqs)
   map<string, double> lratios_;
   map<string, string> naive_seqs_;
+  map<string, PackedSeq> packed_naive_seqs_;  // 2-bit packed versions of the naive seqs in <naive_seqs_> (filled on demand, for hfrac calculation)
   map<string, string> errors_;
 
   set<string> failed_queries_;
+  set<string> seed_uids_;  // --seed-unique-id, plus anybody in --seed-unique-id-fname (if empty, we're not seeded)
+
+  bool pair_index_initialized_;
+  map<size_t, set<string> > cdr3_buckets_;  // clusters in the current partition, keyed by cdr3 length (pairs with different cdr3 lengths are never merged)
+  map<KeyPair, double> candidate_pairs_;  // naive hfrac for each pair in the current partition that passes the hfrac hi bound, ordered by keys (i.e. the order the old double loop used)
+  set<pair<double, KeyPair> > candidate_hfracs_;  // same pairs, but ordered by hfrac
+  map<string, set<KeyPair> > cluster_candidate_pairs_;  // candidate pairs in which each cluster appears (so we can remove them when the cluster is merged away)
+  map<string, vector<size_t> > naive_seq_segments_;  // hashes of the pigeonhole segments of each cluster's naive seq (empty if we can't use the pigeonhole bound for this cluster)
 
   set<string> initial_log_probs_, initial_naive_hfracs_, initial_naive_seqs_;  // keep track of the ones we read from the initial cache file so we can write only the new ones to the output cache file
 
@@ -171,6 +207,14 @@ private:
 
   bool force_merge_;  // this gets set to true if args_->n_final_clusters() is set, and we've got to keep going past the most likely partition in order to get down to the requested number of clusters
 
+  vector<HMMHolder*> thread_hmms_;  // one for each thread in CalculateLogProbs() (they can't share one, since DPHandler::Run() rescales the hmms' emission probs for each query)
+  map<string, CacheEntry> prefetched_cachefo_;  // cache lookups from PrecalculateLRatioLogProbs() that FetchCachedInfo() hasn't yet added to our maps
+  map<string, pair<double, bool> > precalculated_log_probs_;  // (log prob, no path) from CalculateLogProbs() that CalculateLogProb() hasn't yet used
+
+  CacheClient *cache_client_;  // if set, we get cached values from (and send newly-calculated ones to) the cache server, rather than the input/output cache files
+  HmmCacheFile *cache_file_;  // if set, the input cache file is binary, and we look up keys in it as we need them (rather than reading the whole thing at the start)
+  set<string> fetched_keys_;  // keys we've already looked up in the cache server or binary cache file (whether or not it had them)
+
   Partition *current_partition_;  // (a.t.m. only used for writing to status file)
   time_t last_status_write_time_;  // last time that we wrote our progress to a file
   FILE *progress_file_;
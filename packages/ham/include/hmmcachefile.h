@@ -0,0 +1,72 @@
+#ifndef HAM_HMMCACHEFILE_H
+#define HAM_HMMCACHEFILE_H
+
+#include <cstdint>
+#include <cstring>
+#include <string>
+#include <vector>
+#include <map>
+#include <fstream>
+#include <stdexcept>
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+
+using namespace std;
+namespace ham {
+
+// ----------------------------------------------------------------------------------------
+// everything we cache for one key (i.e. one cluster's colon-separated uids)
+class CacheEntry {
+public:
+  CacheEntry() : has_logprob_(false), logprob_(0.), has_naive_hfrac_(false), naive_hfrac_(0.) {}
+  CacheEntry(string logprob_str, string naive_seq, string naive_hfrac_str, string errors);  // from the (string) columns of a csv cache file line (or a cache server response)
+  void Update(CacheEntry &other);  // set anything that's set in <other> (i.e. empty values don't replace existing ones, same as for repeated lines in the csv file)
+
+  bool has_logprob_;
+  double logprob_;
+  bool has_naive_hfrac_;
+  double naive_hfrac_;
+  string naive_seq_;
+  string errors_;
+};
+
+// ----------------------------------------------------------------------------------------
+// Binary, append-only version of the hmm cache file, which we look things up in (via its hash indices) rather than parsing the whole thing.
+// The file is a series of self-contained segments, so appending one file to another gives a valid file. Each segment (all little-endian):
+//   header (32 bytes):  "HMMC", u32 version, u32 n_uids, u32 n_records, u32 n_buckets, u32 uid_blob_size, u64 segment_size
+//   uid table:          u32 offsets[n_uids + 1] into the following blob of (interned) uid strings, padded to a multiple of 8 bytes
+//   index:              n_buckets (a power of two) x {u32 crc32(key), u32 key length, u64 record offset from segment start (0 for empty buckets)}, with linear probing
+//   records:            u32 n_key_uids, u32 uid_indices[n_key_uids], u8 flags, then (depending on flags): f32 logprob, f32 naive_hfrac, u32 length + naive seq (2-bit packed if it's all ACGT), u32 length + errors
+// A key appears at most once in each segment, but can be in several segments, in which case later (non-empty) values take precedence.
+// This has to match python/hmmcachefile.py.
+class HmmCacheFile {
+public:
+  HmmCacheFile(string fname);
+  ~HmmCacheFile();
+  bool Get(string key, CacheEntry &entry);  // update <entry> with the info for <key> from each segment (returns false if it wasn't in any of them)
+  size_t n_segments() { return segments_.size(); }
+  size_t n_records();
+
+  static bool IsBinary(string fname);  // does <fname> have our suffix?
+  static void Append(string fname, vector<pair<string, CacheEntry> > &entries);  // write <entries> to a new segment at the end of <fname> (creating it if necessary)
+
+private:
+  class Segment {
+  public:
+    const char *start_, *uid_offsets_, *uid_blob_, *index_;
+    uint32_t n_uids_, n_records_, n_buckets_;
+  };
+  bool FindRecord(Segment &seg, string &key, uint32_t hash, CacheEntry &entry);
+  string GetUid(Segment &seg, uint32_t iuid);
+
+  string fname_;
+  int fd_;
+  size_t size_;
+  const char *data_;
+  vector<Segment> segments_;
+};
+
+}
+#endif
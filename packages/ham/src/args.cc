@@ -15,10 +15,12 @@ Args::Args(int argc, const char * argv[]):
   annotationfile_arg_("", "annotationfile", "if specified, write annotations for each cluster to here", false, "", "string"),
   input_cachefname_arg_("", "input-cachefname", "input cached log prob/naive seq csv file", false, "", "string"),
   output_cachefname_arg_("", "output-cachefname", "output cached log prob/naive seq csv file", false, "", "string"),
+  cache_server_socket_arg_("", "cache-server-socket", "unix socket of a cache server to use instead of the input/output cache files (see python/hmmcacheserver.py)", false, "", "string"),
   locus_arg_("", "locus", "ig{h,k,l} or tr{a,b,g,d}", true, "", "string"),
   algorithm_arg_("", "algorithm", "algorithm to run", true, "", &algo_vals_),
   ambig_base_arg_("", "ambig-base", "ambiguous base", false, "", "string"),
   seed_unique_id_arg_("", "seed-unique-id", "seed unique id", false, "", "string"),
+  seed_unique_id_fname_arg_("", "seed-unique-id-fname", "file with additional seed unique ids (one per line): when partitioning, we only merge pairs of clusters in which at least one contains a seed", false, "", "string"),
   hamming_fraction_bound_lo_arg_("", "hamming-fraction-bound-lo", "if hamming fraction for a pair is smaller than this, merge them without calculating lratio", false, 0.0, "float"),
   hamming_fraction_bound_hi_arg_("", "hamming-fraction-bound-hi", "if hamming fraction for a pair is larger than this, skip without calculating lratio", false, 1.0, "float"),
   logprob_ratio_threshold_arg_("", "logprob-ratio-threshold", "", false, -INFINITY, "float"),
@@ -31,6 +33,7 @@ Args::Args(int argc, const char * argv[]):
   n_final_clusters_arg_("", "n-final-clusters", "instead of stopping at the most likely partition, stop when you have this many clusters", false, 0, "unsigned"),
   min_largest_cluster_size_arg_("", "min-largest-cluster-size", "instead of stopping at the most likely partition, stop when your largest cluster is this big", false, 0, "unsigned"),
   max_cluster_size_arg_("", "max-cluster-size", "if any cluster gets bigger than this, stop clustering", false, 0, "unsigned"),
+  n_threads_arg_("", "n-threads", "number of threads with which to calculate the forward log probs for candidate lratio merges", false, 1, "unsigned"),
   random_seed_arg_("", "random-seed", "", false, time(NULL), "unsigned"),
   no_chunk_cache_arg_("", "no-chunk-cache", "don't perform chunk caching?", false),
   partition_arg_("", "partition", "", false),
@@ -55,6 +58,7 @@ Args::Args(int argc, const char * argv[]):
     cmd.add(annotationfile_arg_);
     cmd.add(input_cachefname_arg_);
     cmd.add(output_cachefname_arg_);
+    cmd.add(cache_server_socket_arg_);
     cmd.add(locus_arg_);
     cmd.add(hamming_fraction_bound_lo_arg_);
     cmd.add(hamming_fraction_bound_hi_arg_);
@@ -63,6 +67,7 @@ Args::Args(int argc, const char * argv[]):
     cmd.add(algorithm_arg_);
     cmd.add(ambig_base_arg_);
     cmd.add(seed_unique_id_arg_);
+    cmd.add(seed_unique_id_fname_arg_);
     cmd.add(debug_arg_);
     cmd.add(naive_hamming_cluster_arg_);
     cmd.add(biggest_naive_seq_cluster_to_calculate_arg_);
@@ -71,6 +76,7 @@ Args::Args(int argc, const char * argv[]):
     cmd.add(n_final_clusters_arg_);
     cmd.add(min_largest_cluster_size_arg_);
     cmd.add(max_cluster_size_arg_);
+    cmd.add(n_threads_arg_);
     cmd.add(random_seed_arg_);
     cmd.add(no_chunk_cache_arg_);
     cmd.add(cache_naive_seqs_arg_);
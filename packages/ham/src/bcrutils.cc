@@ -301,6 +301,39 @@ void Result::check_boundaries(KSet best, KBounds kbounds) {
     could_not_expand_ = true;
 }
 
+// ----------------------------------------------------------------------------------------
+PackedSeq::PackedSeq(string &seq, Track *track) :
+  size_(seq.size()),
+  bits_((seq.size() + 31) / 32, 0),
+  mask_((seq.size() + 31) / 32, 0)
+{
+  for(size_t ic=0; ic<seq.size(); ++ic) {
+    uint8_t ich = track->symbol_index(seq.substr(ic, 1));
+    if(ich == track->ambiguous_index())  // leave both bits and mask zero
+      continue;
+    if(ich > 3)
+      throw runtime_error("symbol index " + to_string(ich) + " for " + seq.substr(ic, 1) + " doesn't fit in two bits in PackedSeq::PackedSeq()");
+    size_t shift(2 * (ic % 32));
+    bits_[ic / 32] |= uint64_t(ich) << shift;
+    mask_[ic / 32] |= uint64_t(1) << shift;
+  }
+}
+
+// ----------------------------------------------------------------------------------------
+void PackedSeq::HammingDistance(PackedSeq &other, int &distance, int &len_excluding_ambigs) {
+  if(size_ != other.size_)
+    throw runtime_error("sequences different length in PackedSeq::HammingDistance() " + to_string(size_) + " " + to_string(other.size_));
+  distance = 0;
+  len_excluding_ambigs = 0;
+  for(size_t iw=0; iw<bits_.size(); ++iw) {
+    uint64_t valid(mask_[iw] & other.mask_[iw]);
+    uint64_t diff(bits_[iw] ^ other.bits_[iw]);
+    diff = (diff | (diff >> 1)) & valid;  // collapse each two-bit slot onto its low bit, and only keep positions at which neither seq is ambiguous
+    distance += __builtin_popcountll(diff);
+    len_excluding_ambigs += __builtin_popcountll(valid);
+  }
+}
+
 // ----------------------------------------------------------------------------------------
 void HMMHolder::CacheAll() {
   for(auto & region : gl_.regions_) {
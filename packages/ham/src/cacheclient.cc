@@ -0,0 +1,82 @@
+#include "cacheclient.h"
+namespace ham {
+
+// ----------------------------------------------------------------------------------------
+CacheClient::CacheClient(string socket_path) :
+  socket_path_(socket_path),
+  rfile_(nullptr),
+  wfile_(nullptr)
+{
+  struct sockaddr_un addr;
+  if(socket_path_.size() >= sizeof(addr.sun_path))
+    throw runtime_error("cache server socket path too long: " + socket_path_);
+  int fd = socket(AF_UNIX, SOCK_STREAM, 0);
+  if(fd < 0)
+    throw runtime_error("couldn't create socket for cache server " + socket_path_);
+  memset(&addr, 0, sizeof(addr));
+  addr.sun_family = AF_UNIX;
+  strncpy(addr.sun_path, socket_path_.c_str(), sizeof(addr.sun_path) - 1);
+  if(connect(fd, (struct sockaddr*)&addr, sizeof(addr)) < 0) {
+    close(fd);
+    throw runtime_error("couldn't connect to cache server " + socket_path_);
+  }
+  rfile_ = fdopen(fd, "r");
+  wfile_ = fdopen(dup(fd), "w");
+  if(rfile_ == nullptr || wfile_ == nullptr)
+    throw runtime_error("couldn't open streams for cache server " + socket_path_);
+}
+
+// ----------------------------------------------------------------------------------------
+CacheClient::~CacheClient() {
+  if(wfile_ != nullptr)
+    fclose(wfile_);  // flushes any remaining puts
+  if(rfile_ != nullptr)
+    fclose(rfile_);
+}
+
+// ----------------------------------------------------------------------------------------
+vector<vector<string> > CacheClient::Get(vector<string> &keys) {
+  vector<vector<string> > results;
+  if(keys.size() == 0)
+    return results;
+
+  fputs("get", wfile_);
+  for(auto &key : keys) {
+    fputs(" ", wfile_);
+    fputs(key.c_str(), wfile_);
+  }
+  fputs("\n", wfile_);
+  if(fflush(wfile_) != 0)
+    throw runtime_error("lost connection to cache server " + socket_path_);
+
+  char *buffer(nullptr);
+  size_t bufsize(0);
+  for(size_t ik=0; ik<keys.size(); ++ik) {
+    ssize_t nread = getline(&buffer, &bufsize, rfile_);
+    if(nread <= 0) {
+      free(buffer);
+      throw runtime_error("lost connection to cache server " + socket_path_);
+    }
+    string line(buffer, nread);
+    if(line.back() == '\n')
+      line.pop_back();
+    vector<string> columns(SplitString(line, ","));
+    if(columns.size() != 4) {
+      free(buffer);
+      throw runtime_error("unexpected response from cache server for " + keys[ik] + ": " + line);
+    }
+    results.push_back(columns);
+  }
+  free(buffer);
+  return results;
+}
+
+// ----------------------------------------------------------------------------------------
+void CacheClient::Put(string cacheline) {
+  fputs("put ", wfile_);
+  fputs(cacheline.c_str(), wfile_);
+  if(fflush(wfile_) != 0)  // flush right away, so other procs can see it (and it's tiny compared to the time it took to calculate)
+    throw runtime_error("lost connection to cache server " + socket_path_);
+}
+
+}
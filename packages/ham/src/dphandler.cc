@@ -294,7 +294,7 @@ void DPHandler::PrintPath(KSet kset, vector<string> query_strs, string gene, dou
   TermColors tc;
 
   // make a string for the germline match
-  string germline(gl_.seqs_[gene]);
+  string germline(gl_.seqs_.at(gene));
   string modified_germline = germline.substr(left_erosion_length, germline.size() - right_erosion_length - left_erosion_length);  // remove deletions
   modified_germline = left_insert + modified_germline + right_insert;  // add insertions to either end
   assert(modified_germline.size() == query_strs[0].size());
@@ -547,7 +547,7 @@ string DPHandler::GetInsertion(string side, vector<string> names) {
 size_t DPHandler::GetErosionLength(string side, vector<string> names, string gene_name) {
   // NOTE this does *not* count a bunch of Ns at the end as an erosion, that interpretation is made in partitiondriver.py
 
-  string germline(gl_.seqs_[gene_name]);
+  string germline(gl_.seqs_.at(gene_name));
 
   // first check if we eroded the entire sequence. If so we can't say how much was left and how much was right, so just (integer) divide by two (arbitrarily giving one side the odd base if necessary)
   bool its_inserts_all_the_way_down(true);
@@ -602,7 +602,7 @@ size_t DPHandler::GetErosionLength(string side, vector<string> names, string gen
   if(side == "left") {
     length = state_index;
   } else if(side == "right") {
-    size_t germline_length = gl_.seqs_[gene_name].size();
+    size_t germline_length = gl_.seqs_.at(gene_name).size();
     length = germline_length - state_index - 1;
   } else {
     assert(0);
@@ -8,6 +8,7 @@ Glomerator::Glomerator(HMMHolder &hmms, GermLines &gl, vector<vector<Sequence> >
   args_(args),
   gl_(gl),
   hmms_(hmms),
+  pair_index_initialized_(false),
   n_fwd_calculated_(0),
   n_vtb_calculated_(0),
   n_hfrac_calculated_(0),
@@ -15,11 +16,16 @@ Glomerator::Glomerator(HMMHolder &hmms, GermLines &gl, vector<vector<Sequence> >
   n_lratio_merges_(0),
   asym_factor_(4.),
   force_merge_(false),
+  cache_client_(nullptr),
+  cache_file_(nullptr),
   current_partition_(nullptr),
   progress_file_(fopen((args_->outfile() + ".progress").c_str(), "w"))
 {
   time(&last_status_write_time_);
+  if(args_->cache_server_socket() != "")
+    cache_client_ = new CacheClient(args_->cache_server_socket());
   ReadCacheFile();
+  ReadSeedUids();
 
   for(size_t iqry = 0; iqry < qry_seq_list.size(); iqry++) {
     string key = SeqNameStr(qry_seq_list[iqry], ":");
@@ -35,7 +41,7 @@ Glomerator::Glomerator(HMMHolder &hmms, GermLines &gl, vector<vector<Sequence> >
     for(auto &uid : SplitString(key)) {
       single_seq_cachefo_[uid] = Query(uid,  // NOTE these are not necessarily the same as they would be (well, were) for the single seqs -- e.g. only_genes is now the OR for all the sequences
 				       GetSeqs(uid),
-				       !InString(args_->seed_unique_id(), uid),
+				       !HasSeed(uid),
 				       args_->str_lists_["only_genes"][iqry],
 				       KBounds(kmin, kmax),
 				       args_->floats_["mut_freq"][iqry],
@@ -44,7 +50,7 @@ Glomerator::Glomerator(HMMHolder &hmms, GermLines &gl, vector<vector<Sequence> >
 
     cachefo_[key] = Query(key,
 			  GetSeqs(key),
-			  !InString(args_->seed_unique_id(), key),
+			  !HasSeed(key),
 			  args_->str_lists_["only_genes"][iqry],
 			  KBounds(kmin, kmax),
 			  args_->floats_["mut_freq"][iqry],
@@ -52,12 +58,27 @@ Glomerator::Glomerator(HMMHolder &hmms, GermLines &gl, vector<vector<Sequence> >
   }
 
   current_partition_ = &initial_partition_;
+
+  if(cache_client_ != nullptr || cache_file_ != nullptr) {  // get everything we'll need for the initial partition in one go (clusters we make by merging get fetched as we go)
+    vector<string> keys(initial_partition_.begin(), initial_partition_.end());
+    for(auto &kv : single_seq_cachefo_)
+      if(!initial_partition_.count(kv.first))
+	keys.push_back(kv.first);
+    FetchCachedInfo(keys);
+    cout << "        read-cache:  logprobs " << log_probs_.size() << "   naive-seqs " << naive_seqs_.size() << endl;
+  }
 }
 
 // ----------------------------------------------------------------------------------------
 Glomerator::~Glomerator() {
   cout << FinalString(true) << endl;
+  for(auto *thmms : thread_hmms_)
+    delete thmms;
+  if(cache_file_ != nullptr)  // close it before writing, since the output file may be the same as the input file
+    delete cache_file_;
   WriteCacheFile();
+  if(cache_client_ != nullptr)
+    delete cache_client_;
   fclose(progress_file_);
   remove((args_->outfile() + ".progress").c_str());
 
@@ -86,7 +107,7 @@ void Glomerator::CacheNaiveSeqs() {  // they're written to file in the destructo
 void Glomerator::Cluster() {
   if(args_->debug()) {
     cout << "   hieragloming " << initial_partition_.size() << " clusters";
-    if(args_->seed_unique_id() != "")
+    if(!seed_uids_.empty())
       cout << "  (" << GetSeededClusters(initial_partition_).size() << " seeded)";
     cout << endl;
   }
@@ -113,7 +134,16 @@ void Glomerator::Cluster() {
 // ----------------------------------------------------------------------------------------
 void Glomerator::ReadCacheFile() {
   if(args_->input_cachefname() == "") {
-    cout << "        read-cache:  logprobs 0   naive-seqs 0" << endl;
+    if(cache_client_ == nullptr)  // if we're using the cache server, this gets printed after we fetch from it
+      cout << "        read-cache:  logprobs 0   naive-seqs 0" << endl;
+    return;
+  }
+
+  if(args_->output_cachefname() != "" && HmmCacheFile::IsBinary(args_->input_cachefname()) != HmmCacheFile::IsBinary(args_->output_cachefname()))  // we only write new info to binary files, so they can't be mixed with csv
+    throw runtime_error("input and output cache files have to either both be binary or both csv, but got " + args_->input_cachefname() + " and " + args_->output_cachefname() + "\n");
+  if(HmmCacheFile::IsBinary(args_->input_cachefname())) {  // we look things up as we need them (the read-cache line gets printed after we fetch the ones for the initial partition)
+    if(cache_client_ == nullptr)  // if we've got the cache server, it has all the info that's in the file
+      cache_file_ = new HmmCacheFile(args_->input_cachefname());
     return;
   }
 
@@ -140,37 +170,115 @@ void Glomerator::ReadCacheFile() {
     line.erase(remove(line.begin(), line.end(), '\r'), line.end());
     vector<string> column_list = SplitString(line, ",");
     assert(column_list.size() == 5);
-    string query(column_list[0]);
-    string errors(column_list[4]);
-    if(errors.find("no_path") != string::npos) {
-      failed_queries_.insert(query);
-      continue;
-    }
+    CacheEntry entry(column_list[1], column_list[2], column_list[3], column_list[4]);
+    AddCacheInfo(column_list[0], entry);
+  }
+  cout << "        read-cache:  logprobs " << log_probs_.size() << "   naive-seqs " << naive_seqs_.size() << endl;
+}
 
-    string logprob_str(column_list[1]);
-    if(logprob_str.size() > 0) {  // NOTE <query> might already be in <log_probs_> (see above), but this won't replace it unless it's actually set in the file (we could also check that they're similar, but since we don't expect them to always be identical, that would be complicated)
-      log_probs_[query] = stof(logprob_str);
-      initial_log_probs_.insert(query);
-    }
+// ----------------------------------------------------------------------------------------
+// add the info from one line of the cache file (or one response from the cache server)
+void Glomerator::AddCacheInfo(string query, CacheEntry &entry) {
+  if(entry.errors_.find("no_path") != string::npos) {
+    failed_queries_.insert(query);
+    return;
+  }
 
-    string naive_seq(column_list[2]);
+  if(entry.has_logprob_) {  // NOTE <query> might already be in <log_probs_> (see above), but this won't replace it unless it's actually set in the file (we could also check that they're similar, but since we don't expect them to always be identical, that would be complicated)
+    log_probs_[query] = entry.logprob_;
+    initial_log_probs_.insert(query);
+  }
 
-    string naive_hfrac_str(column_list[3]);
-    if(naive_hfrac_str.size() > 0) {
-      naive_hfracs_[query] = stof(naive_hfrac_str);
-      initial_naive_hfracs_.insert(query);
-    }
+  if(entry.has_naive_hfrac_) {
+    naive_hfracs_[query] = entry.naive_hfrac_;
+    initial_naive_hfracs_.insert(query);
+  }
 
-    if(naive_seq.size() > 0) {
-      naive_seqs_[query] = naive_seq;
-      initial_naive_seqs_.insert(query);
+  if(entry.naive_seq_.size() > 0) {
+    naive_seqs_[query] = entry.naive_seq_;
+    initial_naive_seqs_.insert(query);
+  }
+}
+
+// ----------------------------------------------------------------------------------------
+// everything we know about <query>, in the form we write to binary cache files
+CacheEntry Glomerator::GetCacheEntry(string query) {
+  CacheEntry entry;
+  if(log_probs_.count(query)) {
+    entry.has_logprob_ = true;
+    entry.logprob_ = log_probs_[query];
+  }
+  if(args_->cache_naive_hfracs() && naive_hfracs_.count(query)) {
+    entry.has_naive_hfrac_ = true;
+    entry.naive_hfrac_ = naive_hfracs_[query];
+  }
+  if(naive_seqs_.count(query))
+    entry.naive_seq_ = naive_seqs_[query];
+  if(errors_.count(query))
+    entry.errors_ = errors_[query];
+  return entry;
+}
+
+// ----------------------------------------------------------------------------------------
+// look up any of <keys> that we haven't already looked up in the cache server or binary cache file
+void Glomerator::FetchCachedInfo(vector<string> keys) {
+  if(cache_client_ == nullptr && cache_file_ == nullptr)
+    return;
+  vector<string> keys_to_fetch;
+  for(auto &key : keys) {
+    if(fetched_keys_.count(key))  // already asked about it (and if it had it, it's now in our maps)
+      continue;
+    fetched_keys_.insert(key);
+    if(prefetched_cachefo_.count(key)) {  // PrecalculateLRatioLogProbs() already asked about it, but left it to us to add the info (so it happens in the same order as without threads)
+      AddCacheInfo(key, prefetched_cachefo_[key]);
+      prefetched_cachefo_.erase(key);
+      continue;
     }
+    keys_to_fetch.push_back(key);
   }
-  cout << "        read-cache:  logprobs " << log_probs_.size() << "   naive-seqs " << naive_seqs_.size() << endl;
+  vector<CacheEntry> entries(LookUpCachedInfo(keys_to_fetch));
+  for(size_t ik=0; ik<keys_to_fetch.size(); ++ik)
+    AddCacheInfo(keys_to_fetch[ik], entries[ik]);
 }
 
 // ----------------------------------------------------------------------------------------
-void Glomerator::WriteCacheLine(ofstream &ofs, string query) {
+// ask the cache server or binary cache file about <keys>, but don't add anything to our maps (entries are empty for keys that it doesn't have)
+vector<CacheEntry> Glomerator::LookUpCachedInfo(vector<string> &keys) {
+  vector<CacheEntry> entries(keys.size());
+  if(keys.size() == 0)
+    return entries;
+  if(cache_client_ != nullptr) {
+    vector<vector<string> > results(cache_client_->Get(keys));
+    for(size_t ik=0; ik<keys.size(); ++ik)
+      entries[ik] = CacheEntry(results[ik][0], results[ik][1], results[ik][2], results[ik][3]);
+  } else {
+    for(size_t ik=0; ik<keys.size(); ++ik)
+      cache_file_->Get(keys[ik], entries[ik]);
+  }
+  return entries;
+}
+
+// ----------------------------------------------------------------------------------------
+void Glomerator::FetchCachedInfo(string key) {
+  if(cache_client_ == nullptr && cache_file_ == nullptr)
+    return;
+  FetchCachedInfo(vector<string>{key});
+}
+
+// ----------------------------------------------------------------------------------------
+// send everything we know about <key> to the cache server (the server overwrites any columns that are non-empty)
+void Glomerator::PublishToCacheServer(string key) {
+  if(cache_client_ == nullptr)
+    return;
+  fetched_keys_.insert(key);  // no point asking about it after this
+  ostringstream oss;
+  oss << setprecision(20);
+  WriteCacheLine(oss, key);
+  cache_client_->Put(oss.str());
+}
+
+// ----------------------------------------------------------------------------------------
+void Glomerator::WriteCacheLine(ostream &ofs, string query) {
   ofs << query << ",";
   if(log_probs_.count(query))
     ofs << log_probs_[query];
@@ -191,32 +299,41 @@ void Glomerator::WriteCacheFile() {
   if(args_->output_cachefname() == "")
     return;
 
-  ofstream log_prob_ofs(args_->output_cachefname());
-  if(!log_prob_ofs.is_open())
-    throw runtime_error("couldn't open output cache file " + args_->output_cachefname() + "\n");
-
-  log_prob_ofs << "unique_ids,logprob,naive_seq,naive_hfrac,errors" << endl;  // these have to match the line in ReadCacheFile(), as well as partition_cachefile_headers in utils.py
-  log_prob_ofs << setprecision(20);
-
+  bool binary(HmmCacheFile::IsBinary(args_->output_cachefname()));
+  bool only_new_vals(args_->only_cache_new_vals() || binary);  // binary files are append-only, and (since we look things up lazily) we may not have even read everything in the input file
   set<string> keys_to_cache;
   for(auto &kv : log_probs_) {
-    if(args_->only_cache_new_vals() && initial_log_probs_.count(kv.first))  // don't cache it if we had it in the initial cache file (this is just an optimization)
+    if(only_new_vals && initial_log_probs_.count(kv.first))  // don't cache it if we had it in the initial cache file (this is just an optimization)
       continue;
     keys_to_cache.insert(kv.first);
   }
   for(auto &kv : naive_seqs_) {
-    if(args_->only_cache_new_vals() && initial_naive_seqs_.count(kv.first))  // note that if we had an initial log prob, but not an initial naive seq, we *do* want to write it (if we calculated the naive seq)
+    if(only_new_vals && initial_naive_seqs_.count(kv.first))  // note that if we had an initial log prob, but not an initial naive seq, we *do* want to write it (if we calculated the naive seq)
       continue;
     keys_to_cache.insert(kv.first);
   }
   if(args_->cache_naive_hfracs()) {
     for(auto &kv : naive_hfracs_) {
-      if(args_->only_cache_new_vals() && initial_naive_hfracs_.count(kv.first))
+      if(only_new_vals && initial_naive_hfracs_.count(kv.first))
 	continue;
       keys_to_cache.insert(kv.first);
     }
   }
 
+  if(binary) {
+    vector<pair<string, CacheEntry> > entries;
+    for(auto &key : keys_to_cache)
+      entries.push_back(pair<string, CacheEntry>(key, GetCacheEntry(key)));
+    HmmCacheFile::Append(args_->output_cachefname(), entries);
+    return;
+  }
+
+  ofstream log_prob_ofs(args_->output_cachefname());
+  if(!log_prob_ofs.is_open())
+    throw runtime_error("couldn't open output cache file " + args_->output_cachefname() + "\n");
+
+  log_prob_ofs << "unique_ids,logprob,naive_seq,naive_hfrac,errors" << endl;  // these have to match the line in ReadCacheFile(), as well as partition_cachefile_headers in utils.py
+  log_prob_ofs << setprecision(20);
   for(auto &key : keys_to_cache)
     WriteCacheLine(log_prob_ofs, key);
 
@@ -262,7 +379,7 @@ void Glomerator::WriteAnnotations(ClusterPath &cp) {
 
   // NOTE we're no longer calculating the logprob for *every* partition, but in Glomerator::WritePartitions() we *do* calculate them if we're told to (i.e. the last time through), and this can make it so the last partition isn't the most likely
   for(auto &cluster : cp.partitions()[cp.i_best()]) {
-    if(args_->seed_unique_id() != "" && SeedMissing(cluster))
+    if(!seed_uids_.empty() && SeedMissing(cluster))
       continue;
 
     RecoEvent event;
@@ -430,6 +547,34 @@ string Glomerator::PrintStr(string queries) {
     return "len(" + to_string(CountMembers(queries)) + ")";
 }
 
+// ----------------------------------------------------------------------------------------
+void Glomerator::ReadSeedUids() {
+  if(args_->seed_unique_id() != "")
+    seed_uids_.insert(args_->seed_unique_id());
+  if(args_->seed_unique_id_fname() == "")
+    return;
+  ifstream ifs(args_->seed_unique_id_fname());
+  if(!ifs.is_open())
+    throw runtime_error("couldn't open seed unique id file " + args_->seed_unique_id_fname());
+  string uid;
+  while(getline(ifs, uid)) {
+    if(uid != "")
+      seed_uids_.insert(uid);
+  }
+  ifs.close();
+}
+
+// ----------------------------------------------------------------------------------------
+// does <queries> contain any of the seed uids? (only called when we make a new Query -- after that, use SeedMissing(), which looks it up in the cache)
+bool Glomerator::HasSeed(string queries) {
+  if(seed_uids_.empty())
+    return false;
+  for(auto &uid : SplitString(queries))
+    if(seed_uids_.count(uid))
+      return true;
+  return false;
+}
+
 // ----------------------------------------------------------------------------------------
 bool Glomerator::SeedMissing(string queries) {
   return cachefo(queries).seed_missing_;  // NOTE after refactoring the double loops, we probably don't really need to cache all these any more
@@ -445,36 +590,41 @@ bool Glomerator::SeedMissing(string queries) {
 }
 
 // ----------------------------------------------------------------------------------------
-double Glomerator::CalculateHfrac(string &seq_a, string &seq_b) {
+double Glomerator::CalculateHfrac(PackedSeq &pseq_a, PackedSeq &pseq_b) {
   ++n_hfrac_calculated_;
-  if(seq_a.size() != seq_b.size())
-    throw runtime_error("sequences different length in Glomerator::NaiveHfrac\n    " + to_string(seq_a.size()) + ": " + seq_a + "\n    " + to_string(seq_b.size()) + ": " + seq_b + "\n");
   int distance(0), len_excluding_ambigs(0);
-  for(size_t ic=0; ic<seq_a.size(); ++ic) {
-    uint8_t ch_a = track_->symbol_index(seq_a.substr(ic, 1));  // kind of hackey remnant left from when naive seqs were Sequence objects
-    uint8_t ch_b = track_->symbol_index(seq_b.substr(ic, 1));
-    if(ch_a == track_->ambiguous_index() || ch_b == track_->ambiguous_index())  // skip this position if either sequence has an ambiguous character (if not set, ambig-base should be the empty string)
-      continue;
-    ++len_excluding_ambigs;
-    if(ch_a != ch_b)
-      ++distance;
-  }
-
+  pseq_a.HammingDistance(pseq_b, distance, len_excluding_ambigs);  // skips positions where either sequence has an ambiguous character (if not set, ambig-base should be the empty string)
   return distance / double(len_excluding_ambigs);
 }
 
+// ----------------------------------------------------------------------------------------
+PackedSeq &Glomerator::GetPackedNaiveSeq(string key) {
+  if(packed_naive_seqs_.count(key) == 0)
+    packed_naive_seqs_[key] = PackedSeq(GetNaiveSeq(key), track_);
+  return packed_naive_seqs_[key];
+}
+
 // ----------------------------------------------------------------------------------------
 double Glomerator::NaiveHfrac(string key_a, string key_b) {
   string joint_key = JoinNames(key_a, key_b);  // NOTE since the cache is indexed by the joint key, this assumes we can arrive at this cluster via only one path. Which should be ok.
   if(naive_hfracs_.count(joint_key))  // if we've already calculated this distance
     return naive_hfracs_[joint_key];
+  if(args_->cache_naive_hfracs()) {  // if we're not caching them, they won't be in the cache
+    FetchCachedInfo(joint_key);
+    if(naive_hfracs_.count(joint_key))
+      return naive_hfracs_[joint_key];
+  }
 
   string &seq_a = GetNaiveSeq(key_a);
   string &seq_b = GetNaiveSeq(key_b);
   double hfrac(INFINITY);
   if(failed_queries_.count(key_a) || failed_queries_.count(key_b))
     return hfrac;
-  naive_hfracs_[joint_key] = CalculateHfrac(seq_a, seq_b);
+  if(seq_a.size() != seq_b.size())
+    throw runtime_error("sequences different length in Glomerator::NaiveHfrac\n    " + to_string(seq_a.size()) + ": " + seq_a + "\n    " + to_string(seq_b.size()) + ": " + seq_b + "\n");
+  naive_hfracs_[joint_key] = CalculateHfrac(GetPackedNaiveSeq(key_a), GetPackedNaiveSeq(key_b));
+  if(args_->cache_naive_hfracs())
+    PublishToCacheServer(joint_key);
 
   return naive_hfracs_[joint_key];
 }
@@ -521,7 +671,7 @@ string Glomerator::ChooseSubsetOfNames(string queries, int n_max) {
 
   tmp_cachefo_[subqueries] = Query(subqueries,
 				   GetSeqs(subqueries),
-				   !InString(args_->seed_unique_id(), subqueries),
+				   !HasSeed(subqueries),
 				   cacheref.only_genes_,
 				   cacheref.kbounds_,
 				   cacheref.mute_freq_,
@@ -628,6 +778,9 @@ string Glomerator::FindNaiveSeqNameReplace(pair<string, string> *parents) {
 
 // ----------------------------------------------------------------------------------------
 string &Glomerator::GetNaiveSeq(string queries, pair<string, string> *parents) {
+  if(naive_seqs_.count(queries))
+    return naive_seqs_[queries];
+  FetchCachedInfo(queries);  // maybe it's in the cache (or somebody else already calculated it)
   if(naive_seqs_.count(queries))
     return naive_seqs_[queries];
 
@@ -636,6 +789,7 @@ string &Glomerator::GetNaiveSeq(string queries, pair<string, string> *parents) {
     string name_with_which_to_replace = FindNaiveSeqNameReplace(parents);
     if(name_with_which_to_replace != "") {
       naive_seqs_[queries] = GetNaiveSeq(name_with_which_to_replace);  // copy the whole sequence object  TODO this doesn't follow/do the turtle thing
+      PublishToCacheServer(queries);
       return naive_seqs_[queries];
     }
   }
@@ -644,14 +798,19 @@ string &Glomerator::GetNaiveSeq(string queries, pair<string, string> *parents) {
   string queries_to_calc = GetNaiveSeqNameToCalculate(queries);
 
   // actually calculate the viterbi path for whatever queries we've decided on
+  if(naive_seqs_.count(queries_to_calc) == 0)
+    FetchCachedInfo(queries_to_calc);
   if(naive_seqs_.count(queries_to_calc) == 0) {
     string tmp_nseq = CalculateNaiveSeq(queries_to_calc);  // some compilers add <queries_to_calc> to <naive_seqs_> *before* calling CalculateNaiveSeq(), which causes that function's check to fail
     naive_seqs_[queries_to_calc] = tmp_nseq;
+    PublishToCacheServer(queries_to_calc);
   }
 
   // if we did some translation, propagate the naive sequence back to the queries we were originally interested in
-  if(queries_to_calc != queries)
+  if(queries_to_calc != queries) {
     naive_seqs_[queries] = naive_seqs_[queries_to_calc];
+    PublishToCacheServer(queries);
+  }
 
   return naive_seqs_[queries];
 }
@@ -666,9 +825,13 @@ string &Glomerator::GetNaiveSeq(string queries, pair<string, string> *parents) {
 double Glomerator::GetLogProb(string queries) {  // NOTE this does *no* translation, so you better have done that already before you call it if you want it done
   if(log_probs_.count(queries))  // already did it
     return log_probs_[queries];
+  FetchCachedInfo(queries);
+  if(log_probs_.count(queries))  // it was in the cache
+    return log_probs_[queries];
 
   double tmplp = CalculateLogProb(queries);  // NOTE this should be the *only* place (besides cache reading) that log_probs_ gets modified
   log_probs_[queries] = tmplp;  // tmp variable is just so we can assert that queries isn't already in log_probs_
+  PublishToCacheServer(queries);
 
   return log_probs_[queries];
 }
@@ -745,16 +908,125 @@ double Glomerator::CalculateLogProb(string queries) {  // NOTE can modify kbinfo
   
   ++n_fwd_calculated_;
 
-  DPHandler dph("forward", args_, gl_, hmms_);
-  Query &cacheref = cachefo(queries);
-  Result result = dph.Run(cacheref.seqs_, cacheref.kbounds_, cacheref.only_genes_, cacheref.mute_freq_);
-  if(result.no_path_) {
+  double score(-INFINITY);
+  bool no_path(false);
+  if(precalculated_log_probs_.count(queries)) {  // CalculateLogProbs() already ran forward on it (but left all the bookkeeping to us, so it happens in the same order as without threads)
+    score = precalculated_log_probs_[queries].first;
+    no_path = precalculated_log_probs_[queries].second;
+    precalculated_log_probs_.erase(queries);
+  } else {
+    DPHandler dph("forward", args_, gl_, hmms_);
+    Query &cacheref = cachefo(queries);
+    Result result = dph.Run(cacheref.seqs_, cacheref.kbounds_, cacheref.only_genes_, cacheref.mute_freq_);
+    no_path = result.no_path_;
+    if(!no_path)
+      score = result.total_score();
+  }
+  if(no_path) {
     AddFailedQuery(queries, "no_path");
     return -INFINITY;
   }
 
   WriteStatus();
-  return result.total_score();
+  return score;
+}
+
+// ----------------------------------------------------------------------------------------
+// Go through the candidate pairs in the same order as FindLRatioMerge(), doing the name translation/subset choice and Query bookkeeping that GetLogProbRatio() would do, and calculate (on --n-threads threads) all the log probs that we might need.
+// This only fills <prefetched_cachefo_> and <precalculated_log_probs_>: GetLogProb() then uses them when (and if) the serial loop in FindLRatioMerge() gets to them, and does the cache/failed query bookkeeping at that point.
+// So the results are the same as without threads (e.g. a cluster that turns out to have no path still gets its first lratio calculated, and can be merged), but we may calculate some log probs that the serial loop never uses (e.g. because one of the clusters failed before it got to them).
+void Glomerator::PrecalculateLRatioLogProbs() {
+  vector<string> keys_to_fetch;
+  set<string> keys_seen;
+  for(auto &cpair : candidate_pairs_) {
+    string key_a(cpair.first.first), key_b(cpair.first.second);
+    if(failed_queries_.count(key_a) || failed_queries_.count(key_b))
+      continue;
+    string joint_name(JoinNames(key_a, key_b));
+    if(lratios_.count(joint_name))
+      continue;
+    Query full_qmerged = GetMergedQuery(key_a, key_b);
+    pair<string, string> parents_to_calc = GetLogProbPairOfNamesToCalculate(joint_name, full_qmerged.parents_);
+    Query &qmerged_to_calc = GetMergedQuery(parents_to_calc.first, parents_to_calc.second);
+    for(auto &key : vector<string>{parents_to_calc.first, parents_to_calc.second, qmerged_to_calc.name_}) {
+      if(log_probs_.count(key) || keys_seen.count(key))
+	continue;
+      keys_seen.insert(key);
+      keys_to_fetch.push_back(key);
+    }
+  }
+
+  PrefetchCachedInfo(keys_to_fetch);  // one round trip to the cache server (if we're using one) rather than one for each key
+  vector<string> keys_to_calc;
+  for(auto &key : keys_to_fetch) {
+    if(precalculated_log_probs_.count(key))
+      continue;
+    if(prefetched_cachefo_.count(key) && prefetched_cachefo_[key].has_logprob_)  // GetLogProb() will find it in the cache
+      continue;
+    keys_to_calc.push_back(key);
+  }
+  if(keys_to_calc.size() > 1)  // if there's only one, it's simpler to let GetLogProb() do it
+    CalculateLogProbs(keys_to_calc);
+}
+
+// ----------------------------------------------------------------------------------------
+// look up in the cache any of <keys> that we haven't already looked up, but only store the results in <prefetched_cachefo_> (FetchCachedInfo() adds them to our maps when it's asked for them)
+void Glomerator::PrefetchCachedInfo(vector<string> &keys) {
+  if(cache_client_ == nullptr && cache_file_ == nullptr)
+    return;
+  vector<string> keys_to_fetch;
+  for(auto &key : keys)
+    if(!fetched_keys_.count(key) && !prefetched_cachefo_.count(key))
+      keys_to_fetch.push_back(key);
+  vector<CacheEntry> entries(LookUpCachedInfo(keys_to_fetch));
+  for(size_t ik=0; ik<keys_to_fetch.size(); ++ik)
+    prefetched_cachefo_[keys_to_fetch[ik]] = entries[ik];
+}
+
+// ----------------------------------------------------------------------------------------
+// run forward for <queries> (none of which can already be in <log_probs_>) with --n-threads threads, and put the results in <precalculated_log_probs_> for CalculateLogProb() to use
+void Glomerator::CalculateLogProbs(vector<string> &queries) {
+  vector<Query*> qrefs;
+  for(auto &query : queries) {
+    assert(log_probs_.count(query) == 0);
+    qrefs.push_back(&cachefo(query));  // cachefo() can add to <tmp_cachefo_>, so we have to do it before starting the threads (references into a map stay valid as other entries are added)
+  }
+
+  size_t n_threads(min(size_t(args_->n_threads()), queries.size()));
+  while(thread_hmms_.size() < n_threads)
+    thread_hmms_.push_back(new HMMHolder(args_->hmmdir(), gl_, track_));
+
+  vector<double> scores(queries.size(), -INFINITY);
+  vector<char> no_paths(queries.size(), 0);  // not vector<bool>, since its elements share bytes, so threads writing to different ones would race
+  vector<exception_ptr> errors(n_threads);
+  atomic<size_t> inext(0);  // index of the next query that a thread should take
+  vector<thread> threads;
+  for(size_t ith=0; ith<n_threads; ++ith)
+    threads.push_back(thread(&Glomerator::LogProbWorker, this, thread_hmms_[ith], ref(qrefs), ref(scores), ref(no_paths), ref(inext), ref(errors[ith])));
+  for(auto &thr : threads)
+    thr.join();
+  for(auto &err : errors)
+    if(err)
+      rethrow_exception(err);
+
+  for(size_t iq=0; iq<queries.size(); ++iq)  // everything else (failed queries, <log_probs_>, <n_fwd_calculated_>, the cache server) happens in the main thread when GetLogProb() asks for it
+    precalculated_log_probs_[queries[iq]] = pair<double, bool>(scores[iq], no_paths[iq]);
+}
+
+// ----------------------------------------------------------------------------------------
+// run by each thread in CalculateLogProbs(): keep taking the next query and running forward on it until there aren't any left. Only touches its own <hmms> and its own entries in <scores> and <no_paths>.
+void Glomerator::LogProbWorker(HMMHolder *hmms, vector<Query*> &qrefs, vector<double> &scores, vector<char> &no_paths, atomic<size_t> &inext, exception_ptr &error) {
+  try {
+    DPHandler dph("forward", args_, gl_, *hmms);
+    for(size_t iq=inext++; iq<qrefs.size(); iq=inext++) {
+      Result result = dph.Run(qrefs[iq]->seqs_, qrefs[iq]->kbounds_, qrefs[iq]->only_genes_, qrefs[iq]->mute_freq_);  // Run() clears the dphandler's trellis cache each time, so reusing it is the same as making a new one for each query (as CalculateLogProb() does)
+      no_paths[iq] = result.no_path_;
+      if(!result.no_path_)
+	scores[iq] = result.total_score();
+    }
+  } catch(...) {  // exceptions can't propagate out of a thread, so pass it back to be rethrown in the main thread
+    error = current_exception();
+  }
 }
 
 // ----------------------------------------------------------------------------------------
@@ -799,7 +1071,7 @@ Query &Glomerator::cachefo(string queries) {
 
     tmp_cachefo_[queries] = Query(queries,
 				  GetSeqs(queries),
-				  !InString(args_->seed_unique_id(), queries),
+				  !HasSeed(queries),
 				  vector<string>(only_gene_set.begin(), only_gene_set.end()),
 				  kbounds,
 				  mute_freq_total / tmpvec.size(),
@@ -879,7 +1151,7 @@ void Glomerator::CopyToPermanentCache(string translated_query, string superquery
     // cout << "scratchy! " << superquery << " --> " << translated_query << endl;
     cachefo_[translated_query] = Query(translated_query,
 				       GetSeqs(translated_query),
-				       !InString(args_->seed_unique_id(), translated_query),
+				       !HasSeed(translated_query),
 				       supercache.only_genes_,
 				       supercache.kbounds_,
 				       supercache.mute_freq_,
@@ -913,7 +1185,7 @@ Query &Glomerator::GetMergedQuery(string name_a, string name_b) {
   // NOTE now that I'm adding the merged query to the cache info here, I can maybe get rid of the qmerged entirely UPDATE I have no idea if this is still relevant
   tmp_cachefo_[joint_name] = Query(joint_name,
 				   GetSeqs(joint_name),
-				   !InString(args_->seed_unique_id(), joint_name),
+				   !HasSeed(joint_name),
 				   joint_only_genes,
 				   ref_a.kbounds_.LogicalOr(ref_b.kbounds_),
 				   (ref_a.seqs_.size()*ref_a.mute_freq_ + ref_b.seqs_.size()*ref_b.mute_freq_) / double(ref_a.seqs_.size() + ref_b.seqs_.size()),  // simple weighted average (doesn't account for different sequence lengths)
@@ -981,49 +1253,124 @@ Partition Glomerator::GetSeededClusters(Partition &partition) {
   return clusters;
 }
 
+// ----------------------------------------------------------------------------------------
+// return <key_a> and <key_b> in the order in which the exhaustive double loop over the partition would have first visited them (so that ties are broken the same way)
+KeyPair Glomerator::OrderedKeyPair(string key_a, string key_b) {
+  if(!seed_uids_.empty() && SeedMissing(key_a) != SeedMissing(key_b))  // if only one of them is seeded, it's the one in the outer loop
+    return SeedMissing(key_a) ? KeyPair(key_b, key_a) : KeyPair(key_a, key_b);
+  return key_a < key_b ? KeyPair(key_a, key_b) : KeyPair(key_b, key_a);
+}
+
+// ----------------------------------------------------------------------------------------
+// Split <key>'s naive seq into n_max_distance + 1 segments, where n_max_distance is the largest hamming distance that could pass the hfrac hi bound.
+// By the pigeonhole principle, two seqs that are close enough to pass the bound must then have at least one identical segment.
+vector<size_t> &Glomerator::NaiveSeqSegments(string key) {
+  if(naive_seq_segments_.count(key))
+    return naive_seq_segments_[key];
+
+  vector<size_t> &segments = naive_seq_segments_[key];
+  string &naive_seq = GetNaiveSeq(key);
+  if(naive_seq.size() == 0 || failed_queries_.count(key))
+    return segments;
+  if(track_->ambiguous_char() != "" && naive_seq.find(track_->ambiguous_char()) != string::npos)  // ambiguous bases don't count toward the distance, so identical segments aren't guaranteed
+    return segments;
+
+  size_t len(naive_seq.size());
+  double max_distance = floor(args_->hamming_fraction_bound_hi() * len) + 1;  // add one so we're safe against rounding
+  size_t n_segments = size_t(max_distance) + 1;
+  if(n_segments > len)  // bound is too loose for the pigeonhole filter to be any use
+    return segments;
+
+  hash<string> hasher;
+  for(size_t iseg=0; iseg<n_segments; ++iseg) {
+    size_t istart(iseg * len / n_segments), istop((iseg + 1) * len / n_segments);
+    segments.push_back(hasher(naive_seq.substr(istart, istop - istart)));
+  }
+  return segments;
+}
+
+// ----------------------------------------------------------------------------------------
+// false if the pigeonhole bound guarantees that the pair's naive hfrac is larger than the hi bound (true if it might not be)
+bool Glomerator::PairCouldPassHfracBound(string key_a, string key_b) {
+  if(naive_hfracs_.count(JoinNames(key_a, key_b)))  // if we already have it, we may as well use it
+    return true;
+  vector<size_t> &segs_a = NaiveSeqSegments(key_a);
+  vector<size_t> &segs_b = NaiveSeqSegments(key_b);
+  if(segs_a.size() == 0 || segs_a.size() != segs_b.size() || GetNaiveSeq(key_a).size() != GetNaiveSeq(key_b).size())  // if either can't use the filter (or if they're different lengths, so CalculateHfrac() can complain about it)
+    return true;
+  for(size_t iseg=0; iseg<segs_a.size(); ++iseg) {
+    if(segs_a[iseg] == segs_b[iseg])
+      return true;
+  }
+  return false;
+}
+
+// ----------------------------------------------------------------------------------------
+// add <key> to the candidate pair index, along with any pairs it forms with clusters already in the index that pass the hfrac hi bound
+void Glomerator::AddToPairIndex(string key) {
+  size_t cdr3_length(cachefo(key).cdr3_length_);
+  set<string> &bucket = cdr3_buckets_[cdr3_length];
+  for(auto &key_other : bucket) {
+    if(!seed_uids_.empty() && SeedMissing(key) && SeedMissing(key_other))  // with a seed, we only ever merge pairs that include at least one seeded cluster
+      continue;
+    if(failed_queries_.count(key) || failed_queries_.count(key_other))
+      continue;
+    if(!PairCouldPassHfracBound(key, key_other))
+      continue;
+    KeyPair kpair = OrderedKeyPair(key, key_other);
+    double hfrac = NaiveHfrac(kpair.first, kpair.second);
+    if(hfrac > args_->hamming_fraction_bound_hi())  // if naive hamming fraction too big, don't even consider merging the pair
+      continue;
+    candidate_pairs_[kpair] = hfrac;
+    candidate_hfracs_.insert(pair<double, KeyPair>(hfrac, kpair));
+    cluster_candidate_pairs_[key].insert(kpair);
+    cluster_candidate_pairs_[key_other].insert(kpair);
+  }
+  bucket.insert(key);
+}
+
+// ----------------------------------------------------------------------------------------
+// remove <key>, and all the candidate pairs in which it appears, from the index
+void Glomerator::RemoveFromPairIndex(string key) {
+  for(auto &kpair : cluster_candidate_pairs_[key]) {
+    candidate_hfracs_.erase(pair<double, KeyPair>(candidate_pairs_[kpair], kpair));
+    candidate_pairs_.erase(kpair);
+    string key_other = kpair.first == key ? kpair.second : kpair.first;
+    cluster_candidate_pairs_[key_other].erase(kpair);
+  }
+  cluster_candidate_pairs_.erase(key);
+  naive_seq_segments_.erase(key);
+  packed_naive_seqs_.erase(key);
+  cdr3_buckets_[cachefo(key).cdr3_length_].erase(key);
+}
+
+// ----------------------------------------------------------------------------------------
+void Glomerator::InitializePairIndex(Partition &partition) {
+  for(auto &key : partition)
+    AddToPairIndex(key);
+  pair_index_initialized_ = true;
+  if(args_->debug())
+    printf("          initialized pair index with %zu candidate pairs among %zu clusters\n", candidate_pairs_.size(), partition.size());
+}
+
 // ----------------------------------------------------------------------------------------
 pair<double, Query> Glomerator::FindHfracMerge(ClusterPath *path) {
   double min_hamming_fraction(INFINITY);
   Query min_hamming_merge;
 
-  Partition outer_clusters(path->CurrentPartition());  // for plain partitioning, outer loop is over everything in the current partition
-  if(args_->seed_unique_id() != "")  // whereas if seed unique id is set, outer loop is only over those clusters that contain the seed
-    outer_clusters = GetSeededClusters(path->CurrentPartition());
-  for(Partition::iterator it_a = outer_clusters.begin(); it_a != outer_clusters.end(); ++it_a) {
-    Partition::iterator it_b(it_a);  // for plain partitioning, inner loop starts at the position of the outer iterator + 1
-    ++it_b;
-    if(args_->seed_unique_id() != "")  // but if the seed's set, inner loop is over the *entire* current partition (including the seeded clusters). So we also need to skip key_a == key_b below.
-      it_b = path->CurrentPartition().begin();
-
-    for( ; true; ++it_b) {
-      if(args_->seed_unique_id() == "") {
-	if(it_b == outer_clusters.end())  // NOTE you can't replace this with path->CurrentPartition().end() because in this case <it_b> is looping over the *copy* of path->CurrentPartition()
-	  break;
-      } else {
-	if(it_b == path->CurrentPartition().end())
-	  break;
-      }
+  if(!pair_index_initialized_)
+    InitializePairIndex(path->CurrentPartition());
 
-      string key_a(*it_a), key_b(*it_b);
-      if(key_a == key_b)  // otherwise we'd loop over the seeded ones twice
-	continue;
+  if(args_->hamming_fraction_bound_lo() > 0.0) {
+    for(auto &hpair : candidate_hfracs_) {  // sorted by hfrac (and then by the order of the old double loop), so the first one that isn't failed is the one we want
+      if(hpair.first >= args_->hamming_fraction_bound_lo())
+	break;
+      string key_a(hpair.second.first), key_b(hpair.second.second);
       if(failed_queries_.count(key_a) || failed_queries_.count(key_b))
 	continue;
-
-      if(cachefo(key_a).cdr3_length_ != cachefo(key_b).cdr3_length_)
-      	continue;
-
-      double hfrac = NaiveHfrac(key_a, key_b);
-      if(hfrac > args_->hamming_fraction_bound_hi())  // if naive hamming fraction too big, don't even consider merging the pair
-	continue;
-
-      if(args_->hamming_fraction_bound_lo() <= 0.0 || hfrac >= args_->hamming_fraction_bound_lo())
-	continue;
-
-      if(hfrac < min_hamming_fraction) {
-	  min_hamming_fraction = hfrac;
-	  min_hamming_merge = GetMergedQuery(key_a, key_b);
-      }
+      min_hamming_fraction = hpair.first;
+      min_hamming_merge = GetMergedQuery(key_a, key_b);
+      break;
     }
   }
 
@@ -1041,49 +1388,30 @@ pair<double, Query> Glomerator::FindLRatioMerge(ClusterPath *path) {
   double max_lratio(-INFINITY);
   Query chosen_qmerge;
 
-  Partition outer_clusters(path->CurrentPartition());
-  if(args_->seed_unique_id() != "")  // see comments in FindHfracMerge
-    outer_clusters = GetSeededClusters(path->CurrentPartition());
-  for(Partition::iterator it_a = outer_clusters.begin(); it_a != outer_clusters.end(); ++it_a) {
-    Partition::iterator it_b(it_a);
-    ++it_b;
-    if(args_->seed_unique_id() != "")
-      it_b = path->CurrentPartition().begin();
-
-    for( ; true; ++it_b) {
-      if(args_->seed_unique_id() == "") {
-	if(it_b == outer_clusters.end())  // NOTE you can't replace this with path->CurrentPartition().end() because in this case <it_b> is looping over the *copy* of path->CurrentPartition()
-	  break;
-      } else {
-	if(it_b == path->CurrentPartition().end())
-	  break;
-      }
-
-      string key_a(*it_a), key_b(*it_b);
-      if(key_a == key_b)  // otherwise we'd loop over the seeded ones twice
-	continue;
-      if(failed_queries_.count(key_a) || failed_queries_.count(key_b))
-	continue;
+  if(!pair_index_initialized_)
+    InitializePairIndex(path->CurrentPartition());
 
-      if(cachefo(key_a).cdr3_length_ != cachefo(key_b).cdr3_length_)
-      	continue;
+  if(args_->n_threads() > 1)
+    PrecalculateLRatioLogProbs();
 
-      double hfrac = NaiveHfrac(key_a, key_b);
-      if(hfrac > args_->hamming_fraction_bound_hi())  // if naive hamming fraction too big, don't even consider merging the pair
-	continue;
+  for(auto &cpair : candidate_pairs_) {  // only pairs with the same cdr3 length that pass the hfrac hi bound are in the index
+    string key_a(cpair.first.first), key_b(cpair.first.second);
+    if(failed_queries_.count(key_a) || failed_queries_.count(key_b))
+      continue;
 
-      double lratio = GetLogProbRatio(key_a, key_b);
+    double lratio = GetLogProbRatio(key_a, key_b);
 
-      // don't merge if lratio is small (less than zero, more or less)
-      if(!force_merge_ && LikelihoodRatioTooSmall(lratio, CountMembers(key_a) + CountMembers(key_b)))
-	continue;
+    // don't merge if lratio is small (less than zero, more or less)
+    if(!force_merge_ && LikelihoodRatioTooSmall(lratio, CountMembers(key_a) + CountMembers(key_b)))
+      continue;
 
-      if(lratio > max_lratio) {
-	max_lratio = lratio;
-	chosen_qmerge = GetMergedQuery(key_a, key_b);
-      }
+    if(lratio > max_lratio) {
+      max_lratio = lratio;
+      chosen_qmerge = GetMergedQuery(key_a, key_b);
     }
   }
+  prefetched_cachefo_.clear();  // anything left over is stuff that the serial loop didn't need (and the cache server may know more about them by the next time we need them)
+  precalculated_log_probs_.clear();
 
   if(max_lratio != -INFINITY) {  // if we found a merge that we liked (note that this is *minus* infinity, but in the hfrac fcn it's +INFINITY)
     ++n_lratio_merges_;
@@ -1182,6 +1510,9 @@ void Glomerator::Merge(ClusterPath *path) {
   new_partition.erase(chosen_qmerge.parents_.first);
   new_partition.erase(chosen_qmerge.parents_.second);
   new_partition.insert(chosen_qmerge.name_);
+  RemoveFromPairIndex(chosen_qmerge.parents_.first);
+  RemoveFromPairIndex(chosen_qmerge.parents_.second);
+  AddToPairIndex(chosen_qmerge.name_);
   path->AddPartition(new_partition, -INFINITY, args_->n_partitions_to_write());
   current_partition_ = &path->CurrentPartition();
 
@@ -0,0 +1,328 @@
+#include "hmmcachefile.h"
+#include "text.h"
+namespace ham {
+
+namespace {
+const char kMagic[] = "HMMC";
+const uint32_t kVersion(1);
+const size_t kHeaderSize(32), kBucketSize(16);
+const uint8_t kHasLogprob(1), kHasNaiveHfrac(2), kHasNaiveSeq(4), kPackedNaiveSeq(8), kHasErrors(16);
+const string kBases("ACGT");  // 2-bit codes are the indices in this
+
+// ----------------------------------------------------------------------------------------
+// same as zlib's crc32 (which is what the python side uses)
+uint32_t Crc32(const string &str) {
+  static uint32_t table[256];
+  static bool initialized(false);
+  if(!initialized) {
+    for(uint32_t ib=0; ib<256; ++ib) {
+      uint32_t crc(ib);
+      for(int ibit=0; ibit<8; ++ibit)
+	crc = (crc & 1) ? (0xEDB88320 ^ (crc >> 1)) : (crc >> 1);
+      table[ib] = crc;
+    }
+    initialized = true;
+  }
+  uint32_t crc(0xFFFFFFFF);
+  for(auto ch : str)
+    crc = table[(crc ^ (uint8_t)ch) & 0xFF] ^ (crc >> 8);
+  return crc ^ 0xFFFFFFFF;
+}
+
+// ----------------------------------------------------------------------------------------
+// NOTE these (and the writers below) assume a little-endian machine
+uint32_t ReadU32(const char *ptr) { uint32_t val; memcpy(&val, ptr, sizeof(val)); return val; }
+uint64_t ReadU64(const char *ptr) { uint64_t val; memcpy(&val, ptr, sizeof(val)); return val; }
+float ReadF32(const char *ptr) { float val; memcpy(&val, ptr, sizeof(val)); return val; }
+void WriteU32(string &buf, uint32_t val) { buf.append((const char*)&val, sizeof(val)); }
+void WriteU64(string &buf, uint64_t val) { buf.append((const char*)&val, sizeof(val)); }
+void WriteF32(string &buf, float val) { buf.append((const char*)&val, sizeof(val)); }
+size_t Pad8(size_t size) { return (size + 7) & ~(size_t)7; }
+
+// ----------------------------------------------------------------------------------------
+string PackSeq(const string &seq) {  // four bases per byte, with the first base in the lowest two bits
+  string packed((seq.size() + 3) / 4, '\0');
+  for(size_t ib=0; ib<seq.size(); ++ib)
+    packed[ib / 4] |= (char)(kBases.find(seq[ib]) << (2 * (ib % 4)));
+  return packed;
+}
+
+// ----------------------------------------------------------------------------------------
+string UnpackSeq(const char *packed, size_t length) {
+  string seq(length, ' ');
+  for(size_t ib=0; ib<length; ++ib)
+    seq[ib] = kBases[((uint8_t)packed[ib / 4] >> (2 * (ib % 4))) & 3];
+  return seq;
+}
+}
+
+// ----------------------------------------------------------------------------------------
+CacheEntry::CacheEntry(string logprob_str, string naive_seq, string naive_hfrac_str, string errors) :
+  has_logprob_(logprob_str.size() > 0),
+  logprob_(has_logprob_ ? stof(logprob_str) : 0.),
+  has_naive_hfrac_(naive_hfrac_str.size() > 0),
+  naive_hfrac_(has_naive_hfrac_ ? stof(naive_hfrac_str) : 0.),
+  naive_seq_(naive_seq),
+  errors_(errors)
+{
+}
+
+// ----------------------------------------------------------------------------------------
+void CacheEntry::Update(CacheEntry &other) {
+  if(other.has_logprob_) {
+    has_logprob_ = true;
+    logprob_ = other.logprob_;
+  }
+  if(other.has_naive_hfrac_) {
+    has_naive_hfrac_ = true;
+    naive_hfrac_ = other.naive_hfrac_;
+  }
+  if(other.naive_seq_.size() > 0)
+    naive_seq_ = other.naive_seq_;
+  if(other.errors_.size() > 0)
+    errors_ = other.errors_;
+}
+
+// ----------------------------------------------------------------------------------------
+HmmCacheFile::HmmCacheFile(string fname) :
+  fname_(fname),
+  fd_(-1),
+  size_(0),
+  data_(nullptr)
+{
+  fd_ = open(fname_.c_str(), O_RDONLY);
+  if(fd_ < 0)
+    throw runtime_error("couldn't open hmm cache file " + fname_);
+  struct stat st;
+  if(fstat(fd_, &st) < 0)
+    throw runtime_error("couldn't stat hmm cache file " + fname_);
+  size_ = st.st_size;
+  if(size_ == 0)
+    return;
+  void *mapped = mmap(nullptr, size_, PROT_READ, MAP_SHARED, fd_, 0);
+  if(mapped == MAP_FAILED)
+    throw runtime_error("couldn't mmap hmm cache file " + fname_);
+  data_ = (const char*)mapped;
+
+  size_t pos(0);
+  while(pos < size_) {
+    if(size_ - pos < kHeaderSize || memcmp(data_ + pos, kMagic, 4) != 0)
+      throw runtime_error("bad segment header at byte " + to_string(pos) + " in hmm cache file " + fname_);
+    if(ReadU32(data_ + pos + 4) != kVersion)
+      throw runtime_error("unexpected version " + to_string(ReadU32(data_ + pos + 4)) + " in hmm cache file " + fname_);
+    Segment seg;
+    seg.start_ = data_ + pos;
+    seg.n_uids_ = ReadU32(seg.start_ + 8);
+    seg.n_records_ = ReadU32(seg.start_ + 12);
+    seg.n_buckets_ = ReadU32(seg.start_ + 16);
+    uint32_t uid_blob_size(ReadU32(seg.start_ + 20));
+    uint64_t segment_size(ReadU64(seg.start_ + 24));
+    if(segment_size > size_ - pos)
+      throw runtime_error("truncated segment at byte " + to_string(pos) + " in hmm cache file " + fname_);
+    seg.uid_offsets_ = seg.start_ + kHeaderSize;
+    seg.uid_blob_ = seg.uid_offsets_ + 4 * (seg.n_uids_ + 1);
+    seg.index_ = seg.start_ + Pad8(kHeaderSize + 4 * (seg.n_uids_ + 1) + uid_blob_size);
+    segments_.push_back(seg);
+    pos += segment_size;
+  }
+}
+
+// ----------------------------------------------------------------------------------------
+HmmCacheFile::~HmmCacheFile() {
+  if(data_ != nullptr)
+    munmap((void*)data_, size_);
+  if(fd_ >= 0)
+    close(fd_);
+}
+
+// ----------------------------------------------------------------------------------------
+size_t HmmCacheFile::n_records() {
+  size_t total(0);
+  for(auto &seg : segments_)
+    total += seg.n_records_;
+  return total;
+}
+
+// ----------------------------------------------------------------------------------------
+bool HmmCacheFile::Get(string key, CacheEntry &entry) {
+  uint32_t hash(Crc32(key));
+  bool found(false);
+  for(auto &seg : segments_) {  // oldest first, so later values take precedence
+    if(FindRecord(seg, key, hash, entry))
+      found = true;
+  }
+  return found;
+}
+
+// ----------------------------------------------------------------------------------------
+string HmmCacheFile::GetUid(Segment &seg, uint32_t iuid) {
+  uint32_t start(ReadU32(seg.uid_offsets_ + 4 * iuid)), end(ReadU32(seg.uid_offsets_ + 4 * (iuid + 1)));
+  return string(seg.uid_blob_ + start, end - start);
+}
+
+// ----------------------------------------------------------------------------------------
+bool HmmCacheFile::FindRecord(Segment &seg, string &key, uint32_t hash, CacheEntry &entry) {
+  if(seg.n_buckets_ == 0)
+    return false;
+  uint32_t mask(seg.n_buckets_ - 1);
+  for(uint32_t ib=(hash & mask), n_probed=0; n_probed<seg.n_buckets_; ib=((ib + 1) & mask), ++n_probed) {
+    const char *bucket(seg.index_ + kBucketSize * ib);
+    uint64_t record_offset(ReadU64(bucket + 8));
+    if(record_offset == 0)  // empty bucket, so it isn't here
+      return false;
+    if(ReadU32(bucket) != hash || ReadU32(bucket + 4) != key.size())
+      continue;
+
+    const char *ptr(seg.start_ + record_offset);
+    uint32_t n_key_uids(ReadU32(ptr));
+    ptr += 4;
+    string record_key;
+    for(uint32_t iu=0; iu<n_key_uids; ++iu) {
+      if(iu > 0)
+	record_key += ":";
+      record_key += GetUid(seg, ReadU32(ptr + 4 * iu));
+    }
+    if(record_key != key)  // hash collision
+      continue;
+    ptr += 4 * n_key_uids;
+
+    CacheEntry record;
+    uint8_t flags((uint8_t)*ptr);
+    ptr += 1;
+    if(flags & kHasLogprob) {
+      record.has_logprob_ = true;
+      record.logprob_ = ReadF32(ptr);
+      ptr += 4;
+    }
+    if(flags & kHasNaiveHfrac) {
+      record.has_naive_hfrac_ = true;
+      record.naive_hfrac_ = ReadF32(ptr);
+      ptr += 4;
+    }
+    if(flags & kHasNaiveSeq) {
+      uint32_t length(ReadU32(ptr));
+      ptr += 4;
+      if(flags & kPackedNaiveSeq) {
+	record.naive_seq_ = UnpackSeq(ptr, length);
+	ptr += (length + 3) / 4;
+      } else {
+	record.naive_seq_ = string(ptr, length);
+	ptr += length;
+      }
+    }
+    if(flags & kHasErrors) {
+      uint32_t length(ReadU32(ptr));
+      record.errors_ = string(ptr + 4, length);
+    }
+    entry.Update(record);
+    return true;
+  }
+  return false;
+}
+
+// ----------------------------------------------------------------------------------------
+bool HmmCacheFile::IsBinary(string fname) {
+  string suffix(".hcache");  // has to match <suffix> in python/hmmcachefile.py
+  return fname.size() >= suffix.size() && fname.compare(fname.size() - suffix.size(), suffix.size(), suffix) == 0;
+}
+
+// ----------------------------------------------------------------------------------------
+void HmmCacheFile::Append(string fname, vector<pair<string, CacheEntry> > &input_entries) {
+  // first merge any repeated keys, since each key can only be in a segment once
+  vector<pair<string, CacheEntry> > entries;
+  map<string, size_t> ientries;
+  for(auto &kv : input_entries) {
+    if(ientries.count(kv.first)) {
+      entries[ientries[kv.first]].second.Update(kv.second);
+    } else {
+      ientries[kv.first] = entries.size();
+      entries.push_back(kv);
+    }
+  }
+  if(entries.size() == 0)
+    return;
+
+  // serialize the records (with offsets relative to the start of the records), interning the uids as we go
+  map<string, uint32_t> iuids;
+  vector<string> uids;
+  string records;
+  vector<uint64_t> record_offsets;
+  for(auto &kv : entries) {
+    CacheEntry &entry(kv.second);
+    record_offsets.push_back(records.size());
+    vector<string> key_uids(SplitString(kv.first, ":"));
+    WriteU32(records, key_uids.size());
+    for(auto &uid : key_uids) {
+      if(iuids.count(uid) == 0) {
+	iuids[uid] = uids.size();
+	uids.push_back(uid);
+      }
+      WriteU32(records, iuids[uid]);
+    }
+    bool pack_seq(entry.naive_seq_.size() > 0 && entry.naive_seq_.find_first_not_of(kBases) == string::npos);
+    uint8_t flags(0);
+    if(entry.has_logprob_) flags |= kHasLogprob;
+    if(entry.has_naive_hfrac_) flags |= kHasNaiveHfrac;
+    if(entry.naive_seq_.size() > 0) flags |= kHasNaiveSeq;
+    if(pack_seq) flags |= kPackedNaiveSeq;
+    if(entry.errors_.size() > 0) flags |= kHasErrors;
+    records.push_back((char)flags);
+    if(entry.has_logprob_)
+      WriteF32(records, entry.logprob_);
+    if(entry.has_naive_hfrac_)
+      WriteF32(records, entry.naive_hfrac_);
+    if(entry.naive_seq_.size() > 0) {
+      WriteU32(records, entry.naive_seq_.size());
+      records += pack_seq ? PackSeq(entry.naive_seq_) : entry.naive_seq_;
+    }
+    if(entry.errors_.size() > 0) {
+      WriteU32(records, entry.errors_.size());
+      records += entry.errors_;
+    }
+  }
+
+  // then the uid table
+  string uid_table, uid_blob;
+  for(auto &uid : uids) {
+    WriteU32(uid_table, uid_blob.size());
+    uid_blob += uid;
+  }
+  WriteU32(uid_table, uid_blob.size());
+  uid_table += uid_blob;
+  uid_table.append(Pad8(kHeaderSize + uid_table.size()) - kHeaderSize - uid_table.size(), '\0');
+
+  // and the index
+  uint32_t n_buckets(1);
+  while(n_buckets < 2 * entries.size())
+    n_buckets *= 2;
+  string index(kBucketSize * n_buckets, '\0');
+  uint64_t records_start(kHeaderSize + uid_table.size() + index.size());
+  for(size_t ie=0; ie<entries.size(); ++ie) {
+    uint32_t hash(Crc32(entries[ie].first)), ib(hash & (n_buckets - 1));
+    while(ReadU64(&index[kBucketSize * ib + 8]) != 0)
+      ib = (ib + 1) & (n_buckets - 1);
+    string bucket;
+    WriteU32(bucket, hash);
+    WriteU32(bucket, entries[ie].first.size());
+    WriteU64(bucket, records_start + record_offsets[ie]);
+    index.replace(kBucketSize * ib, kBucketSize, bucket);
+  }
+
+  string header(kMagic, 4);
+  WriteU32(header, kVersion);
+  WriteU32(header, uids.size());
+  WriteU32(header, entries.size());
+  WriteU32(header, n_buckets);
+  WriteU32(header, uid_blob.size());
+  WriteU64(header, records_start + records.size());
+
+  ofstream ofs(fname, ios::binary | ios::app);
+  if(!ofs.is_open())
+    throw runtime_error("couldn't open hmm cache file " + fname + " for appending\n");
+  ofs << header << uid_table << index << records;
+  ofs.close();
+  if(ofs.fail())
+    throw runtime_error("error writing hmm cache file " + fname + "\n");
+}
+
+}
@@ -423,83 +423,95 @@ static void *worker(void *data) {
   return 0;
 }
 
-void ig_align_reads(const char *ref_path, const uint8_t n_extra_refs,
-                    const char **extra_ref_paths, const char *qry_path,
-                    const char *output_path, const int32_t match, /* 2 */
-                    const int32_t mismatch,                       /* 2 */
-                    const int32_t gap_o,                          /* 3 */
-                    const int32_t gap_e,                          /* 1 */
-                    const unsigned max_drop,                      /* 1000 */
-                    const int min_score,                          /* 0 */
-                    const unsigned bandwidth,                     /* 150 */
-                    const uint8_t n_threads,                      /* 1 */
-                    const char *read_group, const char *read_group_id) {
-  gzFile read_fp, ref_fp;
-  FILE *out_fp;
-  int32_t j, k, l;
-  const int m = 5;
-  kseq_t *seq;
-  int8_t *mat = (int8_t *)calloc(25, sizeof(int8_t));
+/* This table is used to transform nucleotide letters into numbers. */
+static uint8_t nt_table[128] = {
+    4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4,
+    4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4,
+    4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 0,
+    4, 1, 4, 4, 4, 2, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 3, 0, 4, 4,
+    4, 4, 4, 4, 4, 4, 4, 4, 4, 0, 4, 1, 4, 4, 4, 2, 4, 4, 4, 4, 4, 4,
+    4, 4, 4, 4, 4, 4, 3, 0, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4};
 
-  /* This table is used to transform nucleotide letters into numbers. */
-  uint8_t table[128] = {4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4,
-                        4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4,
-                        4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4,
-                        4, 4, 4, 4, 4, 4, 4, 4, 0, 4, 1, 4, 4, 4, 2, 4, 4, 4, 4,
-                        4, 4, 4, 4, 4, 4, 4, 4, 3, 0, 4, 4, 4, 4, 4, 4, 4, 4, 4,
-                        4, 4, 0, 4, 1, 4, 4, 4, 2, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4,
-                        4, 4, 3, 0, 4, 4, 4, 4, 4, 4, 4, 4, 4, 4};
+typedef struct {
+  kseq_v ref_seqs;
+  uint8_t n_extra_refs;
+  kseq_v *extra_ref_seqs;
+} refs_t;
 
-  // initialize scoring matrix for genome sequences
-  for (l = k = 0; LIKELY(l < 4); ++l) {
-    for (j = 0; LIKELY(j < 4); ++j)
-      mat[k++] =
-          l == j ? match : -mismatch; /* weight_match : -weight_mismatch */
-    mat[k++] = 0;                     // ambiguous base
-  }
-  for (j = 0; LIKELY(j < 5); ++j)
-    mat[k++] = 0;
+static void read_refs(refs_t *refs, const char *ref_path,
+                      const uint8_t n_extra_refs,
+                      const char **extra_ref_paths) {
+  gzFile ref_fp;
+  kseq_t *seq;
 
-  // Read reference sequences
   ref_fp = gzopen(ref_path, "r");
   if(ref_fp == NULL) {
     fprintf(stderr, "Failed to open reference %s\n", ref_path);
     assert(0);
   }
   seq = kseq_init(ref_fp);
-  kseq_v ref_seqs;
-  ref_seqs = read_seqs(seq, 0);
+  refs->ref_seqs = read_seqs(seq, 0);
   kseq_destroy(seq);
   gzclose(ref_fp);
 
-  fprintf(stderr, "[ig_align] Read %lu references\n", kv_size(ref_seqs));
+  fprintf(stderr, "[ig_align] Read %lu references\n", kv_size(refs->ref_seqs));
 
-  kseq_v *extra_ref_seqs = malloc(sizeof(kseq_v) * n_extra_refs);
+  refs->n_extra_refs = n_extra_refs;
+  refs->extra_ref_seqs = malloc(sizeof(kseq_v) * n_extra_refs);
 
   for (size_t i = 0; i < n_extra_refs; i++) {
     ref_fp = gzopen(extra_ref_paths[i], "r");
     assert(ref_fp != NULL && "Failed to open reference");
     seq = kseq_init(ref_fp);
-    extra_ref_seqs[i] = read_seqs(seq, 0);
+    refs->extra_ref_seqs[i] = read_seqs(seq, 0);
     kseq_destroy(seq);
     gzclose(ref_fp);
     fprintf(stderr, "[ig_align] Read %lu extra references from %s\n",
-            kv_size(extra_ref_seqs[i]), extra_ref_paths[i]);
+            kv_size(refs->extra_ref_seqs[i]), extra_ref_paths[i]);
   }
+}
 
-  // Print SAM header
-  out_fp = fopen(output_path, "w");
+static void destroy_refs(refs_t *refs) {
+  // Clean up reference sequences
+  kvi_destroy(kseq_stack_destroy, refs->ref_seqs);
+
+  // And extra reference sequences
+  for (size_t i = 0; i < refs->n_extra_refs; i++) {
+    kvi_destroy(kseq_stack_destroy, refs->extra_ref_seqs[i]);
+  }
+  free(refs->extra_ref_seqs);
+}
+
+// initialize scoring matrix for genome sequences
+static void init_score_matrix(int8_t *mat, const int32_t match,
+                              const int32_t mismatch) {
+  int32_t j, k, l;
+  for (l = k = 0; LIKELY(l < 4); ++l) {
+    for (j = 0; LIKELY(j < 4); ++j)
+      mat[k++] =
+          l == j ? match : -mismatch; /* weight_match : -weight_mismatch */
+    mat[k++] = 0;                     // ambiguous base
+  }
+  for (j = 0; LIKELY(j < 5); ++j)
+    mat[k++] = 0;
+}
+
+static void write_sam_header(FILE *out_fp, const refs_t *refs,
+                             const int32_t match, const int32_t mismatch,
+                             const int32_t gap_o, const int32_t gap_e,
+                             const char *read_group) {
+  const kseq_t *seq;
   fprintf(out_fp, "@HD\tVN:1.4\tSO:unsorted\n");
   fprintf(out_fp, "@PG\tID:ig_align\tPN:ig_align\tCL:match=%d,mismatch=%d,go=%"
                   "d,ge=%d\tVN:%s\n",
           match, mismatch, gap_o, gap_e, xstr(VDJALIGN_VERSION));
-  for (size_t i = 0; i < kv_size(ref_seqs); i++) {
-    seq = &kv_A(ref_seqs, i);
+  for (size_t i = 0; i < kv_size(refs->ref_seqs); i++) {
+    seq = &kv_A(refs->ref_seqs, i);
     fprintf(out_fp, "@SQ\tSN:%s\tLN:%d\n", seq->name.s, (int32_t)seq->seq.l);
   }
-  for (size_t i = 0; i < n_extra_refs; i++) {
-    for (size_t j = 0; j < kv_size(extra_ref_seqs[i]); j++) {
-      seq = &kv_A(extra_ref_seqs[i], j);
+  for (size_t i = 0; i < refs->n_extra_refs; i++) {
+    for (size_t j = 0; j < kv_size(refs->extra_ref_seqs[i]); j++) {
+      seq = &kv_A(refs->extra_ref_seqs[i], j);
       fprintf(out_fp, "@SQ\tSN:%s\tLN:%d\n", seq->name.s, (int32_t)seq->seq.l);
     }
   }
@@ -507,6 +519,76 @@ void ig_align_reads(const char *ref_path, const uint8_t n_extra_refs,
     fputs(read_group, out_fp);
     fputc('\n', out_fp);
   }
+}
+
+/* Align <reads> and write the sam records to <out_fp>. Frees the contents of
+ * each read (but not <reads> itself). */
+static void align_and_write(FILE *out_fp, kseq_v reads, const refs_t *refs,
+                            align_config_t *conf, const uint8_t n_threads,
+                            const char *read_group_id) {
+  const size_t n_reads = kv_size(reads);
+  worker_t *w = calloc(n_threads, sizeof(worker_t));
+  kstring_t *sams = calloc(n_reads, sizeof(kstring_t));
+  for (size_t i = 0; i < n_threads; i++) {
+    w[i].start = i;
+    w[i].n = n_reads;
+    w[i].step = n_threads;
+    w[i].ref_seqs = refs->ref_seqs;
+    w[i].n_extra_refs = refs->n_extra_refs;
+    w[i].extra_ref_seqs = refs->extra_ref_seqs;
+    w[i].reads = reads;
+    w[i].sams = sams;
+    w[i].config = conf;
+    w[i].read_group_id = read_group_id;
+  }
+
+  if (n_threads == 1) {
+    worker(w);
+  } else {
+    pthread_t *tid = calloc(n_threads, sizeof(pthread_t));
+    for (size_t i = 0; i < n_threads; ++i)
+      pthread_create(&tid[i], 0, worker, &w[i]);
+    for (size_t i = 0; i < n_threads; ++i)
+      pthread_join(tid[i], 0);
+    free(tid);
+  }
+  free(w);
+
+  for (size_t i = 0; i < n_reads; i++) {
+    if (sams[i].s) {
+      fputs(sams[i].s, out_fp);
+      free(sams[i].s);
+    }
+  }
+  free(sams);
+}
+
+void ig_align_reads(const char *ref_path, const uint8_t n_extra_refs,
+                    const char **extra_ref_paths, const char *qry_path,
+                    const char *output_path, const int32_t match, /* 2 */
+                    const int32_t mismatch,                       /* 2 */
+                    const int32_t gap_o,                          /* 3 */
+                    const int32_t gap_e,                          /* 1 */
+                    const unsigned max_drop,                      /* 1000 */
+                    const int min_score,                          /* 0 */
+                    const unsigned bandwidth,                     /* 150 */
+                    const uint8_t n_threads,                      /* 1 */
+                    const char *read_group, const char *read_group_id) {
+  gzFile read_fp;
+  FILE *out_fp;
+  const int m = 5;
+  kseq_t *seq;
+  int8_t *mat = (int8_t *)calloc(25, sizeof(int8_t));
+
+  init_score_matrix(mat, match, mismatch);
+
+  // Read reference sequences
+  refs_t refs;
+  read_refs(&refs, ref_path, n_extra_refs, extra_ref_paths);
+
+  // Print SAM header
+  out_fp = fopen(output_path, "w");
+  write_sam_header(out_fp, &refs, match, mismatch, gap_o, gap_e, read_group);
 
   align_config_t conf;
   conf.gap_o = gap_o;
@@ -514,7 +596,7 @@ void ig_align_reads(const char *ref_path, const uint8_t n_extra_refs,
   conf.max_drop = max_drop;
   conf.min_score = min_score;
   conf.m = m;
-  conf.table = table;
+  conf.table = nt_table;
   conf.mat = mat;
   conf.bandwidth = bandwidth;
 
@@ -529,55 +611,129 @@ void ig_align_reads(const char *ref_path, const uint8_t n_extra_refs,
       break;
     }
 
-    worker_t *w = calloc(n_threads, sizeof(worker_t));
-    kstring_t *sams = calloc(n_reads, sizeof(kstring_t));
-    for (size_t i = 0; i < n_threads; i++) {
-      w[i].start = i;
-      w[i].n = n_reads;
-      w[i].step = n_threads;
-      w[i].ref_seqs = ref_seqs;
-      w[i].n_extra_refs = n_extra_refs;
-      w[i].extra_ref_seqs = extra_ref_seqs;
-      w[i].reads = reads;
-      w[i].sams = sams;
-      w[i].config = &conf;
-      w[i].read_group_id = read_group_id;
+    align_and_write(out_fp, reads, &refs, &conf, n_threads, read_group_id);
+    count += n_reads;
+    kv_destroy(reads);
+  }
+  kseq_destroy(seq);
+  fprintf(stderr, "[ig_align] Aligned %lu reads\n", count);
+
+  destroy_refs(&refs);
+
+  gzclose(read_fp);
+  fclose(out_fp);
+  free(mat);
+}
+
+/* Read one line from <fp> into <str> (without the trailing newline). Returns
+ * false on EOF. */
+static bool read_line(FILE *fp, kstring_t *str) {
+  str->l = 0;
+  int c;
+  while ((c = getc(fp)) != EOF && c != '\n')
+    kputc(c, str);
+  if (c == EOF && str->l == 0)
+    return false;
+  if (str->s == NULL)
+    kputs("", str);
+  return true;
+}
+
+/* Read <n_reads> two-line fasta entries from <fp>. The name is everything in
+ * the header up to the first whitespace (as in kseq), and the rest is the
+ * comment. */
+static bool read_batch_seqs(FILE *fp, const size_t n_reads, kseq_v *reads) {
+  kstring_t line = {0, 0, NULL};
+  for (size_t i = 0; i < n_reads; i++) {
+    kseq_t s;
+    memset(&s, 0, sizeof(kseq_t));
+    if (!read_line(fp, &line) || line.l == 0 || line.s[0] != '>') {
+      free(line.s);
+      return false;
+    }
+    size_t iname_end = 1;
+    while (iname_end < line.l && line.s[iname_end] != ' ' &&
+           line.s[iname_end] != '\t')
+      iname_end++;
+    kputsn(line.s + 1, iname_end - 1, &s.name);
+    if (iname_end + 1 < line.l)
+      kputsn(line.s + iname_end + 1, line.l - iname_end - 1, &s.comment);
+    if (!read_line(fp, &line)) {
+      kseq_stack_destroy(&s);
+      free(line.s);
+      return false;
+    }
+    kputsn(line.s, line.l, &s.seq);
+    kv_push(kseq_t, *reads, s);
+  }
+  free(line.s);
+  return true;
+}
+
+void ig_align_serve(const char *ref_path, const uint8_t n_extra_refs,
+                    const char **extra_ref_paths, FILE *in_fp, FILE *out_fp,
+                    const int32_t gap_e, const unsigned max_drop,
+                    const int min_score, const unsigned bandwidth,
+                    const uint8_t n_threads) {
+  const int m = 5;
+  int8_t *mat = (int8_t *)calloc(25, sizeof(int8_t));
+
+  // Read reference sequences (just once, for all the batches)
+  refs_t refs;
+  read_refs(&refs, ref_path, n_extra_refs, extra_ref_paths);
+
+  align_config_t conf;
+  conf.gap_e = gap_e;
+  conf.max_drop = max_drop;
+  conf.min_score = min_score;
+  conf.m = m;
+  conf.table = nt_table;
+  conf.mat = mat;
+  conf.bandwidth = bandwidth;
+
+  size_t count = 0;
+  kstring_t line = {0, 0, NULL};
+  while (read_line(in_fp, &line)) {
+    if (line.l == 0)
+      continue;
+    int32_t match, mismatch, gap_o;
+    size_t n_reads;
+    if (sscanf(line.s, "batch %d %d %d %zu", &match, &mismatch, &gap_o,
+               &n_reads) != 4) {
+      fprintf(stderr, "[ig_align] Invalid batch header: %s\n", line.s);
+      exit(1);
     }
 
-    if (n_threads == 1) {
-      worker(w);
-    } else {
-      pthread_t *tid = calloc(n_threads, sizeof(pthread_t));
-      for (size_t i = 0; i < n_threads; ++i)
-        pthread_create(&tid[i], 0, worker, &w[i]);
-      for (size_t i = 0; i < n_threads; ++i)
-        pthread_join(tid[i], 0);
+    kseq_v reads;
+    kv_init(reads);
+    if (!read_batch_seqs(in_fp, n_reads, &reads)) {
+      fprintf(stderr, "[ig_align] Failed to read %zu queries for batch\n",
+              n_reads);
+      exit(1);
     }
-    free(w);
 
-    for (size_t i = 0; i < n_reads; i++) {
-      if (sams[i].s) {
-        fputs(sams[i].s, out_fp);
-        free(sams[i].s);
-      }
+    init_score_matrix(mat, match, mismatch);
+    conf.gap_o = gap_o;
+    write_sam_header(out_fp, &refs, match, mismatch, gap_o, gap_e, NULL);
+    // align in chunks, flushing after each one, so the caller can start
+    // processing the output before we finish the whole batch
+    const size_t chunk_size = 1000 * n_threads;
+    for (size_t istart = 0; istart < n_reads; istart += chunk_size) {
+      kseq_v chunk;
+      chunk.a = &kv_A(reads, istart);
+      chunk.n = chunk.m =
+          istart + chunk_size < n_reads ? chunk_size : n_reads - istart;
+      align_and_write(out_fp, chunk, &refs, &conf, n_threads, NULL);
+      fflush(out_fp);
     }
-    free(sams);
+    fputs(IG_ALIGN_BATCH_END, out_fp);
+    fflush(out_fp);
     count += n_reads;
     kv_destroy(reads);
   }
-  kseq_destroy(seq);
+  free(line.s);
   fprintf(stderr, "[ig_align] Aligned %lu reads\n", count);
 
-  // Clean up reference sequences
-  kvi_destroy(kseq_stack_destroy, ref_seqs);
-
-  // And extra reference sequences
-  for (size_t i = 0; i < n_extra_refs; i++) {
-    kvi_destroy(kseq_stack_destroy, extra_ref_seqs[i]);
-  }
-  free(extra_ref_seqs);
-
-  gzclose(read_fp);
-  fclose(out_fp);
+  destroy_refs(&refs);
   free(mat);
 }
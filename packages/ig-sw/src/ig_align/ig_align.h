@@ -2,6 +2,10 @@
 #define IG_ALIGN_H
 
 #include <stdint.h>
+#include <stdio.h>
+
+/* Written to the output after each batch in server mode. */
+#define IG_ALIGN_BATCH_END "#batch-end\n"
 
 /**
  * If n_extra_refs is > 0,
@@ -23,4 +27,22 @@ void ig_align_reads(const char *ref_path,
                     const char *read_group,
                     const char *read_group_id);
 
+/**
+ * Server mode: read the references once, then read batches of queries from
+ * <in_fp> until EOF, writing a complete sam file for each batch to <out_fp>
+ * followed by IG_ALIGN_BATCH_END. Each batch is a header line
+ * "batch <match> <mismatch> <gap_o> <n_queries>" followed by <n_queries>
+ * two-line fasta entries.
+ */
+void ig_align_serve(const char *ref_path,
+                    const uint8_t n_extra_refs,
+                    const char **extra_ref_paths,
+                    FILE *in_fp,
+                    FILE *out_fp,
+                    const int32_t gap_e,
+                    const unsigned max_drop,
+                    const int min_score,
+                    const unsigned bandwidth,
+                    const uint8_t n_threads);
+
 #endif
@@ -46,14 +46,21 @@ int main(int argc, const char *argv[]) {
     TCLAP::CmdLine cmd("Aligns reads from fasta files", ' ', "1");
 
     // tclap command line arguments
-    TCLAP::UnlabeledValueArg<std::string> qry_path_opt(
-        "query-path", "The path to the query file", true, "", "string");
-    cmd.add(qry_path_opt);
-
-    TCLAP::UnlabeledValueArg<std::string> output_path_opt(
-        "output-path", "The path to the output file", true, "output.sam",
+    // NOTE tclap doesn't allow more than one optional unlabeled arg, so the
+    // query and output paths share one (they're not used with --server)
+    TCLAP::UnlabeledMultiArg<std::string> io_paths_opt(
+        "query-and-output-paths",
+        "The path to the query file, then the path to the output file", false,
         "string");
-    cmd.add(output_path_opt);
+    cmd.add(io_paths_opt);
+
+    TCLAP::SwitchArg server_opt(
+        "", "server",
+        "Read the germline genes once, then align batches of queries from "
+        "stdin, writing sam output to stdout (instead of query and output "
+        "files)",
+        false);
+    cmd.add(server_opt);
 
     TCLAP::ValueArg<int> match_opt("m", "match", "Match score: default 2",
                                    false, 2, "int");
@@ -112,12 +119,21 @@ int main(int argc, const char *argv[]) {
 
     cmd.parse(argc, argv);
 
+    // server
+    bool server = server_opt.getValue();
+    std::vector<std::string> io_paths = io_paths_opt.getValue();
+    if (!server && io_paths.size() != 2) {
+      std::cerr << "error: need a query path and an output path (unless "
+                   "--server is set)"
+                << std::endl;
+      return 1;
+    }
     // qry_path
-    std::string str_qry_path = qry_path_opt.getValue();
+    std::string str_qry_path = server ? "" : io_paths[0];
     // char *qry_path = ToCharArray(str_qry_path);
     char *qry_path = &str_qry_path[0];
     // output_path
-    std::string str_out_path = output_path_opt.getValue();
+    std::string str_out_path = server ? "" : io_paths[1];
     char *output_path = &str_out_path[0];
     // match
     int match = match_opt.getValue();
@@ -154,9 +170,14 @@ int main(int argc, const char *argv[]) {
     }
     const char **extra_ref_paths = (const char **)extra_paths;
 
-    ig_align_reads(ref_path, n_extra_refs, extra_ref_paths, qry_path,
-                   output_path, match, mismatch, gap_o, gap_e, max_drop,
-                   min_score, bandwidth, n_threads, NULL, NULL);
+    if (server) {
+      ig_align_serve(ref_path, n_extra_refs, extra_ref_paths, stdin, stdout,
+                     gap_e, max_drop, min_score, bandwidth, n_threads);
+    } else {
+      ig_align_reads(ref_path, n_extra_refs, extra_ref_paths, qry_path,
+                     output_path, match, mismatch, gap_o, gap_e, max_drop,
+                     min_score, bandwidth, n_threads, NULL, NULL);
+    }
 
   } catch (TCLAP::ArgException &e) // catch any exception
   {
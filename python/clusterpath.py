@@ -124,6 +124,8 @@ class ClusterPath(object):
             self.readlines(lines, process_csv=True)
         elif utils.getsuffix(fname) == '.yaml':
             utils.read_yaml_output(fname, cpath=self)
+        elif utils.getsuffix(fname) == '.npz':
+            utils.read_npz_output(fname, cpath=self, skip_annotations=True)
         else:
             raise Exception('unhandled annotation file suffix %s' % outfname)
 
@@ -1,4 +1,6 @@
 import itertools
+import heapq
+import numpy
 import os
 import sys
 import math
@@ -27,49 +29,85 @@ class Glomerator(object):
         if debug:
             print '  max %d per cluster' % max_per_cluster
 
-        distances = {}  # cache the calculated fractional hamming distances
+        # single-linkage agglomeration over an integer-indexed condensed distance array, with a heap holding each cluster's nearest (allowed) neighbor
+        #  - each cluster has a slot (its row in the distance array, which the merged cluster takes over from its first parent) and an id (its position in creation order)
+        #  - ties are broken by the ids of the pair, which reproduces the order of the itertools.combinations() loop that we used to use
+        names = [cl[0] for cl in clusters]
+        n_seqs = len(names)
+        bits, mask = utils.pack_seqs([naive_seqs[name] for name in names])
+        distances = numpy.zeros(n_seqs * (n_seqs - 1) / 2, dtype=numpy.float64)  # condensed: pair (islot, jslot) with islot < jslot is at index n_seqs * islot - islot * (islot + 1) / 2 + jslot - islot - 1
+        for islot in range(n_seqs - 1):
+            istart = n_seqs * islot - islot * (islot + 1) / 2
+            distances[istart : istart + n_seqs - islot - 1] = utils.packed_hfracs(*utils.packed_hamming_distances(bits[islot], mask[islot], bits[islot + 1:], mask[islot + 1:]))
+
+        active = numpy.ones(n_seqs, dtype=numpy.bool_)  # is there a cluster in this slot?
+        sizes = numpy.ones(n_seqs, dtype=numpy.int64)
+        slot_ids = numpy.arange(n_seqs)  # id of the cluster in each slot
+        id_slots = {i : i for i in range(n_seqs)}  # and the reverse (active clusters only)
+        members = {i : [names[i]] for i in range(n_seqs)}  # keyed by slot
+
+        def cindices(islot, other_slots):
+            lo, hi = numpy.minimum(islot, other_slots), numpy.maximum(islot, other_slots)
+            return n_seqs * lo - lo * (lo + 1) / 2 + hi - lo - 1
+
+        def nearest_neighbor_entry(islot):  # heap entry (distance, smaller id, larger id, owner id) for the closest cluster that we're allowed to merge with the one in <islot>
+            other_slots = numpy.flatnonzero(active)
+            other_slots = other_slots[other_slots != islot]
+            if not merge_whatever_you_got:  # merged cluster would be too big, so look for smaller (albeit further-apart) things to merge
+                other_slots = other_slots[sizes[other_slots] + sizes[islot] <= max_per_cluster]
+            if len(other_slots) == 0:
+                return None
+            dists = distances[cindices(islot, other_slots)]
+            other_slots = other_slots[dists == dists.min()]
+            lo_ids, hi_ids = numpy.minimum(slot_ids[other_slots], slot_ids[islot]), numpy.maximum(slot_ids[other_slots], slot_ids[islot])
+            ibest = numpy.lexsort((hi_ids, lo_ids))[0]
+            return (dists.min(), lo_ids[ibest], hi_ids[ibest], slot_ids[islot])
+
+        def push_nearest_neighbor(islot):
+            entry = nearest_neighbor_entry(islot)
+            if entry is not None:
+                heapq.heappush(heap, entry)
+
+        def reset_heap():
+            del heap[:]
+            for islot in numpy.flatnonzero(active):
+                push_nearest_neighbor(islot)
+
+        merge_whatever_you_got = False  # merge the best pair, even if together they'll be to big
+        heap = []
+        reset_heap()
+        next_id = n_seqs
+        while len(members) > n_clusters:
+            if len(heap) == 0:  # didn't find a suitable pair
+                if debug:
+                    print '    didn\'t find shiznitz'
+                merge_whatever_you_got = True  # from now on, merge whatever's best regardless of size
+                reset_heap()
+                continue
 
-        # ----------------------------------------------------------------------------------------
-        def get_clusters_to_merge():
-            smallest_min_distance, clusters_to_merge = None, None
-            n_skipped = 0
-            for clust_a, clust_b in itertools.combinations(clusters, 2):  # find the two clusters which contain the pair of sequences which are closest in hamming fraction (skipping cluster pairs that would make a cluster that's too big)
-                if len(clust_a) + len(clust_b) > max_per_cluster and not glomerate.merge_whatever_you_got:  # merged cluster would be too big, so look for smaller (albeit further-apart) things to merge
-                    n_skipped += 1
-                    continue
-                min_distance = None  # find the smallest hamming distance between any two sequences in the two clusters
-                for query_a in clust_a:
-                    for query_b in clust_b:
-                        joint_key = query_a + ';' + query_b  #';'.join([query_a, query_b])
-                        if joint_key not in distances:
-                            distances[joint_key] = utils.hamming_fraction(naive_seqs[query_a], naive_seqs[query_b])
-                            distances[query_b + ';' + query_a] = distances[joint_key]  # also add with key in reverse order, in case we run into the pair that way later on
-                        if min_distance is None or distances[joint_key] < min_distance:
-                            min_distance = distances[joint_key]
-                if smallest_min_distance is None or min_distance < smallest_min_distance:
-                    smallest_min_distance = min_distance
-                    clusters_to_merge = (clust_a, clust_b)
-
-            if debug and n_skipped > 0:
-                print '      skipped: %d ' % n_skipped
-
-            return clusters_to_merge
+            _, id_a, id_b, owner_id = heapq.heappop(heap)
+            if owner_id not in id_slots:  # owner was already merged into something else (the merged cluster has its own entry)
+                continue
+            if id_a not in id_slots or id_b not in id_slots or (not merge_whatever_you_got and sizes[id_slots[id_a]] + sizes[id_slots[id_b]] > max_per_cluster):  # owner's neighbor is gone, or they've gotten too big to merge, so find it a new one
+                push_nearest_neighbor(id_slots[owner_id])
+                continue
 
-        # ----------------------------------------------------------------------------------------
-        def glomerate():
+            slot_a, slot_b = id_slots.pop(id_a), id_slots.pop(id_b)
             if debug:
-                print '    current ', ' '.join([str(len(cl)) for cl in clusters])
-            clusters_to_merge = get_clusters_to_merge()
-            if clusters_to_merge is None:  # if we didn't find a suitable pair
-                if debug:
-                    print '    didn\'t find shiznitz'
-                glomerate.merge_whatever_you_got = True  # next time through, merge whatever's best regardless of size
-            else:
-                if debug:
-                    print '    merging', len(clusters_to_merge[0]), len(clusters_to_merge[1])
-                clusters.append(clusters_to_merge[0] + clusters_to_merge[1])
-                clusters.remove(clusters_to_merge[0])
-                clusters.remove(clusters_to_merge[1])
+                print '    merging', sizes[slot_a], sizes[slot_b]
+            members[slot_a] = members[slot_a] + members.pop(slot_b)  # merged cluster takes over slot_a
+            sizes[slot_a] += sizes[slot_b]
+            active[slot_b] = False
+            other_slots = numpy.flatnonzero(active)
+            other_slots = other_slots[other_slots != slot_a]
+            ia, ib = cindices(slot_a, other_slots), cindices(slot_b, other_slots)
+            distances[ia] = numpy.minimum(distances[ia], distances[ib])  # single linkage
+            slot_ids[slot_a] = next_id
+            id_slots[next_id] = slot_a
+            next_id += 1
+            push_nearest_neighbor(slot_a)
+
+        clusters = [members[id_slots[cid]] for cid in sorted(id_slots)]  # same order as the list in the old version
 
         # ----------------------------------------------------------------------------------------
         def homogenize():
@@ -88,13 +126,6 @@ class Glomerator(object):
             if debug:
                 print '    sorted ', ' '.join([str(len(cl)) for cl in clusters])
 
-        # ----------------------------------------------------------------------------------------
-        # da bizniz
-        glomerate.merge_whatever_you_got = False  # merge the best pair, even if together they'll be to big
-
-        while len(clusters) > n_clusters:
-            glomerate()
-        
         if len(clusters) > 1:  # homogenize if partition is non-trivial
             clusters.sort(key=len)
 
@@ -0,0 +1,288 @@
+import os
+import csv
+import mmap
+import zlib
+import struct
+import collections
+
+import utils
+
+# ----------------------------------------------------------------------------------------
+# Binary, append-only hmm cache file (naive seqs, log probs, naive hfracs, and errors for each cluster), which bcrham reads with HmmCacheFile in packages/ham/src/hmmcachefile.cc (see the header there for the format, which has to match the one here).
+# The file is a series of self-contained segments, each with its own hash index, so bcrham (and get_cached_hmm_naive_seqs() in partitiondriver) can look up keys without parsing the whole file, and merging subprocess cache files is just appending a segment.
+# Functions here take/return the same string-valued line dicts (with keys utils.partition_cachefile_headers) that you get from reading the csv version with csv.DictReader, and handle either format based on the file suffix.
+
+suffix = '.hcache'  # has to match HmmCacheFile::IsBinary()
+magic = 'HMMC'
+version = 1
+header_struct = struct.Struct('<4sIIIIIQ')  # magic, version, n_uids, n_records, n_buckets, uid_blob_size, segment_size
+bucket_struct = struct.Struct('<IIQ')  # crc32 of key, key length, record offset from start of segment (0 for empty bucket)
+flag_bits = collections.OrderedDict([('logprob', 1), ('naive_hfrac', 2), ('naive_seq', 4), ('packed', 8), ('errors', 16)])
+bases = 'ACGT'  # 2-bit codes are the indices in this
+unpack_table = [''.join(bases[(ibyte >> (2 * ib)) & 3] for ib in range(4)) for ibyte in range(256)]  # four bases for each possible byte value (first base in the lowest two bits)
+pack_table = {bstr : chr(ibyte) for ibyte, bstr in enumerate(unpack_table)}
+float_columns = ['logprob', 'naive_hfrac']
+
+# ----------------------------------------------------------------------------------------
+def is_binary(fname):
+    return utils.getsuffix(fname) == suffix
+
+# ----------------------------------------------------------------------------------------
+def key_hash(key):
+    return zlib.crc32(key) & 0xffffffff
+
+# ----------------------------------------------------------------------------------------
+def pad8(size):
+    return (size + 7) & ~7
+
+# ----------------------------------------------------------------------------------------
+def pack_seq(seq):
+    padded = seq + bases[0] * (-len(seq) % 4)
+    return ''.join([pack_table[padded[i : i + 4]] for i in range(0, len(padded), 4)])
+
+# ----------------------------------------------------------------------------------------
+def unpack_seq(packed, length):
+    return ''.join(map(unpack_table.__getitem__, bytearray(packed)))[:length]
+
+# ----------------------------------------------------------------------------------------
+def empty_line(key):
+    line = {h : '' for h in utils.partition_cachefile_headers}
+    line['unique_ids'] = key
+    return line
+
+# ----------------------------------------------------------------------------------------
+def update_line(line, newline):  # same semantics as bcrham: empty values don't replace existing ones
+    for header in utils.partition_cachefile_headers[1:]:
+        if newline.get(header, '') not in ('', None):
+            line[header] = str_float(newline[header]) if header in float_columns else str(newline[header])
+
+# ----------------------------------------------------------------------------------------
+def str_float(val):  # the f32 values round trip with nine significant digits
+    return '%.9g' % val if not isinstance(val, basestring) else val
+
+# ----------------------------------------------------------------------------------------
+class HmmCacheFile(object):
+    def __init__(self, fname):
+        self.fname = fname
+        self.segments = []
+        self.cachefile, self.mm = None, None
+        if not os.path.exists(self.fname) or os.stat(self.fname).st_size == 0:
+            return
+        self.cachefile = open(self.fname, 'rb')
+        self.mm = mmap.mmap(self.cachefile.fileno(), 0, access=mmap.ACCESS_READ)
+        pos = 0
+        while pos < len(self.mm):
+            if len(self.mm) - pos < header_struct.size:
+                raise Exception('truncated segment header at byte %d in %s' % (pos, self.fname))
+            smagic, sversion, n_uids, n_records, n_buckets, uid_blob_size, segment_size = header_struct.unpack_from(self.mm, pos)
+            if smagic != magic or sversion != version:
+                raise Exception('bad segment header (magic %s, version %d) at byte %d in %s' % (repr(smagic), sversion, pos, self.fname))
+            if pos + segment_size > len(self.mm):
+                raise Exception('truncated segment at byte %d in %s' % (pos, self.fname))
+            offsets_start = pos + header_struct.size
+            index_start = pos + pad8(header_struct.size + 4 * (n_uids + 1) + uid_blob_size)
+            self.segments.append({'start' : pos, 'n_uids' : n_uids, 'n_records' : n_records, 'n_buckets' : n_buckets, 'offsets_start' : offsets_start, 'blob_start' : offsets_start + 4 * (n_uids + 1),
+                                  'index_start' : index_start, 'records_start' : index_start + bucket_struct.size * n_buckets, 'uids' : None})
+            pos += segment_size
+
+    # ----------------------------------------------------------------------------------------
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.cachefile.close()
+
+    # ----------------------------------------------------------------------------------------
+    def n_records(self):
+        return sum(seg['n_records'] for seg in self.segments)
+
+    # ----------------------------------------------------------------------------------------
+    def get_uid(self, seg, iuid):
+        if seg['uids'] is not None:
+            return seg['uids'][iuid]
+        start, end = struct.unpack_from('<II', self.mm, seg['offsets_start'] + 4 * iuid)
+        return self.mm[seg['blob_start'] + start : seg['blob_start'] + end]
+
+    # ----------------------------------------------------------------------------------------
+    def read_uids(self, seg):  # decode the whole uid table (if we're going to read every record)
+        if seg['uids'] is None:
+            offsets = struct.unpack_from('<%dI' % (seg['n_uids'] + 1), self.mm, seg['offsets_start'])
+            blob = self.mm[seg['blob_start'] : seg['blob_start'] + offsets[-1]]
+            seg['uids'] = [blob[offsets[i] : offsets[i + 1]] for i in range(seg['n_uids'])]
+
+    # ----------------------------------------------------------------------------------------
+    def read_record(self, seg, pos, key=None):  # returns line for record at <pos> (and the position after it), or (None, None) if <key> is set and isn't the record's key
+        n_key_uids, = struct.unpack_from('<I', self.mm, pos)
+        pos += 4
+        record_key = ':'.join([self.get_uid(seg, iuid) for iuid in struct.unpack_from('<%dI' % n_key_uids, self.mm, pos)])
+        if key is not None and record_key != key:
+            return None, None
+        pos += 4 * n_key_uids
+        line = empty_line(record_key)
+        flags = ord(self.mm[pos])
+        pos += 1
+        for column in float_columns:
+            if flags & flag_bits[column]:
+                line[column] = str_float(struct.unpack_from('<f', self.mm, pos)[0])
+                pos += 4
+        for column in ['naive_seq', 'errors']:
+            if flags & flag_bits[column]:
+                length, = struct.unpack_from('<I', self.mm, pos)
+                pos += 4
+                if column == 'naive_seq' and flags & flag_bits['packed']:
+                    line[column] = unpack_seq(self.mm[pos : pos + (length + 3) // 4], length)
+                    pos += (length + 3) // 4
+                else:
+                    line[column] = self.mm[pos : pos + length]
+                    pos += length
+        return line, pos
+
+    # ----------------------------------------------------------------------------------------
+    def get(self, key):  # merged info for <key> from all segments (or None if it isn't in any of them)
+        khash = key_hash(key)
+        line = None
+        for seg in self.segments:  # oldest first, so later values take precedence
+            mask = seg['n_buckets'] - 1
+            ibucket = khash & mask
+            for _ in range(seg['n_buckets']):
+                bhash, klen, offset = bucket_struct.unpack_from(self.mm, seg['index_start'] + bucket_struct.size * ibucket)
+                if offset == 0:
+                    break
+                if bhash == khash and klen == len(key):
+                    seg_line, _ = self.read_record(seg, seg['start'] + offset, key=key)
+                    if seg_line is not None:
+                        if line is None:
+                            line = empty_line(key)
+                        update_line(line, seg_line)
+                        break
+                ibucket = (ibucket + 1) & mask
+        return line
+
+    # ----------------------------------------------------------------------------------------
+    def iterlines(self):  # every record in the file, in order (so there can be more than one for the same key)
+        for seg in self.segments:
+            self.read_uids(seg)
+            pos = seg['records_start']
+            for _ in range(seg['n_records']):
+                line, pos = self.read_record(seg, pos)
+                yield line
+            seg['uids'] = None  # don't keep them all around
+
+# ----------------------------------------------------------------------------------------
+def append_segment(fname, lines):  # write <lines> (iterable of line dicts, values can be strings or numbers) to a new segment at the end of <fname>
+    entries = collections.OrderedDict()  # merge any repeated keys, since each key can only be in a segment once
+    for line in lines:
+        if line['unique_ids'] not in entries:
+            entries[line['unique_ids']] = empty_line(line['unique_ids'])
+        update_line(entries[line['unique_ids']], line)
+    if len(entries) == 0:
+        return
+
+    iuids, uids = {}, []
+    records, record_offsets = [], []
+    rsize = 0
+    for key, line in entries.items():
+        record_offsets.append(rsize)
+        key_uids = key.split(':')
+        for uid in key_uids:
+            if uid not in iuids:
+                iuids[uid] = len(uids)
+                uids.append(uid)
+        rstrs = [struct.pack('<%dI' % (len(key_uids) + 1), len(key_uids), *[iuids[u] for u in key_uids])]
+        flags = 0
+        for column in float_columns:
+            if line[column] != '':
+                flags |= flag_bits[column]
+                rstrs.append(struct.pack('<f', float(line[column])))
+        for column in ['naive_seq', 'errors']:
+            if line[column] != '':
+                flags |= flag_bits[column]
+                val = line[column]
+                rstrs.append(struct.pack('<I', len(val)))
+                if column == 'naive_seq' and len(val.translate(None, bases)) == 0:
+                    flags |= flag_bits['packed']
+                    val = pack_seq(val)
+                rstrs.append(val)
+        rstrs.insert(1, chr(flags))
+        rstr = ''.join(rstrs)
+        records.append(rstr)
+        rsize += len(rstr)
+
+    uid_offsets = [0]
+    for uid in uids:
+        uid_offsets.append(uid_offsets[-1] + len(uid))
+    uid_table = struct.pack('<%dI' % len(uid_offsets), *uid_offsets) + ''.join(uids)
+    uid_table += '\0' * (pad8(header_struct.size + len(uid_table)) - header_struct.size - len(uid_table))
+
+    n_buckets = 1
+    while n_buckets < 2 * len(entries):
+        n_buckets *= 2
+    buckets = [None for _ in range(n_buckets)]
+    records_start = header_struct.size + len(uid_table) + bucket_struct.size * n_buckets
+    for key, roffset in zip(entries, record_offsets):
+        khash = key_hash(key)
+        ibucket = khash & (n_buckets - 1)
+        while buckets[ibucket] is not None:
+            ibucket = (ibucket + 1) & (n_buckets - 1)
+        buckets[ibucket] = (khash, len(key), records_start + roffset)
+    index = ''.join([bucket_struct.pack(*(b if b is not None else (0, 0, 0))) for b in buckets])
+
+    with open(fname, 'ab') as cachefile:
+        cachefile.write(header_struct.pack(magic, version, len(uids), len(entries), n_buckets, uid_offsets[-1], records_start + rsize))
+        cachefile.write(uid_table)
+        cachefile.write(index)
+        cachefile.write(''.join(records))
+
+# ----------------------------------------------------------------------------------------
+def iterlines(fname):  # every line in <fname> as string-valued dicts (there can be more than one line for the same key)
+    if not os.path.exists(fname) or os.stat(fname).st_size == 0:
+        return
+    if is_binary(fname):
+        hfile = HmmCacheFile(fname)
+        try:
+            for line in hfile.iterlines():
+                yield line
+        finally:
+            hfile.close()
+    else:
+        with open(fname) as cachefile:
+            for line in csv.DictReader(cachefile):
+                yield line
+
+# ----------------------------------------------------------------------------------------
+def read_cachefile(fname):  # returns OrderedDict from key to line dict, with the info from all lines for each key merged together
+    cachefo = collections.OrderedDict()
+    for line in iterlines(fname):
+        if line['unique_ids'] not in cachefo:
+            cachefo[line['unique_ids']] = empty_line(line['unique_ids'])
+        update_line(cachefo[line['unique_ids']], line)
+    return cachefo
+
+# ----------------------------------------------------------------------------------------
+def write_cachefile(fname, lines, append=False):  # NOTE for binary files we append a segment, for csv files we append lines (with a header only if the file is empty)
+    if not append and os.path.exists(fname):
+        os.remove(fname)
+    if is_binary(fname):
+        append_segment(fname, lines)
+        return
+    write_header = not os.path.exists(fname) or os.stat(fname).st_size == 0
+    with open(fname, 'a') as cachefile:
+        writer = csv.DictWriter(cachefile, utils.partition_cachefile_headers)
+        if write_header:
+            writer.writeheader()
+        for line in lines:
+            writer.writerow({h : str_float(line.get(h, '')) if h in float_columns and line.get(h) is not None else line.get(h, '') for h in utils.partition_cachefile_headers})
+
+# ----------------------------------------------------------------------------------------
+def merge_cachefiles(infnames, outfname, append=False):
+    """
+    Merge the info from <infnames> (any of which may be binary or csv, or not exist) into <outfname> (which can be one of <infnames>).
+    If <append> is set, we add the merged info to the end of <outfname> as a new segment (so you shouldn't include <outfname> in <infnames>), otherwise we rewrite it with one line for each key.
+    """
+    cachefo = collections.OrderedDict()
+    for fname in infnames:
+        for key, line in read_cachefile(fname).items():
+            if key not in cachefo:
+                cachefo[key] = line
+            else:
+                update_line(cachefo[key], line)
+    write_cachefile(outfname, cachefo.values(), append=append)
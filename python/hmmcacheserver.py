@@ -0,0 +1,102 @@
+import os
+import socket
+import tempfile
+import threading
+import SocketServer
+
+import utils
+import hmmcachefile
+
+# ----------------------------------------------------------------------------------------
+class HmmCacheRequestHandler(SocketServer.StreamRequestHandler):
+    """ one of these runs (in its own thread) for each connected bcrham process (see packages/ham/include/cacheclient.h for the protocol) """
+    def handle(self):
+        cache = self.server.cache
+        for line in self.rfile:
+            command, _, rest = line.rstrip('\n').partition(' ')
+            if command == 'get':
+                self.wfile.write(''.join(cache.get_line(key) for key in rest.split(' ')))
+                self.wfile.flush()
+            elif command == 'put':
+                cache.put(rest)
+            else:
+                raise Exception('unexpected request \'%s\' from bcrham' % line.strip())
+
+# ----------------------------------------------------------------------------------------
+class ThreadingUnixStreamServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True  # don't wait for bcrham procs that are hung (or whatever) when we exit
+
+# ----------------------------------------------------------------------------------------
+class HmmCacheServer(object):
+    """
+    In-memory version of the hmm cache file (naive seqs, logprobs, and naive hfracs) that all the bcrham processes in a partition step query and add to via a unix socket.
+    This replaces copying the cache file to each process's subdir, having each of them parse it, and then merging their output cache files back together.
+    We keep <fname> (binary or csv, see hmmcachefile.py) up to date by appending to it in flush(), since it's also read (and written) in lots of places in partitiondriver.
+    """
+    columns = utils.partition_cachefile_headers[1:]  # everything but 'unique_ids'
+
+    def __init__(self, fname, workdir):
+        self.fname = fname
+        self.cache = {}  # map from key (colon-separated uids) to list of column strings (just strings, so we write back exactly what bcrham gave us)
+        self.updated_keys = set()  # keys that have changed since the last flush()
+        self.lock = threading.Lock()
+        if os.path.exists(self.fname) and os.stat(self.fname).st_size > 0:
+            self.read_cachefile()
+
+        self.socket_dir = tempfile.mkdtemp(prefix='hmm-cache-', dir=workdir if len(workdir) < 80 else None)  # unix sockets have a max path length of around 100
+        self.socket_path = self.socket_dir + '/socket'
+        self.server = ThreadingUnixStreamServer(self.socket_path, HmmCacheRequestHandler)
+        self.server.cache = self
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # ----------------------------------------------------------------------------------------
+    def read_cachefile(self):
+        for line in hmmcachefile.iterlines(self.fname):
+            self.update(line['unique_ids'], [line[c] for c in self.columns])  # NOTE there can be more than one line for the same key (e.g. if we calculated the naive seq in one run, and the log prob in a later one)
+        self.updated_keys = set()
+        print '        read %d entries into hmm cache server' % len(self.cache)
+
+    # ----------------------------------------------------------------------------------------
+    def update(self, key, values):  # same semantics as reading the cache file in bcrham: empty values don't replace existing ones
+        if key not in self.cache:
+            self.cache[key] = ['' for _ in self.columns]
+        cachevals = self.cache[key]
+        for ival, val in enumerate(values):
+            if val != '':
+                cachevals[ival] = val
+        self.updated_keys.add(key)
+
+    # ----------------------------------------------------------------------------------------
+    def get_line(self, key):
+        with self.lock:  # update() modifies rows in place, so without the lock we could return a row that's only partly updated
+            values = self.cache.get(key)
+            if values is None:
+                return ',' * (len(self.columns) - 1) + '\n'
+            return ','.join(values) + '\n'
+
+    # ----------------------------------------------------------------------------------------
+    def put(self, linestr):
+        values = linestr.split(',')
+        if len(values) != len(self.columns) + 1:
+            raise Exception('unexpected cache line from bcrham: %s' % linestr)
+        with self.lock:
+            self.update(values[0], values[1:])
+
+    # ----------------------------------------------------------------------------------------
+    def flush(self):  # append anything that's changed since the last flush() to <self.fname>
+        with self.lock:  # copy the rows while we've got the lock, but write them without it
+            keys, self.updated_keys = self.updated_keys, set()
+            lines = [dict([('unique_ids', key)] + zip(self.columns, self.cache[key])) for key in keys]
+        if len(lines) == 0:
+            return
+        hmmcachefile.write_cachefile(self.fname, lines, append=True)
+
+    # ----------------------------------------------------------------------------------------
+    def close(self):
+        self.flush()
+        self.server.shutdown()
+        self.server.server_close()
+        os.remove(self.socket_path)
+        os.rmdir(self.socket_dir)
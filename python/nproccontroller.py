@@ -0,0 +1,103 @@
+import os
+import numpy
+import yaml
+
+import utils
+
+# ----------------------------------------------------------------------------------------
+class NProcController(object):
+    """
+    Choose the number of bcrham procs for each clustering step (with --adaptive-n-procs) using a cost model fit to the steps we've already run, rather than the fixed reduction factor in PartitionDriver.prepare_next_iteration().
+    Model for a step with n procs and N clusters:
+        wall time = overhead_intercept + overhead_slope * n + imbalance * seconds_per_calc * calcs_per_proc,   calcs_per_proc = calc_coefficient * N^2 / n^2
+    i.e. each proc compares all pairs of its N/n clusters, and overhead is everything besides the slowest bcrham proc (writing input, starting procs, merging output...).
+    We then pick the next n by simulating the rest of the clustering (down to one proc, assuming the last step's merge fraction holds) for each of several reduction factors, and taking the one with the smallest predicted total time.
+    """
+    reduction_factors = [1., 1.3, 1.6, 2., 3., 5.]  # candidate factors by which to divide n_procs (1.3 is the fixed factor that prepare_next_iteration() uses)
+    default_factor = 1.3  # if we stay at the same n_procs for the next step, assume we reduce by this much after that
+    min_merge_fraction = 0.01  # if the last step merged less than this fraction of its clusters, the procs aren't finding anything to merge among their own clusters, so we have to reduce n_procs to get more cross-process merging
+    max_sim_steps = 100
+
+    def __init__(self):
+        self.steps = []  # one dict for each clustering step
+        self.decisions = []  # and one for each choice we made (written to --adaptive-n-procs-log-fname, if it's set, so you can tune things)
+
+    # ----------------------------------------------------------------------------------------
+    def add_step(self, n_procs, n_clusters_before, n_clusters_after, bcrham_proc_info, timing_info):  # <bcrham_proc_info> and <timing_info> are the PartitionDriver attributes (for the step that just finished)
+        bcrham_times = [pinfo['time']['bcrham'] for pinfo in bcrham_proc_info]
+        n_calcd = [pinfo['calcd']['vtb'] + pinfo['calcd']['fwd'] for pinfo in bcrham_proc_info if pinfo['calcd']['vtb'] is not None and pinfo['calcd']['fwd'] is not None]
+        if None in bcrham_times or len(n_calcd) != len(bcrham_proc_info):  # probably lost some stdout somewhere (see get_n_calculated_per_process()), so we can't use this step
+            print '    %s missing bcrham time or calc info for step with %d procs, so not using it in n_procs cost model' % (utils.color('yellow', 'warning'), n_procs)
+            return
+        self.steps.append({'n_procs' : n_procs, 'n_clusters_before' : n_clusters_before, 'n_clusters_after' : n_clusters_after, 'bcrham_times' : bcrham_times, 'n_calcd' : sum(n_calcd), 'wall' : timing_info['total']})
+
+    # ----------------------------------------------------------------------------------------
+    def fit(self):
+        step = self.steps[-1]
+        fitfo = {}
+        fitfo['seconds_per_calc'] = sum(step['bcrham_times']) / max(1., step['n_calcd'])
+        fitfo['calc_coefficient'] = step['n_calcd'] * step['n_procs'] / float(step['n_clusters_before'])**2  # NOTE this changes a lot as clusters get bigger and more things are cached, so we only use the most recent step
+        fitfo['imbalance'] = max(step['bcrham_times']) / max(1e-6, numpy.mean(step['bcrham_times']))
+        fitfo['merge_fraction'] = (step['n_clusters_before'] - step['n_clusters_after']) / float(step['n_clusters_before'])
+
+        overheads = [(s['n_procs'], max(0., s['wall'] - max(s['bcrham_times']))) for s in self.steps]
+        if len(set(n for n, _ in overheads)) > 1:  # if we have more than one n_procs value, fit overhead vs n_procs
+            slope, intercept = numpy.polyfit([n for n, _ in overheads], [o for _, o in overheads], 1)
+            fitfo['overhead_slope'], fitfo['overhead_intercept'] = max(0., slope), max(0., intercept)
+        else:
+            fitfo['overhead_slope'], fitfo['overhead_intercept'] = 0., numpy.mean([o for _, o in overheads])
+        return fitfo
+
+    # ----------------------------------------------------------------------------------------
+    def predict_step_time(self, fitfo, n_procs, n_clusters):
+        calcs_per_proc = fitfo['calc_coefficient'] * n_clusters**2 / float(n_procs)**2
+        return fitfo['overhead_intercept'] + fitfo['overhead_slope'] * n_procs + fitfo['imbalance'] * fitfo['seconds_per_calc'] * calcs_per_proc
+
+    # ----------------------------------------------------------------------------------------
+    def predict_remaining_time(self, fitfo, next_n_procs, factor, n_clusters):  # total predicted time for the rest of the clustering if we use <next_n_procs> for the next step, then keep dividing by <factor>
+        if factor == 1.:
+            factor = self.default_factor
+        total, n_procs = 0., next_n_procs
+        for _ in range(self.max_sim_steps):
+            total += self.predict_step_time(fitfo, n_procs, n_clusters)
+            if n_procs == 1:
+                break
+            n_clusters = max(1., n_clusters * (1. - fitfo['merge_fraction']))
+            n_procs = max(1, int(n_procs / factor))
+        return total
+
+    # ----------------------------------------------------------------------------------------
+    def choose_n_procs(self, n_proc_list, n_clusters):  # returns None if we don't have enough info, in which case you should fall back to the old heuristics
+        if len(self.steps) == 0 or self.steps[-1]['n_procs'] != n_proc_list[-1]:  # don't have info for the last step
+            return None
+        last_n_procs = n_proc_list[-1]
+        fitfo = self.fit()
+
+        must_reduce = []  # reasons we can't stay at the same n_procs
+        if fitfo['merge_fraction'] < self.min_merge_fraction:
+            must_reduce.append('merge fraction %.3f < %.3f' % (fitfo['merge_fraction'], self.min_merge_fraction))
+        if n_proc_list.count(last_n_procs) >= max(4, last_n_procs):  # same as in shall_we_reduce_n_procs()
+            must_reduce.append('already ran %d steps with %d procs' % (n_proc_list.count(last_n_procs), last_n_procs))
+
+        predictions = []  # list of (next n_procs, predicted remaining time)
+        for factor in self.reduction_factors:
+            if factor == 1. and len(must_reduce) > 0:
+                continue
+            next_n_procs = max(1, int(last_n_procs / factor))
+            if next_n_procs in [n for n, _ in predictions]:
+                continue
+            predictions.append((next_n_procs, self.predict_remaining_time(fitfo, next_n_procs, factor, n_clusters)))
+        next_n_procs, predicted_time = min(predictions, key=lambda p: p[1])
+
+        print '      n_procs controller: %.2g s/calc   %.3g calcs*n_procs/n_clusters^2   imbalance %.2f   overhead %.1f + %.2f*n_procs s   merged %.1f%%%s' % (fitfo['seconds_per_calc'], fitfo['calc_coefficient'], fitfo['imbalance'], fitfo['overhead_intercept'], fitfo['overhead_slope'], 100 * fitfo['merge_fraction'],
+                                                                                                                                                       ('   must reduce (%s)' % ', '.join(must_reduce)) if len(must_reduce) > 0 else '')
+        print '          predicted remaining time for next n_procs: %s  -->  %d' % ('  '.join('%d: %.1fs' % (n, t) for n, t in predictions), next_n_procs)
+        self.decisions.append({'last_n_procs' : last_n_procs, 'n_clusters' : n_clusters, 'fit' : {k : float(v) for k, v in fitfo.items()}, 'predictions' : [[n, float(t)] for n, t in predictions], 'must_reduce' : must_reduce, 'chosen' : next_n_procs})
+        return next_n_procs
+
+    # ----------------------------------------------------------------------------------------
+    def write_log(self, fname):
+        if os.path.dirname(fname) != '' and not os.path.exists(os.path.dirname(fname)):
+            os.makedirs(os.path.dirname(fname))
+        with open(fname, 'w') as logfile:
+            yaml.dump({'steps' : self.steps, 'decisions' : self.decisions}, logfile, width=400)
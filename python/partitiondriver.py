@@ -16,14 +16,18 @@ import copy
 import multiprocessing
 import operator
 import traceback
+import heapq
 
 import utils
 import glutils
 import indelutils
 import treeutils
+import hmmcachefile
 from glomerator import Glomerator
 from clusterpath import ClusterPath
-from waterer import Waterer
+from waterer import Waterer, IgSwWorkerPool
+from hmmcacheserver import HmmCacheServer
+from nproccontroller import NProcController
 from parametercounter import ParameterCounter
 from alleleclusterer import AlleleClusterer
 from alleleremover import AlleleRemover
@@ -47,22 +51,28 @@ class PartitionDriver(object):
         self.my_gldir = self.args.workdir + '/' + glutils.glfo_dir
 
         self.vs_info, self.sw_info = None, None
+        self.sw_worker_pool = None  # ig-sw procs that we keep around for all the run_waterer() calls (unless we're using a batch system)
+        self.hmm_cache_server = None  # if set (with --hmm-cache-server), bcrham procs get cached info from this, rather than each reading their own copy of the cache file
         self.duplicates = {}
         self.bcrham_proc_info = None
         self.timing_info = []  # it would be really nice to clean up both this and bcrham_proc_info
+        self.n_proc_controller = NProcController() if self.args.adaptive_n_procs else None  # chooses n_procs for each clustering step from a cost model fit to the previous steps
         self.istep = None  # stupid hack to get around network file system issues (see self.subworkidr()
         self.subworkdirs = []  # arg. same stupid hack
 
         self.unseeded_seqs = None  # all the queries that we *didn't* cluster with the seed uid
         self.small_cluster_seqs = None  # all the queries that we removed after a few partition steps 'cause they were in small clusters
+        self.previous_partition = None  # best partition from --incremental-from (restricted to queries that passed sw)
+        self.incremental_uids = None  # queries that weren't in <self.previous_partition>, i.e. the new ones, which we pass to bcrham as seeds (so it only considers merges that involve at least one of them)
 
         self.sw_param_dir, self.hmm_param_dir, self.multi_hmm_param_dir = ['%s/%s' % (self.args.parameter_dir, s) for s in ['sw', 'hmm', 'multi-hmm']]
         self.sub_param_dir = self.args.parameter_dir + '/' + self.args.parameter_type
 
         self.hmm_infname = self.args.workdir + '/hmm_input.csv'
-        self.hmm_cachefname = self.args.workdir + '/hmm_cached_info.csv'
+        self.hmm_cachefname = self.args.workdir + '/hmm_cached_info' + hmmcachefile.suffix
         self.hmm_outfname = self.args.workdir + '/hmm_output.csv'
         self.cpath_progress_dir = '%s/cluster-path-progress' % self.args.workdir  # write the cluster paths for each clustering step to separate files in this dir
+        self.seed_uid_fname = self.args.workdir + '/seed-unique-ids.txt'  # for when we have too many seeds to put on the bcrham command line (a.t.m. only with --incremental-from)
 
         if self.args.outfname is not None:
             utils.prep_dir(dirname=None, fname=self.args.outfname, allow_other_files=True)
@@ -121,6 +131,11 @@ class PartitionDriver(object):
 
     # ----------------------------------------------------------------------------------------
     def clean(self):
+        if self.sw_worker_pool is not None:
+            self.sw_worker_pool.close()
+        if self.hmm_cache_server is not None:
+            self.hmm_cache_server.close()  # writes anything it hasn't yet written to self.hmm_cachefname
+
         if self.args.new_allele_fname is not None:
             new_allele_region = 'v'
             new_alleles = [(g, seq) for g, seq in self.glfo['seqs'][new_allele_region].items() if glutils.is_snpd(g)]
@@ -137,13 +152,13 @@ class PartitionDriver(object):
                 print '  waiting for lock on %s' % lockfname
                 time.sleep(0.5)
             lockfile = open(lockfname, 'w')
-            if not os.path.exists(self.args.persistent_cachefname):
-                open(self.args.persistent_cachefname, 'w').close()
-            self.merge_files(infnames=[self.args.persistent_cachefname, self.hmm_cachefname], outfname=self.args.persistent_cachefname, dereplicate=True)
+            hmmcachefile.merge_cachefiles([self.args.persistent_cachefname, self.hmm_cachefname], self.args.persistent_cachefname)  # rewrites it with one line for each key (in whichever format its suffix says)
             lockfile.close()
             os.remove(lockfname)
         if os.path.exists(self.hmm_cachefname):
             os.remove(self.hmm_cachefname)
+        if os.path.exists(self.seed_uid_fname):
+            os.remove(self.seed_uid_fname)
 
         for subd in self.subworkdirs:
             if os.path.exists(subd):  # if there was only one proc for this step, it'll have already been removed
@@ -163,6 +178,9 @@ class PartitionDriver(object):
     def deal_with_persistent_cachefile(self):
         if self.args.persistent_cachefname is None or not os.path.exists(self.args.persistent_cachefname):  # nothin' to do (ham'll initialize it)
             return
+        if hmmcachefile.is_binary(self.args.persistent_cachefname):
+            check_call(['cp', self.args.persistent_cachefname, self.hmm_cachefname])
+            return
 
         with open(self.args.persistent_cachefname) as cachefile:
             reader = csv.DictReader(cachefile)
@@ -178,8 +196,8 @@ class PartitionDriver(object):
                         utils.process_input_line(line)
                         outrow = {'unique_ids' : line['unique_ids'], 'naive_seq' : line['padlefts'][0] * utils.ambiguous_bases[0] + line['naive_seq'] + line['padrights'][0] * utils.ambiguous_bases[0]}
                         writer.writerow(outrow)
-            elif set(reader.fieldnames) == set(utils.partition_cachefile_headers):  # headers are ok, so can just copy straight over
-                check_call(['cp', self.args.persistent_cachefname, self.hmm_cachefname])
+            elif set(reader.fieldnames) == set(utils.partition_cachefile_headers):  # headers are ok, so we just need to convert it to binary
+                hmmcachefile.merge_cachefiles([self.args.persistent_cachefname], self.hmm_cachefname)
             else:
                 raise Exception('--persistent-cachefname %s has unexpected header list %s' % (self.args.persistent_cachefname, reader.fieldnames))
 
@@ -193,11 +211,13 @@ class PartitionDriver(object):
             self.set_vsearch_info(get_annotations=True)
 
         pre_failed_queries = self.sw_info['failed-queries'] if self.sw_info is not None else None  # don't re-run on failed queries if this isn't the first sw run (i.e., if we're parameter caching)
+        if self.sw_worker_pool is None and self.args.batch_system is None:
+            self.sw_worker_pool = IgSwWorkerPool(self.args.workdir)
         waterer = Waterer(self.args, self.glfo, self.input_info, self.simglfo, self.reco_info,
                           count_parameters=count_parameters,
                           parameter_out_dir=self.sw_param_dir if write_parameters else None,
                           plot_annotation_performance=self.args.plot_annotation_performance,
-                          duplicates=self.duplicates, pre_failed_queries=pre_failed_queries, aligned_gl_seqs=self.aligned_gl_seqs, vs_info=self.vs_info)
+                          duplicates=self.duplicates, pre_failed_queries=pre_failed_queries, aligned_gl_seqs=self.aligned_gl_seqs, vs_info=self.vs_info, worker_pool=self.sw_worker_pool)
 
         cache_path = self.sw_cache_path(find_any=require_cachefile)
         cachefname = cache_path + ('.yaml' if self.args.sw_cachefname is None else utils.getsuffix(self.args.sw_cachefname))  # use yaml, unless csv was explicitly set on the command line
@@ -288,8 +308,10 @@ class PartitionDriver(object):
         # get and write hmm parameters
         print 'hmm'
         sys.stdout.flush()
-        _, annotations, hmm_failures = self.run_hmm('viterbi', parameter_in_dir=self.sw_param_dir, parameter_out_dir=self.hmm_param_dir, count_parameters=True)
-        if self.args.outfname is not None and self.current_action == self.all_actions[-1]:
+        writing_output = self.args.outfname is not None and self.current_action == self.all_actions[-1]
+        stream_fcn = self.get_output_stream_fcn() if writing_output else None
+        _, annotations, hmm_failures = self.run_hmm('viterbi', parameter_in_dir=self.sw_param_dir, parameter_out_dir=self.hmm_param_dir, count_parameters=True, stream_fcn=stream_fcn)
+        if writing_output and stream_fcn is None:
             self.write_output(annotations.values(), hmm_failures)
         self.write_hmms(self.hmm_param_dir)  # note that this modifies <self.glfo>
 
@@ -303,12 +325,27 @@ class PartitionDriver(object):
                 self.write_output(None, set(), write_sw=True)  # note that if you're auto-parameter caching, this will just be rewriting an sw output file that's already there from parameter caching, but oh, well. If you're setting --only-smith-waterman and not using cache-parameters, you have only yourself to blame
             return
         print 'hmm'
-        _, annotations, hmm_failures = self.run_hmm('viterbi', parameter_in_dir=self.sub_param_dir, count_parameters=self.args.count_parameters, parameter_out_dir=self.multi_hmm_param_dir if self.args.parameter_out_dir is None else self.args.parameter_out_dir)
+        stream_fcn = self.get_output_stream_fcn() if self.args.outfname is not None and not self.args.get_tree_metrics else None
+        _, annotations, hmm_failures = self.run_hmm('viterbi', parameter_in_dir=self.sub_param_dir, count_parameters=self.args.count_parameters, parameter_out_dir=self.multi_hmm_param_dir if self.args.parameter_out_dir is None else self.args.parameter_out_dir, stream_fcn=stream_fcn)
+        if stream_fcn is not None:  # already wrote them
+            return
         if self.args.get_tree_metrics:
             self.calculate_tree_metrics(annotations, cpath=None)  # adds tree metrics to <annotations>
         if self.args.outfname is not None:
             self.write_output(annotations.values(), hmm_failures)
 
+    # ----------------------------------------------------------------------------------------
+    def get_output_stream_fcn(self):
+        """
+        If we don't need the annotations for anything besides writing them to --outfname, return a fcn that writes them as they're read from bcrham output (so we never have all of them in memory at once), otherwise return None.
+        Only the json yaml writer can write a generator of annotations, and printing, annotation clustering, and linearham info all need the whole list.
+        """
+        if utils.getsuffix(self.args.outfname) != '.yaml' or self.args.write_full_yaml_output or self.args.presto_output or self.args.airr_output:
+            return None
+        if self.args.debug or self.args.annotation_clustering is not None or (self.args.extra_annotation_columns is not None and 'linearham-info' in self.args.extra_annotation_columns):
+            return None
+        return lambda annotation_lines, hmm_failures: self.write_output(annotation_lines, hmm_failures, streaming=True)
+
     # ----------------------------------------------------------------------------------------
     def calculate_tree_metrics(self, annotations, cpath=None):
         if self.current_action == 'get-tree-metrics' and self.args.input_metafname is not None:  # presumably if you're running 'get-tree-metrics' with --input-metafname set, that means you didn't add the affinities (+ other metafo) when you partitioned, so we need to add it now
@@ -333,7 +370,8 @@ class PartitionDriver(object):
                     continue
             if self.args.reco_ids is not None and line['reco_id'] not in self.args.reco_ids:
                 continue
-            utils.add_implicit_info(self.glfo, line)
+            line = utils.ImplicitInfoLine(line)  # so the slowest implicit info only gets calculated if it's used
+            utils.add_implicit_info(self.glfo, line, lazy=True)
             annotations[uidstr] = line
 
             n_queries_read += 1
@@ -345,6 +383,18 @@ class PartitionDriver(object):
 
         return annotations
 
+    # ----------------------------------------------------------------------------------------
+    def select_lazy_annotations(self, lazy_annotations, ignore_args_dot_queries=False):  # choose the events that print_results() would print with --cluster-indices using only the uids and invalid flags in <lazy_annotations>'s index, so we only read those events (uses the same criteria as parse_existing_annotations(), except for reco ids and n_max_queries, for which we don't read lazily)
+        ievents = []
+        for ievent in range(len(lazy_annotations)):
+            if lazy_annotations.is_invalid(ievent):
+                continue
+            if self.args.queries is not None and not ignore_args_dot_queries and len(set(self.args.queries) & set(lazy_annotations.unique_ids(ievent))) == 0:
+                continue
+            ievents.append(ievent)
+        sorted_ievents = sorted(ievents, key=lambda i: len(lazy_annotations.unique_ids(i)), reverse=True)
+        return [lazy_annotations[sorted_ievents[iclust]] for iclust in self.args.cluster_indices]
+
     # ----------------------------------------------------------------------------------------
     def view_alternative_annotations(self):
         print '  %s getting alternative annotation information from existing output file. These results will only be meaningful if you had --calculate-alternative-annotations set when writing the output file (so that all subcluster annotations were stored). We can\'t check for that here directly, so instead we print this warning to make sure you had it set ;-)' % utils.color('yellow', 'note')
@@ -386,7 +436,7 @@ class PartitionDriver(object):
         self.write_output(cluster_annotations.values(), set(), cpath=cpath, dont_write_failed_queries=True)  # I *think* we want <dont_write_failed_queries> set, because the failed queries should already have been written, so now they'll just be mixed in with the others in <annotations>
 
     # ----------------------------------------------------------------------------------------
-    def print_results(self, cpath, annotations):
+    def print_results(self, cpath, annotations, selected_annotations=None):  # if set, <selected_annotations> are the annotations to print, already sorted and restricted to --cluster-indices (see select_lazy_annotations())
         seed_uid = self.args.seed_unique_id
         if cpath is not None:
             # it's expected that sometimes you'll write a seed partition cpath, but then when you read the file you don't bother to seed the seed id on the command line. The reverse, however, shouldn't happen
@@ -403,9 +453,12 @@ class PartitionDriver(object):
 
         if len(annotations) > 0:
             print utils.color('green', 'annotations:')
-            sorted_annotations = sorted(annotations.values(), key=lambda l: len(l['unique_ids']), reverse=True)
-            if self.args.cluster_indices is not None:
-                sorted_annotations = [sorted_annotations[iclust] for iclust in self.args.cluster_indices]
+            if selected_annotations is not None:
+                sorted_annotations = selected_annotations
+            else:
+                sorted_annotations = sorted(annotations.values(), key=lambda l: len(l['unique_ids']), reverse=True)
+                if self.args.cluster_indices is not None:
+                    sorted_annotations = [sorted_annotations[iclust] for iclust in self.args.cluster_indices]
             for line in sorted_annotations:
                 if self.args.only_print_best_partition and cpath is not None and cpath.i_best is not None and line['unique_ids'] not in cpath.partitions[cpath.i_best]:
                     continue
@@ -432,6 +485,7 @@ class PartitionDriver(object):
 
         annotation_lines = []
         cpath = None
+        selected_annotations = None  # if we read the output lazily, the (sorted) annotations that print_results() should print
         tmpact = self.current_action  # just a shorthand for brevity
         if utils.getsuffix(outfname) == '.csv':  # old way
             if tmpact == 'view-partitions' or tmpact == 'plot-partitions' or tmpact == 'view-output' or tmpact == 'get-tree-metrics' or read_partitions:
@@ -444,7 +498,14 @@ class PartitionDriver(object):
         elif utils.getsuffix(outfname) == '.yaml':  # new way
             # NOTE replaces <self.glfo>, which is definitely what we want (that's the point of putting glfo in the yaml file), but it's still different behavior than if reading a csv
             assert self.glfo is None  # make sure bin/partis successfully figured out that we would be reading the glfo from the yaml output file
-            self.glfo, annotation_lines, cpath = utils.read_yaml_output(outfname, n_max_queries=self.args.n_max_queries, dont_add_implicit_info=True, seed_unique_id=self.args.seed_unique_id)  # add implicit info below, so we can skip some of 'em
+            lazy = tmpact in ['view-output', 'view-annotations'] and self.args.cluster_indices is not None and self.args.reco_ids is None and self.args.n_max_queries <= 0  # if we're only printing a few clusters, only parse (and add implicit info to) those ones (we need to read every event to get reco ids, and n_max_queries would be weird)
+            self.glfo, annotation_lines, cpath = utils.read_yaml_output(outfname, n_max_queries=self.args.n_max_queries, dont_add_implicit_info=True, seed_unique_id=self.args.seed_unique_id, lazy=lazy)  # add implicit info below, so we can skip some of 'em
+            if isinstance(annotation_lines, utils.LazyAnnotationList):  # it could still be a list if the file wasn't json
+                selected_annotations = self.select_lazy_annotations(annotation_lines, ignore_args_dot_queries=ignore_args_dot_queries)
+                annotation_lines = selected_annotations
+        elif utils.getsuffix(outfname) == '.npz':  # columnar version of the yaml file (same note about glfo)
+            assert self.glfo is None
+            self.glfo, annotation_lines, cpath = utils.read_npz_output(outfname, n_max_queries=self.args.n_max_queries, dont_add_implicit_info=True, seed_unique_id=self.args.seed_unique_id)
         else:
             raise Exception('unhandled annotation file suffix %s' % outfname)
 
@@ -465,7 +526,7 @@ class PartitionDriver(object):
             partplotter.plot(self.args.plotdir + '/partitions', partition=cpath.partitions[cpath.i_best], annotations=annotations, reco_info=self.reco_info, cpath=cpath)
 
         if tmpact in ['view-output', 'view-annotations', 'view-partitions']:
-            self.print_results(cpath, annotations)
+            self.print_results(cpath, annotations, selected_annotations=selected_annotations)
 
         return annotations, cpath
 
@@ -484,8 +545,15 @@ class PartitionDriver(object):
 
         print 'hmm'
 
+        if self.args.incremental_from is not None:
+            self.read_incremental_partition()
+
         # pre-cache hmm naive seq for each single query NOTE <self.current_action> is still 'partition' for this (so that we build the correct bcrham command line)
-        if self.args.persistent_cachefname is None or not os.path.exists(self.hmm_cachefname):  # if the default (no persistent cache file), or if a not-yet-existing persistent cache file was specified
+        if self.incremental_uids is not None:  # only need the new ones (naive seqs for the old clusters are either in --persistent-cachefname, or bcrham calculates them as it needs them)
+            if len(self.incremental_uids) > 0:
+                print 'caching %d new naive sequences' % len(self.incremental_uids)
+                self.run_hmm('viterbi', self.sub_param_dir, n_procs=self.auto_nprocs(len(self.incremental_uids)), precache_all_naive_seqs=True, partition=[[q] for q in self.incremental_uids])
+        elif self.args.persistent_cachefname is None or not os.path.exists(self.hmm_cachefname):  # if the default (no persistent cache file), or if a not-yet-existing persistent cache file was specified
             print 'caching all %d naive sequences' % len(self.sw_info['queries'])  # this used to be a speed optimization, but now it's so we have better naive sequences for the pre-bcrham collapse
             self.run_hmm('viterbi', self.sub_param_dir, n_procs=self.auto_nprocs(len(self.sw_info['queries'])), precache_all_naive_seqs=True)
 
@@ -506,6 +574,21 @@ class PartitionDriver(object):
 
         self.check_partition(cpath.partitions[cpath.i_best])
 
+    # ----------------------------------------------------------------------------------------
+    def read_incremental_partition(self):
+        previous_cpath = ClusterPath(fname=self.args.incremental_from)
+        sw_queries = set(self.sw_info['queries'])
+        self.previous_partition = []
+        for cluster in previous_cpath.partitions[previous_cpath.i_best]:
+            cluster = [uid for uid in cluster if uid in sw_queries]  # queries that were removed from the input, or that failed sw this time (or were removed as duplicates)
+            self.previous_partition += utils.group_seqs_by_value(cluster, lambda q: self.sw_info[q]['cdr3_length'])  # bcrham needs each cluster to have a single cdr3 length (which isn't guaranteed if e.g. the germline set changed)
+        previous_uids = set([uid for cluster in self.previous_partition for uid in cluster])
+        self.incremental_uids = [q for q in self.sw_info['queries'] if q not in previous_uids]
+        print '  starting from %d clusters with %d sequences in --incremental-from %s, plus %d new sequences' % (len(self.previous_partition), len(previous_uids), self.args.incremental_from, len(self.incremental_uids))
+        with open(self.seed_uid_fname, 'w') as seedfile:
+            for uid in self.incremental_uids:
+                seedfile.write('%s\n' % uid)
+
     # ----------------------------------------------------------------------------------------
     def split_seeded_clusters(self, old_cpath):
         seeded_clusters, unseeded_clusters = utils.split_partition_with_criterion(old_cpath.partitions[old_cpath.i_best_minus_x], lambda cluster: self.args.seed_unique_id in cluster)
@@ -559,9 +642,15 @@ class PartitionDriver(object):
         last_n_procs = n_proc_list[-1]
         next_n_procs = last_n_procs
 
-        factor = 1.3
-        if self.shall_we_reduce_n_procs(last_n_procs, n_proc_list):
-            next_n_procs = int(next_n_procs / float(factor))
+        controller_n_procs = None
+        if self.n_proc_controller is not None:
+            controller_n_procs = self.n_proc_controller.choose_n_procs(n_proc_list, len(cpath.partitions[cpath.i_best_minus_x]))
+        if controller_n_procs is not None:
+            next_n_procs = controller_n_procs
+        else:
+            factor = 1.3
+            if self.shall_we_reduce_n_procs(last_n_procs, n_proc_list):
+                next_n_procs = int(next_n_procs / float(factor))
 
         def time_to_remove_some_seqs(n_proc_threshold):
             return len(n_proc_list) >= n_proc_threshold or next_n_procs == 1
@@ -665,7 +754,12 @@ class PartitionDriver(object):
     # ----------------------------------------------------------------------------------------
     def init_cpath(self, n_procs):
         initial_nseqs = len(self.sw_info['queries'])  # NOTE um, maybe I should change this to the number of clusters, now that we're doing some preclustering here?
-        initial_nsets = utils.collapse_naive_seqs(self.synth_sw_info(self.sw_info['queries']), split_by_cdr3=True, debug=True)
+        if self.previous_partition is None:
+            initial_nsets = utils.collapse_naive_seqs(self.synth_sw_info(self.sw_info['queries']), split_by_cdr3=True, debug=True)
+        else:  # start from the --incremental-from partition, with only the new queries collapsed (any of them with the same naive seq as an existing cluster will get merged in the first step)
+            initial_nsets = copy.deepcopy(self.previous_partition)
+            if len(self.incremental_uids) > 0:
+                initial_nsets += utils.collapse_naive_seqs(self.synth_sw_info(self.incremental_uids), split_by_cdr3=True, debug=True)
         cpath = ClusterPath(seed_unique_id=self.args.seed_unique_id)
         cpath.add_partition(initial_nsets, logprob=0., n_procs=n_procs)  # NOTE sw info excludes failed sequences (and maybe also sequences with different cdr3 length)
         os.makedirs(self.cpath_progress_dir)
@@ -723,13 +817,19 @@ class PartitionDriver(object):
         tmpstart = time.time()
         n_procs = self.args.n_procs
         cpath, initial_nseqs = self.init_cpath(n_procs)
+        if self.incremental_uids is not None and len(self.incremental_uids) == 0:
+            print '  no new sequences, so keeping the --incremental-from partition'
+            return cpath
         n_proc_list = []
         self.istep = 0
         start = time.time()
         while n_procs > 0:
-            print '%d clusters with %d proc%s' % (len(cpath.partitions[cpath.i_best_minus_x]), n_procs, utils.plural(n_procs))  # NOTE that a.t.m. i_best and i_best_minus_x are usually the same, since we're usually not calculating log probs of partitions (well, we're trying to avoid calculating any extra log probs, which means we usually don't know the log prob of the entire partition)
+            n_clusters_before = len(cpath.partitions[cpath.i_best_minus_x])
+            print '%d clusters with %d proc%s' % (n_clusters_before, n_procs, utils.plural(n_procs))  # NOTE that a.t.m. i_best and i_best_minus_x are usually the same, since we're usually not calculating log probs of partitions (well, we're trying to avoid calculating any extra log probs, which means we usually don't know the log prob of the entire partition)
             cpath, _, _ = self.run_hmm('forward', self.sub_param_dir, n_procs=n_procs, partition=cpath.partitions[cpath.i_best_minus_x], shuffle_input=True)  # note that this annihilates the old <cpath>, which is a memory optimization (but we write all of them to the cpath progress dir)
             n_proc_list.append(n_procs)
+            if self.n_proc_controller is not None:
+                self.n_proc_controller.add_step(n_procs, n_clusters_before, len(cpath.partitions[cpath.i_best_minus_x]), self.bcrham_proc_info, self.timing_info[-1])
             if self.are_we_finished_clustering(n_procs, cpath):
                 break
             n_procs, cpath = self.prepare_next_iteration(n_proc_list, cpath, initial_nseqs)
@@ -740,6 +840,8 @@ class PartitionDriver(object):
             self.merge_shared_clusters(cpath)
 
         cpath = self.merge_cpaths_from_previous_steps(cpath)
+        if self.n_proc_controller is not None and self.args.adaptive_n_procs_log_fname is not None:
+            self.n_proc_controller.write_log(self.args.adaptive_n_procs_log_fname)
 
         print '      loop time: %.1f' % (time.time()-start)
         return cpath
@@ -852,16 +954,12 @@ class PartitionDriver(object):
         # would be nice to merge this with self.read_hmm_cachefile()
         expected_queries = self.sw_info['queries'] if queries is None else queries
         cached_naive_seqs = {}
-        with open(self.hmm_cachefname) as cachefile:
-            reader = csv.DictReader(cachefile)
-            for line in reader:
-                if ':' in line['unique_ids']:  # if it's a cache file left over from a previous partitioning, there'll be clusters in it, too
-                    continue
-                if line['unique_ids'] not in expected_queries:  # probably can only happen if self.args.persistent_cachefname is set
-                    continue
-                cached_naive_seqs[line['unique_ids']] = line['naive_seq']
-                if len(cached_naive_seqs) == len(expected_queries):  # already got everybody
-                    break
+        cachefile = hmmcachefile.HmmCacheFile(self.hmm_cachefname)
+        for uid in expected_queries:  # look up each one in the index, rather than reading the whole file (which, e.g. if self.args.persistent_cachefname is set, can have lots of clusters and queries we don't care about)
+            line = cachefile.get(uid)
+            if line is not None and line['naive_seq'] != '':
+                cached_naive_seqs[uid] = line['naive_seq']
+        cachefile.close()
 
         if set(cached_naive_seqs) != set(expected_queries):  # can happen if hmm can't find a path for a sequence for which sw *did* have an annotation (but in that case the annotation is almost certainly garbage)
             extra = set(cached_naive_seqs) - set(expected_queries)
@@ -962,7 +1060,7 @@ class PartitionDriver(object):
         cmd_str += ' --outfile ' + csv_outfname
         cmd_str += ' --locus ' + self.args.locus
         cmd_str += ' --random-seed ' + str(self.args.seed)
-        if n_procs > 1:  # only cache vals for sequence sets with newly-calculated vals (initial cache file is copied to each subdir)
+        if n_procs > 1:  # only cache vals for sequence sets with newly-calculated vals (all procs read the same initial cache file) NOTE bcrham always does this for binary cache files
             cmd_str += ' --only-cache-new-vals'
 
         if self.args.dont_rescale_emissions:
@@ -970,9 +1068,14 @@ class PartitionDriver(object):
         if self.current_action == 'partition':
             if self.args.cache_naive_hfracs:
                 cmd_str += ' --cache-naive-hfracs'
-            if os.path.exists(self.hmm_cachefname):
-                cmd_str += ' --input-cachefname ' + self.hmm_cachefname
-            cmd_str += ' --output-cachefname ' + self.hmm_cachefname
+            if self.args.n_bcrham_threads > 1:
+                cmd_str += ' --n-threads ' + str(self.args.n_bcrham_threads)
+            if self.hmm_cache_server is not None:
+                cmd_str += ' --cache-server-socket ' + self.hmm_cache_server.socket_path
+            else:
+                if os.path.exists(self.hmm_cachefname):
+                    cmd_str += ' --input-cachefname ' + self.hmm_cachefname
+                cmd_str += ' --output-cachefname ' + self.hmm_cachefname
             if precache_all_naive_seqs:
                 cmd_str += ' --cache-naive-seqs'
             else:  # actually partitioning
@@ -993,6 +1096,8 @@ class PartitionDriver(object):
 
                 if self.args.seed_unique_id is not None and self.unseeded_seqs is None:  # if we're in the last few cycles (i.e. we've removed unseeded clusters) we want bcrham to not know about the seed (this gives more accurate clustering 'cause we're really doing hierarchical agglomeration)
                     cmd_str += ' --seed-unique-id ' + self.args.seed_unique_id
+                elif self.incremental_uids is not None:  # the clusters in the previous partition already had their chance to merge with each other, so we only look at merges involving new queries
+                    cmd_str += ' --seed-unique-id-fname ' + self.seed_uid_fname
 
                 if n_procs == 1:
                     if self.args.n_final_clusters is not None:
@@ -1042,10 +1147,11 @@ class PartitionDriver(object):
             print '             min-max time:  %.1f - %.1f sec' % (summaryfo['time']['bcrham'][0], summaryfo['time']['bcrham'][1])
 
     # ----------------------------------------------------------------------------------------
-    def check_wait_times(self, wait_time):
+    def check_wait_times(self, wait_time, proc_times):  # <proc_times> is the list of per-proc wall/cpu times from utils.run_cmds()
         max_bcrham_time = max([procinfo['time']['bcrham'] for procinfo in self.bcrham_proc_info])
         if max_bcrham_time > 0. and wait_time / max_bcrham_time > 1.5 and wait_time > 30.:  # if we were waiting for a lot longer than the slowest process took, and if it took long enough for us to care
             print '    spent much longer waiting for bcrham (%.1fs) than bcrham reported taking (max per-proc time %.1fs)' % (wait_time, max_bcrham_time)
+            print '        per-proc wall time: %.1f to %.1fs   cpu time: %.1f to %.1fs' % (min(tfo['wall'] for tfo in proc_times), max(tfo['wall'] for tfo in proc_times), min(tfo['cpu'] for tfo in proc_times), max(tfo['cpu'] for tfo in proc_times))
 
     # ----------------------------------------------------------------------------------------
     def execute(self, cmd_str, n_procs):
@@ -1056,7 +1162,7 @@ class PartitionDriver(object):
         def get_cmd_str(iproc):  # all this does at this point is replace workdir with sub-workdir in hmm input, output, and cache file arguments
             strlist = cmd_str.split()
             for istr in range(len(strlist)):
-                if strlist[istr] == self.hmm_infname or strlist[istr] == self.hmm_cachefname or strlist[istr] == self.hmm_outfname:
+                if strlist[istr] == self.hmm_infname or strlist[istr] == self.hmm_outfname or (strlist[istr] == self.hmm_cachefname and strlist[istr - 1] == '--output-cachefname'):  # all procs read the main (binary) cache file, but each writes its new info to its own file
                     strlist[istr] = strlist[istr].replace(self.args.workdir, self.subworkdir(iproc, n_procs))
             return ' '.join(strlist)
 
@@ -1070,17 +1176,18 @@ class PartitionDriver(object):
                    'outfname' : get_outfname(iproc),
                    'dbgfo' : self.bcrham_proc_info[iproc]}
                   for iproc in range(n_procs)]
-        utils.run_cmds(cmdfos, batch_system=self.args.batch_system, batch_options=self.args.batch_options, batch_config_fname=self.args.batch_config_fname, debug='print' if self.args.debug else None)
+        proc_times = utils.run_cmds(cmdfos, batch_system=self.args.batch_system, batch_options=self.args.batch_options, batch_config_fname=self.args.batch_config_fname, debug='print' if self.args.debug else None)
         self.print_partition_dbgfo()
 
-        self.check_wait_times(time.time()-start)
+        self.check_wait_times(time.time()-start, proc_times)
         sys.stdout.flush()
 
     # ----------------------------------------------------------------------------------------
-    def run_hmm(self, algorithm, parameter_in_dir, parameter_out_dir='', count_parameters=False, n_procs=None, precache_all_naive_seqs=False, partition=None, shuffle_input=False, read_output=True):
+    def run_hmm(self, algorithm, parameter_in_dir, parameter_out_dir='', count_parameters=False, n_procs=None, precache_all_naive_seqs=False, partition=None, shuffle_input=False, read_output=True, stream_fcn=None):
         """ 
         Run bcrham, possibly with many processes, and parse and interpret the output.
         NOTE the local <n_procs>, which overrides the one from <self.args>
+        If <stream_fcn> is set, the annotations are passed to it as they're read, rather than returned (see read_annotation_output()).
         """
         start = time.time()
         if len(self.sw_info['queries']) == 0:
@@ -1090,13 +1197,17 @@ class PartitionDriver(object):
         if n_procs is None:
             n_procs = self.args.n_procs
 
-        self.prepare_for_hmm(algorithm, parameter_in_dir, partition, shuffle_input=shuffle_input)
+        input_lines = self.prepare_for_hmm(algorithm, parameter_in_dir, partition, shuffle_input=shuffle_input)
         glutils.write_glfo(self.my_gldir, self.glfo)
+        if self.current_action == 'partition' and self.args.hmm_cache_server and self.args.batch_system is None and self.hmm_cache_server is None:  # unix socket, so only works on this machine
+            self.hmm_cache_server = HmmCacheServer(self.hmm_cachefname, self.args.workdir)
 
         cmd_str = self.get_hmm_cmd_str(algorithm, self.hmm_infname, self.hmm_outfname, parameter_dir=parameter_in_dir, precache_all_naive_seqs=precache_all_naive_seqs, n_procs=n_procs)
 
         if n_procs > 1:
-            self.split_input(n_procs, self.hmm_infname)
+            self.split_input(n_procs, input_lines)
+        else:
+            self.write_hmm_input_file(self.hmm_infname, input_lines)
 
         exec_start = time.time()
         self.execute(cmd_str, n_procs)
@@ -1112,7 +1223,7 @@ class PartitionDriver(object):
                     cpath.write(self.get_cpath_progress_fname(self.istep), self.args.is_data, reco_info=self.reco_info, true_partition=utils.get_true_partition(self.reco_info) if not self.args.is_data else None)
 
             if algorithm == 'viterbi' and not precache_all_naive_seqs:
-                annotations, hmm_failures = self.read_annotation_output(self.hmm_outfname, count_parameters=count_parameters, parameter_out_dir=parameter_out_dir, print_annotations=self.args.debug)
+                annotations, hmm_failures = self.read_annotation_output(self.hmm_outfname, count_parameters=count_parameters, parameter_out_dir=parameter_out_dir, print_annotations=self.args.debug, stream_fcn=stream_fcn)
 
             if os.path.exists(self.hmm_infname):
                 os.remove(self.hmm_infname)
@@ -1129,13 +1240,9 @@ class PartitionDriver(object):
     def read_hmm_cachefile(self):
         # would be nice to merge this with self.get_cached_hmm_naive_seqs()
         cachefo = {}
-        if not os.path.exists(self.hmm_cachefname):
-            return cachefo
-        with open(self.hmm_cachefname) as cachefile:
-            reader = csv.DictReader(cachefile)
-            for line in reader:
-                utils.process_input_line(line)
-                cachefo[':'.join(line['unique_ids'])] = line
+        for line in hmmcachefile.read_cachefile(self.hmm_cachefname).values():  # returns empty dict if it doesn't exist
+            utils.process_input_line(line)
+            cachefo[':'.join(line['unique_ids'])] = line
         return cachefo
 
     # ----------------------------------------------------------------------------------------
@@ -1326,76 +1433,76 @@ class PartitionDriver(object):
         return self.sw_info[qry]['padlefts'][0] * utils.ambiguous_bases[0] + self.reco_info[qry]['naive_seq'] + self.sw_info[qry]['padrights'][0] * utils.ambiguous_bases[0]
 
     # ----------------------------------------------------------------------------------------
-    def split_input(self, n_procs, infname):
+    def split_input(self, n_procs, input_lines):  # write the bcrham input lines from prepare_for_hmm() to a separate input file for each proc
 
         # should we pull out the seeded clusters, and carefully re-inject them into each process?
         separate_seeded_clusters = self.current_action == 'partition' and self.args.seed_unique_id is not None and self.unseeded_seqs is None  # I think it's no longer possible to have seed_unique_id set if we're not partitioning, but I'll leave it just to be safe (otherwise we get the seed seq sent to every process)
 
-        # read single input file
         info = []
         seeded_clusters = {}
-        with open(infname, 'r') as infile:
-            reader = csv.DictReader(infile, delimiter=' ')
-            for line in reader:
-                if separate_seeded_clusters and self.args.seed_unique_id in set(line['names'].split(':')):
-                    if len(seeded_clusters) > 0 and ':' not in line['names']:  # the first time through, we add the seed uid to *every* process. So, when we read those results back in, the procs that didn't merge the seed with anybody will have it as a singleton still, and we only need the singleton once
-                        continue
-                    seeded_clusters[line['names']] = line
-                    continue  # don't want the seeded clusters mixed in with the non-seeded clusters just yet (see below)
-                info.append(line)
+        for line in input_lines:
+            if separate_seeded_clusters and self.args.seed_unique_id in set(line['names'].split(':')):
+                if len(seeded_clusters) > 0 and ':' not in line['names']:  # the first time through, we add the seed uid to *every* process. So, when we read those results back in, the procs that didn't merge the seed with anybody will have it as a singleton still, and we only need the singleton once
+                    continue
+                seeded_clusters[line['names']] = line
+                continue  # don't want the seeded clusters mixed in with the non-seeded clusters just yet (see below)
+            info.append(line)
 
         # find the smallest seeded cluster
         if separate_seeded_clusters:
             if len(seeded_clusters) == 0:
-                raise Exception('couldn\'t find info for seed query %s in %s' % (self.args.seed_unique_id, infname))
+                raise Exception('couldn\'t find info for seed query %s in hmm input' % self.args.seed_unique_id)
             smallest_seed_cluster_str = None
             for unique_id_str in seeded_clusters:
                 if smallest_seed_cluster_str is None or len(unique_id_str.split(':')) < len(smallest_seed_cluster_str.split(':')):
                     smallest_seed_cluster_str = unique_id_str
 
-        # ----------------------------------------------------------------------------------------
-        def get_sub_outfile(siproc, mode):
-            return open(self.subworkdir(siproc, n_procs) + '/' + os.path.basename(infname), mode)
-        def get_writer(sub_outfile):
-            return csv.DictWriter(sub_outfile, reader.fieldnames, delimiter=' ')
-        def copy_cache_files(n_procs):
-            cmdfos = [{'cmd_str' : 'cp ' + self.hmm_cachefname + ' ' + self.subworkdir(iproc, n_procs) + '/',
-                       'workdir' : self.subworkdir(iproc, n_procs),
-                       'outfname' : self.subworkdir(iproc, n_procs) + '/' + os.path.basename(self.hmm_cachefname)}
-                      for iproc in range(n_procs)]
-            utils.run_cmds(cmdfos)
-
-        # initialize output/cache files
-        for iproc in range(n_procs):
-            utils.prep_dir(self.subworkdir(iproc, n_procs))
-            sub_outfile = get_sub_outfile(iproc, 'w')
-            get_writer(sub_outfile).writeheader()
-            sub_outfile.close()  # can't leave 'em all open the whole time 'cause python has the thoroughly unreasonable idea that one oughtn't to have thousands of files open at once
-        if self.current_action == 'partition' and os.path.exists(self.hmm_cachefname):  # copy cachefile to this subdir (first clause is just for so when we're getting cluster annotations we don't copy over the cache files)
-            copy_cache_files(n_procs)
-
         seed_clusters_to_write = seeded_clusters.keys()  # the keys in <seeded_clusters> that we still need to write
-        for iproc in range(n_procs):
-            sub_outfile = get_sub_outfile(iproc, 'a')
-            writer = get_writer(sub_outfile)
-
-            # first deal with the seeded clusters
+        proc_lines = [[] for _ in range(n_procs)]
+        for iproc in range(n_procs):  # first deal with the seeded clusters
             if separate_seeded_clusters:  # write the seed info line to each file
                 if len(seed_clusters_to_write) > 0:
                     if iproc < n_procs - 1:  # if we're not on the last proc, pop off and write the first one
-                        writer.writerow(seeded_clusters[seed_clusters_to_write.pop(0)])
+                        proc_lines[iproc].append(seeded_clusters[seed_clusters_to_write.pop(0)])
                     else:
                         while len(seed_clusters_to_write) > 0:  # keep adding 'em until we run out
-                            writer.writerow(seeded_clusters[seed_clusters_to_write.pop(0)])
+                            proc_lines[iproc].append(seeded_clusters[seed_clusters_to_write.pop(0)])
                 else:  # if we don't have any more that we *need* to write (i.e. that have other seqs in them), just write the shortest one (which will frequently be a singleton)
-                    writer.writerow(seeded_clusters[smallest_seed_cluster_str])
+                    proc_lines[iproc].append(seeded_clusters[smallest_seed_cluster_str])
+
+        # then the non-seeded clusters, with longest-processing-time-first bin packing: go through them from most to least expensive, giving each to the proc with the smallest total cost so far (we used to do round robin, i.e. info[iproc::n_procs], so a proc that got a few huge clusters would determine the wall time for the whole step)
+        costs = self.estimate_hmm_costs(info)
+        seeded_loads = [sum(self.estimate_hmm_costs(proc_lines[iproc])) for iproc in range(n_procs)]
+        proc_loads = [(seeded_loads[iproc], iproc) for iproc in range(n_procs)]  # heap of (total cost, iproc)
+        heapq.heapify(proc_loads)
+        assigned_ilines = [[] for _ in range(n_procs)]
+        for iline in sorted(range(len(info)), key=lambda i: costs[i], reverse=True):  # sort is stable (also with reverse), so clusters with the same cost stay in their (usually shuffled) input order, which for all-singleton steps makes this the same as round robin
+            load, iproc = heapq.heappop(proc_loads)
+            assigned_ilines[iproc].append(iline)
+            heapq.heappush(proc_loads, (load + costs[iline], iproc))
+        if self.args.debug and len(info) > 0:
+            mean_load = (sum(costs) + sum(seeded_loads)) / float(n_procs)
+            print '      split input with max/mean proc cost %.2f (round robin would have been %.2f)' % (max(l for l, _ in proc_loads) / mean_load, max(seeded_loads[iproc] + sum(costs[iproc::n_procs]) for iproc in range(n_procs)) / mean_load)
 
-            # then loop over the non-seeded clusters
-            for iquery in range(len(info)):
-                if iquery % n_procs != iproc:
-                    continue
-                writer.writerow(info[iquery])
-            sub_outfile.close()
+        for iproc in range(n_procs):
+            proc_lines[iproc] += [info[i] for i in sorted(assigned_ilines[iproc])]  # keep them in input order within each proc
+            utils.prep_dir(self.subworkdir(iproc, n_procs))
+            self.write_hmm_input_file(self.subworkdir(iproc, n_procs) + '/' + os.path.basename(self.hmm_infname), proc_lines[iproc])  # only one file open at a time, 'cause python has the thoroughly unreasonable idea that one oughtn't to have thousands of files open at once
+
+    # ----------------------------------------------------------------------------------------
+    def estimate_hmm_costs(self, input_lines):  # rough relative bcrham cost of each cluster in <input_lines> (for balancing procs in split_input())
+        cachefile = hmmcachefile.HmmCacheFile(self.hmm_cachefname) if self.current_action == 'partition' else None
+        costs = []
+        for line in input_lines:
+            cost = float(len(line['seqs']))  # forward/viterbi time goes roughly as number of seqs times sequence length, i.e. the total length of the (colon-separated) seqs
+            if cachefile is not None:
+                cacheline = cachefile.get(line['names'])
+                if cacheline is None or cacheline['logprob'] == '':  # bcrham has to calculate the cluster's own logprob, on top of the ones for its prospective merges (each of which costs about the same)
+                    cost *= 2
+            costs.append(cost)
+        if cachefile is not None:
+            cachefile.close()
+        return costs
 
     # ----------------------------------------------------------------------------------------
     def merge_subprocess_files(self, fname, n_procs, include_outfile=False):
@@ -1409,59 +1516,24 @@ class PartitionDriver(object):
     # ----------------------------------------------------------------------------------------
     def merge_files(self, infnames, outfname, dereplicate):
         """ 
-        Merge <infnames> into <outfname>.
-        NOTE that <outfname> is overwritten with the zero-length file if it exists, otherwise it is created.
-        Some of <infnames> may not exist.
+        Merge <infnames> into <outfname> (see utils.stream_merge_csvs()).
+        NOTE that if <outfname> isn't in <infnames>, it's overwritten (with the zero-length file if there's nothing to merge).
+        Some of <infnames> may not exist (or be zero length).
         """
-        # check_call(['wc', ] + [fn for fn in infnames if fn != outfname])
-        # if os.path.exists(outfname):
-        #     check_call(['wc', outfname])
-        # else:
-        #     print '  outfname d.n.e.'
-
-        header = ''
-        outfile = None
-        one_real_file = False
-        if outfname not in infnames or not os.path.exists(outfname):  # if it *is* in <infnames> we assume we can just tack the other infnames onto the end of it and use <outfname>'s header
-            outfile = open(outfname, 'w')
-        for fname in infnames:
-            if not os.path.exists(fname) or os.stat(fname).st_size == 0:
-                continue
-            one_real_file = True
-            with open(fname) as headfile:
-                reader = csv.DictReader(headfile)
-                header = ','.join(reader.fieldnames)
-                if outfile is not None:
-                    writer = csv.DictWriter(outfile, reader.fieldnames)
-                    writer.writeheader()
-            break  # kinda weird to do it this way, but we just need one of the infiles to get the header info (and some may be zero length)
-        if outfile is not None:
-            outfile.close()
-        if not one_real_file:
-            print '    nothing to merge into %s' % outfname
-            return
-
-        assert header != ''
-
         non_out_infnames = [fn for fn in infnames if fn != outfname]
         if len(non_out_infnames) == 0:
             raise Exception('merge_files() called with <infnames> consisting only of <outfname>')
-        cmd = 'cat ' + ' '.join(non_out_infnames) + ' | grep -v \'' + header + '\''
-        cmd += ' >>' + outfname
-        try:
-            check_call(cmd, shell=True)
-        except CalledProcessError:
-            print '    nothing to merge into %s' % outfname
-            # raise Exception('only read headers from %s', ' '.join([fn for fn in infnames if fn != outfname]))
 
-        if dereplicate:
-            tmpfname = outfname + '.tmp'
-            check_call('echo ' + header + ' >' + tmpfname, shell=True)
-            check_call('grep -v \'' + header + '\' ' + outfname + ' | sort | uniq >>' + tmpfname, shell=True)  # NOTE there can be multiple lines with the same uid string, but this is ok -- the c++ handles it
-            check_call(['mv', tmpfname, outfname])
+        real_infnames = [fn for fn in infnames if os.path.exists(fn) and os.stat(fn).st_size > 0]
+        if len(real_infnames) == 0:
+            print '    nothing to merge into %s' % outfname
+            if outfname not in infnames:
+                open(outfname, 'w').close()
+            return
+        utils.stream_merge_csvs(real_infnames, outfname, dereplicate=dereplicate)  # if <outfname> is in <infnames> but is zero length, this overwrites it
 
-        for infname in infnames:
-            if infname != outfname:
+        for infname in non_out_infnames:
+            if os.path.exists(infname):
                 os.remove(infname)
 
     # ----------------------------------------------------------------------------------------
@@ -1469,8 +1541,14 @@ class PartitionDriver(object):
         """ Merge any/all output files from subsidiary bcrham processes """
         cpath = None  # it would be nice to figure out a cleaner way to do this
         if self.current_action == 'partition':  # merge partitions from several files
-            if n_procs > 1:
-                self.merge_subprocess_files(self.hmm_cachefname, n_procs, include_outfile=True)  # sub cache files only have new info
+            if self.hmm_cache_server is not None:
+                self.hmm_cache_server.flush()  # the procs sent their new info to the server, so we just need to write it to the main cache file
+            elif n_procs > 1:
+                subfnames = [self.subworkdir(iproc, n_procs) + '/' + os.path.basename(self.hmm_cachefname) for iproc in range(n_procs)]
+                hmmcachefile.merge_cachefiles(subfnames, self.hmm_cachefname, append=True)  # sub cache files only have new info, which we add as one new segment at the end of the main cache file
+                for fname in subfnames:
+                    if os.path.exists(fname):
+                        os.remove(fname)
 
             if not precache_all_naive_seqs:
                 if n_procs == 1:
@@ -1603,22 +1681,22 @@ class PartitionDriver(object):
             return
 
         print '      caching fake true naive seqs'
-        with open(self.hmm_cachefname, 'w') as fakecachefile:
-            writer = csv.DictWriter(fakecachefile, utils.partition_cachefile_headers)
-            writer.writeheader()
-            for query_name_list in nsets:
-                writer.writerow({
-                    'unique_ids' : ':'.join([qn for qn in query_name_list]),
-                    'naive_seq' : self.get_padded_true_naive_seq(query_name_list[0])  # NOTE just using the first one... but a.t.m. I think I'll only run this fcn the first time through when they're all singletons, anyway
-                })
+        hmmcachefile.write_cachefile(self.hmm_cachefname, [{
+            'unique_ids' : ':'.join([qn for qn in query_name_list]),
+            'naive_seq' : self.get_padded_true_naive_seq(query_name_list[0])  # NOTE just using the first one... but a.t.m. I think I'll only run this fcn the first time through when they're all singletons, anyway
+        } for query_name_list in nsets])
 
     # ----------------------------------------------------------------------------------------
-    def write_to_single_input_file(self, fname, nsets, parameter_dir, shuffle_input=False):
-        csvfile = open(fname, 'w')
+    def write_hmm_input_file(self, fname, input_lines):
         header = ['names', 'k_v_min', 'k_v_max', 'k_d_min', 'k_d_max', 'mut_freq', 'cdr3_length', 'only_genes', 'seqs']
-        writer = csv.DictWriter(csvfile, header, delimiter=' ')
-        writer.writeheader()
+        with open(fname, 'w') as csvfile:
+            writer = csv.DictWriter(csvfile, header, delimiter=' ')
+            writer.writeheader()
+            for line in input_lines:
+                writer.writerow(line)
 
+    # ----------------------------------------------------------------------------------------
+    def get_hmm_input_lines(self, nsets, parameter_dir, shuffle_input=False):
         if shuffle_input:  # shuffle nset order (this is absolutely critical when clustering with more than one process, in order to redistribute sequences among the several processes)
             random.shuffle(nsets)
 
@@ -1636,11 +1714,12 @@ class PartitionDriver(object):
             print '    skipping matches from %d genes without enough counts: %s' % (len(glfo_genes - genes_with_enough_counts), utils.color_genes(glfo_genes - genes_with_enough_counts))
         available_genes = genes_with_hmm_files & genes_with_enough_counts
 
+        input_lines = []
         for query_name_list in nsets:  # NOTE in principle I think I should remove duplicate singleton <seed_unique_id>s here. But I think they in effect get removed 'cause in bcrham everything's stored as hash maps, so any duplicates just overwites the original upon reading its input
             combined_query = self.combine_queries(query_name_list, available_genes)
             if len(combined_query) == 0:  # didn't find all regions
                 continue
-            writer.writerow({
+            input_lines.append({
                 'names' : ':'.join([qn for qn in query_name_list]),
                 'k_v_min' : combined_query['k_v']['min'],
                 'k_v_max' : combined_query['k_v']['max'],
@@ -1652,12 +1731,12 @@ class PartitionDriver(object):
                 'seqs' : ':'.join(combined_query['seqs'])
             })
 
-        csvfile.close()
+        return input_lines
 
     # ----------------------------------------------------------------------------------------
     @utils.timeprinter
     def prepare_for_hmm(self, algorithm, parameter_dir, partition, shuffle_input=False):
-        """ Write input file for bcrham """
+        """ Get the input lines for bcrham (which get written to the input file[s] in run_hmm()) """
 
         if partition is not None:
             nsets = copy.deepcopy(partition)  # needs to be a deep copy so we can shuffle the order
@@ -1678,7 +1757,7 @@ class PartitionDriver(object):
             else:  # plain ol' singletons
                 nsets = [[q] for q in qlist]
 
-        self.write_to_single_input_file(self.hmm_infname, nsets, parameter_dir, shuffle_input=shuffle_input)  # single file gets split up later if we've got more than one process
+        return self.get_hmm_input_lines(nsets, parameter_dir, shuffle_input=shuffle_input)  # split up later if we've got more than one process (we used to write them to one file here, then read it back in to split it up)
 
     # ----------------------------------------------------------------------------------------
     def check_did_bcrham_fail(self, line, errorfo):
@@ -1790,9 +1869,9 @@ class PartitionDriver(object):
             utils.print_reco_event(after_line, extra_str='    ', label='after')
 
     # ----------------------------------------------------------------------------------------
-    def check_for_unexpectedly_missing_keys(self, annotations, hmm_failure_ids):
+    def check_for_unexpectedly_missing_keys(self, annotated_uids, hmm_failure_ids):
         missing_input_keys = set(self.input_info)
-        missing_input_keys -= set([uid for line in  annotations.values() for uid in line['unique_ids']])  # set(self.sw_info['queries'])  # all the queries for which we had decent sw annotations (sw failures are accounted for below)
+        missing_input_keys -= annotated_uids  # set(self.sw_info['queries'])  # all the queries for which we had decent sw annotations (sw failures are accounted for below)
         missing_input_keys -= self.sw_info['failed-queries']
         missing_input_keys -= self.sw_info['removed-queries']
         missing_input_keys -= set([d for dlist in self.sw_info['duplicates'].values() for d in dlist])
@@ -1807,8 +1886,11 @@ class PartitionDriver(object):
             print '  %s couldn\'t account for %d missing input uid%s%s' % (utils.color('red', 'warning'), len(missing_input_keys), utils.plural(len(missing_input_keys)), ': %s' % ' '.join(missing_input_keys) if len(missing_input_keys) < 15 else '')
 
     # ----------------------------------------------------------------------------------------
-    def read_annotation_output(self, annotation_fname, count_parameters=False, parameter_out_dir=None, print_annotations=False):
-        """ Read bcrham annotation output """
+    def read_annotation_output(self, annotation_fname, count_parameters=False, parameter_out_dir=None, print_annotations=False, stream_fcn=None):
+        """
+        Read bcrham annotation output.
+        If <stream_fcn> is set, instead of keeping all the annotations (and returning them) we pass a generator over them to <stream_fcn> (along with the set of failed uids, which is only complete once the generator is finished), so e.g. we can write them to the output file without ever having more than one in memory.
+        """
         def check_invalid(line, hmm_failures):
             if line['invalid']:
                 counts['n_invalid_events'] += 1
@@ -1827,85 +1909,109 @@ class PartitionDriver(object):
         perfplotter = PerformancePlotter('hmm') if self.args.plot_annotation_performance else None
 
         counts = {n : 0 for n in ['n_lines_read', 'n_seqs_processed', 'n_events_processed', 'n_invalid_events']}
-        eroded_annotations, padded_annotations = OrderedDict(), OrderedDict()
+        padded_uidstrs = set()  # just for the warning about reading the same uids twice
+        annotated_uids = set()
         hmm_failures = set()  # hm, does this duplicate info I'm already keeping track of in one of these other variables?
         errorfo = {}
-        with open(annotation_fname, 'r') as hmm_csv_outfile:
-            reader = csv.DictReader(hmm_csv_outfile)
-            for padded_line in reader:  # line coming from hmm output is N-padded such that all the seqs are the same length
 
-                utils.process_input_line(padded_line)
-                counts['n_lines_read'] += 1
+        # ----------------------------------------------------------------------------------------
+        def annotation_lines():  # generator over (uidstr, annotation) for each annotation that we're going to use (eroded or padded, depending on --mimic-data-read-length)
+            with open(annotation_fname, 'r') as hmm_csv_outfile:
+                reader = csv.DictReader(hmm_csv_outfile)
+                for padded_line in reader:  # line coming from hmm output is N-padded such that all the seqs are the same length
 
-                failed = self.check_did_bcrham_fail(padded_line, errorfo)
-                if failed:
-                    hmm_failures |= set(padded_line['unique_ids'])  # NOTE adds the ids individually (will have to be updated if we start accepting multi-seq input file)
-                    continue
+                    utils.process_input_line(padded_line)
+                    counts['n_lines_read'] += 1
 
-                uids = padded_line['unique_ids']
-                uidstr = ':'.join(uids)
-
-                padded_line['indelfos'] = [self.sw_info['indels'].get(uid, indelutils.get_empty_indel()) for uid in uids]  # reminder: hmm was given a sequence with any indels reversed (i.e. <self.sw_info['indels'][uid]['reverersed_seq']>)
-                padded_line['input_seqs'] = [self.sw_info[uid]['input_seqs'][0] for uid in uids]  # not in <padded_line>, since the hmm doesn't know anything about the input (i.e. non-indel-reversed) sequences
-                padded_line['duplicates'] = [self.duplicates.get(uid, []) for uid in uids]
-                for lkey in [lk for lk in utils.input_metafile_keys.values() if lk in self.sw_info[uids[0]]]:  # if it's in one, it should be in all of them
-                    padded_line[lkey] = [self.sw_info[uid][lkey][0] for uid in uids]
-
-                if not utils.has_d_gene(self.args.locus):
-                    self.process_dummy_d_hack(padded_line)
-
-                # if self.args.correct_boundaries and len(padded_line['unique_ids']) > 1:  # this does a decent job of correcting the multi-hmm's tendency to overestimate insertion and deletion lengths, but it also removes a significant portion of the multi-hmm's advantage in naive hamming distance
-                #     self.correct_multi_hmm_boundaries(padded_line)
-
-                try:
-                    utils.add_implicit_info(self.glfo, padded_line, aligned_gl_seqs=self.aligned_gl_seqs, reset_indel_genes=True)
-                except:  # I really don't like just swallowing it, but it's crashing deep in the new[ish] indel code on an extraordinarily rare and I think super screwed up sequence, and I can't replicate it without running on the entire stupid huge sample
-                    exc_type, exc_value, exc_traceback = sys.exc_info()
-                    lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
-                    print '      %s implicit info adding failed for %s when reading hmm output (so adding to failed queries):' % (utils.color('red', 'warning'), uidstr)
-                    print utils.pad_lines(''.join(lines))
-                    hmm_failures |= set(padded_line['unique_ids'])  # NOTE adds the ids individually (will have to be updated if we start accepting multi-seq input file)
-                    continue
+                    failed = self.check_did_bcrham_fail(padded_line, errorfo)
+                    if failed:
+                        hmm_failures.update(padded_line['unique_ids'])  # NOTE adds the ids individually (will have to be updated if we start accepting multi-seq input file)
+                        continue
 
-                utils.process_per_gene_support(padded_line)  # switch per-gene support from log space to normalized probabilities
+                    uids = padded_line['unique_ids']
+                    uidstr = ':'.join(uids)
+
+                    padded_line['indelfos'] = [self.sw_info['indels'].get(uid, indelutils.get_empty_indel()) for uid in uids]  # reminder: hmm was given a sequence with any indels reversed (i.e. <self.sw_info['indels'][uid]['reverersed_seq']>)
+                    padded_line['input_seqs'] = [self.sw_info[uid]['input_seqs'][0] for uid in uids]  # not in <padded_line>, since the hmm doesn't know anything about the input (i.e. non-indel-reversed) sequences
+                    padded_line['duplicates'] = [self.duplicates.get(uid, []) for uid in uids]
+                    for lkey in [lk for lk in utils.input_metafile_keys.values() if lk in self.sw_info[uids[0]]]:  # if it's in one, it should be in all of them
+                        padded_line[lkey] = [self.sw_info[uid][lkey][0] for uid in uids]
+
+                    if not utils.has_d_gene(self.args.locus):
+                        self.process_dummy_d_hack(padded_line)
+
+                    # if self.args.correct_boundaries and len(padded_line['unique_ids']) > 1:  # this does a decent job of correcting the multi-hmm's tendency to overestimate insertion and deletion lengths, but it also removes a significant portion of the multi-hmm's advantage in naive hamming distance
+                    #     self.correct_multi_hmm_boundaries(padded_line)
+
+                    try:
+                        utils.add_implicit_info(self.glfo, padded_line, aligned_gl_seqs=self.aligned_gl_seqs, reset_indel_genes=True)
+                    except:  # I really don't like just swallowing it, but it's crashing deep in the new[ish] indel code on an extraordinarily rare and I think super screwed up sequence, and I can't replicate it without running on the entire stupid huge sample
+                        exc_type, exc_value, exc_traceback = sys.exc_info()
+                        lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
+                        print '      %s implicit info adding failed for %s when reading hmm output (so adding to failed queries):' % (utils.color('red', 'warning'), uidstr)
+                        print utils.pad_lines(''.join(lines))
+                        hmm_failures.update(padded_line['unique_ids'])  # NOTE adds the ids individually (will have to be updated if we start accepting multi-seq input file)
+                        continue
 
-                if check_invalid(padded_line, hmm_failures):
-                    continue
+                    utils.process_per_gene_support(padded_line)  # switch per-gene support from log space to normalized probabilities
 
-                if uidstr in padded_annotations:  # this shouldn't happen, but it's more an indicator that something else has gone wrong than that in and of itself it's catastrophic
-                    print '%s uidstr %s already read from file %s' % (utils.color('yellow', 'warning'), uidstr, annotation_fname)
-                padded_annotations[uidstr] = padded_line
-
-                line_to_use = padded_line
-                if self.args.mimic_data_read_length:  # used to do this by default as long as there weren't any multi-hmm lines, but now I've decided it's an unnecessary complication
-                    if len(uids) > 1:
-                        print '  %s can\'t mimic data read length on multi-hmm annotations, since we need the padding to make lengths compatible (at least, I think it will crash just below here if you try)' % utils.color('red', 'error')
-                    # get a new dict in which we have edited the sequences to swap Ns on either end (after removing fv and jf insertions) for v_5p and j_3p deletions
-                    eroded_line = utils.reset_effective_erosions_and_effective_insertions(self.glfo, padded_line, aligned_gl_seqs=self.aligned_gl_seqs)  #, padfo=self.sw_info)
-                    if check_invalid(eroded_line, hmm_failures):
-                        continue
-                    line_to_use = eroded_line
-                    eroded_annotations[uidstr] = eroded_line  # these only get used if there aren't any multi-seq lines, so it's ok that they don't all get added if there is a multi seq line
-
-                counts['n_events_processed'] += 1
-                counts['n_seqs_processed'] += len(uids)
-
-                if pcounter is not None:
-                    pcounter.increment(line_to_use)
-
-                if perfplotter is not None:
-                    messed_up = False  # this would be really nice to clean up
-                    for iseq in range(len(line_to_use['unique_ids'])):
-                        if indelutils.has_indels(self.reco_info[uids[iseq]]['indelfos'][0]) or indelutils.has_indels(line_to_use['indelfos'][iseq]):
-                            simlen = indelutils.net_length(self.reco_info[uids[iseq]]['indelfos'][0])
-                            inflen = indelutils.net_length(line_to_use['indelfos'][iseq])
-                            if simlen != inflen:  # see similar code in performanceplotter.py
-                                messed_up = True
-                                break
-                    if messed_up:
+                    if check_invalid(padded_line, hmm_failures):
                         continue
-                    for iseq in range(len(uids)):  # NOTE this counts rearrangement-level parameters once for every mature sequence, which is inconsistent with the pcounters... but I think might make more sense here?
-                        perfplotter.evaluate(self.reco_info[uids[iseq]], utils.synthesize_single_seq_line(line_to_use, iseq), simglfo=self.simglfo)
+
+                    if uidstr in padded_uidstrs:  # this shouldn't happen, but it's more an indicator that something else has gone wrong than that in and of itself it's catastrophic
+                        print '%s uidstr %s already read from file %s' % (utils.color('yellow', 'warning'), uidstr, annotation_fname)
+                    padded_uidstrs.add(uidstr)
+
+                    line_to_use = padded_line
+                    if self.args.mimic_data_read_length:  # used to do this by default as long as there weren't any multi-hmm lines, but now I've decided it's an unnecessary complication
+                        if len(uids) > 1:
+                            print '  %s can\'t mimic data read length on multi-hmm annotations, since we need the padding to make lengths compatible (at least, I think it will crash just below here if you try)' % utils.color('red', 'error')
+                        # get a new dict in which we have edited the sequences to swap Ns on either end (after removing fv and jf insertions) for v_5p and j_3p deletions
+                        eroded_line = utils.reset_effective_erosions_and_effective_insertions(self.glfo, padded_line, aligned_gl_seqs=self.aligned_gl_seqs)  #, padfo=self.sw_info)
+                        if check_invalid(eroded_line, hmm_failures):
+                            continue
+                        line_to_use = eroded_line
+
+                    yield uidstr, line_to_use
+
+                    counts['n_events_processed'] += 1
+                    counts['n_seqs_processed'] += len(uids)
+
+                    if pcounter is not None:
+                        pcounter.increment(line_to_use)
+
+                    if perfplotter is not None:
+                        messed_up = False  # this would be really nice to clean up
+                        for iseq in range(len(line_to_use['unique_ids'])):
+                            if indelutils.has_indels(self.reco_info[uids[iseq]]['indelfos'][0]) or indelutils.has_indels(line_to_use['indelfos'][iseq]):
+                                simlen = indelutils.net_length(self.reco_info[uids[iseq]]['indelfos'][0])
+                                inflen = indelutils.net_length(line_to_use['indelfos'][iseq])
+                                if simlen != inflen:  # see similar code in performanceplotter.py
+                                    messed_up = True
+                                    break
+                        if messed_up:
+                            continue
+                        for iseq in range(len(uids)):  # NOTE this counts rearrangement-level parameters once for every mature sequence, which is inconsistent with the pcounters... but I think might make more sense here?
+                            perfplotter.evaluate(self.reco_info[uids[iseq]], utils.synthesize_single_seq_line(line_to_use, iseq), simglfo=self.simglfo)
+
+        # ----------------------------------------------------------------------------------------
+        def streamed_lines():
+            for _, line in annotation_lines():
+                seqfileopener.add_input_metafo(self.input_info, [line])
+                annotated_uids.update(line['unique_ids'])
+                yield line
+
+        annotations_to_use = None
+        if stream_fcn is None:
+            annotations_to_use = OrderedDict()
+            for uidstr, line in annotation_lines():
+                annotations_to_use[uidstr] = line
+            seqfileopener.add_input_metafo(self.input_info, annotations_to_use.values())
+            annotated_uids |= set([uid for line in annotations_to_use.values() for uid in line['unique_ids']])
+        else:
+            if print_annotations or self.args.annotation_clustering is not None:
+                raise Exception('can\'t print annotations or do annotation clustering if we\'re streaming them')
+            stream_fcn(streamed_lines(), hmm_failures)
 
         if true_pcounter is not None:
             for uids in utils.get_true_partition(self.reco_info, ids=self.sw_info['queries']):  # NOTE this'll include queries that passed sw but failed the hmm... there aren't usually really any of those
@@ -1939,12 +2045,10 @@ class PartitionDriver(object):
             else:
                 print '          %s unknown ecode \'%s\': %s' % (utils.color('red', 'warning'), ecode, ' '.join(errorfo[ecode]))
 
-        annotations_to_use = eroded_annotations if self.args.mimic_data_read_length else padded_annotations
-        seqfileopener.add_input_metafo(self.input_info, annotations_to_use.values())
         if print_annotations:
             self.print_results(None, annotations_to_use)
 
-        self.check_for_unexpectedly_missing_keys(annotations_to_use, hmm_failures)  # NOTE not sure if it's really correct to use <annotations_to_use>, [maybe since <hmm_failures> has ones that failed the conversion to eroded line (and maybe other reasons)]
+        self.check_for_unexpectedly_missing_keys(annotated_uids, hmm_failures)  # NOTE not sure if it's really correct to use <annotations_to_use>, [maybe since <hmm_failures> has ones that failed the conversion to eroded line (and maybe other reasons)]
 
         # annotation (VJ CDR3) clustering
         if self.args.annotation_clustering is not None:
@@ -1985,9 +2089,11 @@ class PartitionDriver(object):
             outfile.close()
 
     # ----------------------------------------------------------------------------------------
-    def write_output(self, annotation_list, hmm_failures, cpath=None, dont_write_failed_queries=False, write_sw=False, outfname=None):
+    def write_output(self, annotation_list, hmm_failures, cpath=None, dont_write_failed_queries=False, write_sw=False, outfname=None, streaming=False):  # if <streaming> is set, <annotation_list> is a generator that's still adding to <hmm_failures> as it goes (see get_output_stream_fcn())
         if outfname is None:
             outfname = self.args.outfname
+        if streaming and (cpath is not None or write_sw or utils.getsuffix(outfname) != '.yaml'):
+            raise Exception('can only stream annotations to .yaml output without partitions')
 
         if write_sw:
             assert annotation_list is None
@@ -1995,7 +2101,10 @@ class PartitionDriver(object):
 
         failed_queries = None
         if not dont_write_failed_queries:  # write empty lines for seqs that failed either in sw or the hmm
-            failed_queries = [{'unique_ids' : [uid], 'invalid' : True, 'input_seqs' : self.input_info[uid]['seqs']} for uid in self.sw_info['failed-queries'] | hmm_failures]  # <uid> *needs* to be single-sequence (but there shouldn't really be any way for it to not be)
+            def failed_query_lines():  # if we're streaming, this doesn't run until the writer gets to the failed queries, which is after it's gone through <annotation_list> (so <hmm_failures> is complete)
+                for uid in self.sw_info['failed-queries'] | hmm_failures:
+                    yield {'unique_ids' : [uid], 'invalid' : True, 'input_seqs' : self.input_info[uid]['seqs']}  # <uid> *needs* to be single-sequence (but there shouldn't really be any way for it to not be)
+            failed_queries = failed_query_lines() if streaming else list(failed_query_lines())
 
         if self.args.presto_output:
             presto_annotation_fname = outfname
@@ -2023,6 +2132,8 @@ class PartitionDriver(object):
             annotation_fname = outfname if cpath is None else self.args.cluster_annotation_fname
             utils.write_annotations(annotation_fname, self.glfo, annotation_list, headers, failed_queries=failed_queries)
         elif utils.getsuffix(outfname) == '.yaml':
-            utils.write_annotations(outfname, self.glfo, annotation_list, headers, failed_queries=failed_queries, partition_lines=partition_lines, use_pyyaml=self.args.write_full_yaml_output)
+            utils.write_annotations(outfname, self.glfo, annotation_list, headers, failed_queries=failed_queries, partition_lines=partition_lines, use_pyyaml=self.args.write_full_yaml_output, write_index=self.args.write_output_index)
+        elif utils.getsuffix(outfname) == '.npz':
+            utils.write_annotations(outfname, self.glfo, annotation_list, headers, failed_queries=failed_queries, partition_lines=partition_lines)
         else:
             raise Exception('unhandled annotation file suffix %s' % outfname)
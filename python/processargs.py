@@ -140,6 +140,15 @@ def process(args):
             args.queries_to_include = [args.seed_unique_id] + args.queries_to_include  # may as well put it first, I guess (?)
     elif args.seed_seq is not None:
         args.seed_unique_id = 'seed-seq'
+    if args.incremental_from is not None:
+        if args.seed_unique_id is not None or args.seed_seq is not None or args.random_seed_seq:
+            raise Exception('can\'t use --incremental-from with seed partitioning')
+        if args.naive_vsearch or args.naive_swarm:
+            raise Exception('--incremental-from only works with (the default) bcrham partitioning')
+        if not os.path.exists(args.incremental_from):
+            raise Exception('--incremental-from file %s d.n.e.' % args.incremental_from)
+    if args.adaptive_n_procs_log_fname is not None and not args.adaptive_n_procs:
+        raise Exception('--adaptive-n-procs-log-fname doesn\'t do anything unless --adaptive-n-procs is set')
 
     if args.sw_debug is None:  # if not explicitly set, set equal to regular debug
         args.sw_debug = args.debug
@@ -212,12 +221,12 @@ def process(args):
             print '%s --batch-options contains \'-e\' or \'-o\', but we add these automatically since we need to be able to parse each job\'s stdout and stderr. You can control the directory under which they\'re written with --workdir (which is currently %s).' % (utils.color('red', 'warning'), args.workdir)
 
     if args.outfname is not None and not args.presto_output and not args.airr_output:
-        if utils.getsuffix(args.outfname) not in ['.csv', '.yaml']:
+        if utils.getsuffix(args.outfname) not in ['.csv', '.yaml', '.npz']:
             raise Exception('unhandled --outfname suffix %s' % utils.getsuffix(args.outfname))
-        if utils.getsuffix(args.outfname) != '.yaml':
+        if utils.getsuffix(args.outfname) == '.csv':
             print '  %s --outfname uses deprecated file format %s. This will still work fine, but the new default .yaml format is much cleaner, and includes annotations, partitions, and germline info in the same file.' % (utils.color('yellow', 'note:'), utils.getsuffix(args.outfname))
-        if args.action in ['view-annotations', 'view-partitions'] and utils.getsuffix(args.outfname) == '.yaml':
-            raise Exception('have to use \'view-output\' action to view .yaml output files')
+        if args.action in ['view-annotations', 'view-partitions'] and utils.getsuffix(args.outfname) in ['.yaml', '.npz']:
+            raise Exception('have to use \'view-output\' action to view %s output files' % utils.getsuffix(args.outfname))
 
     if args.presto_output:
         if args.outfname is None:
@@ -1,4 +1,3 @@
-import numpy
 import bz2
 import gzip
 import copy
@@ -14,6 +13,7 @@ import yaml
 import utils
 
 delimit_info = {'.csv' : ',', '.tsv' : '\t'}
+fastx_suffixes = ['.fa', '.fasta', '.fastx', '.fq', '.fastq']
 
 # ----------------------------------------------------------------------------------------
 def add_seed_seq(args, input_info, reco_info, is_data):
@@ -67,7 +67,7 @@ def add_input_metafo(input_info, annotation_list, debug=False):  # transfer inpu
         print '  transferred input meta info (%s) for %d sequences from input_info' % (', '.join('\'%s\'' % k for k in added_keys), len(added_uids))
 
 # ----------------------------------------------------------------------------------------
-def post_process(input_info, reco_info, args, infname, found_seed, is_data, iline):
+def post_process(input_info, reco_info, args, infname, found_seed, is_data, iline, n_sampled_from=None):
     if args is None:
         return
 
@@ -104,31 +104,27 @@ def post_process(input_info, reco_info, args, infname, found_seed, is_data, ilin
         args.seed_unique_id = random.choice(input_info.keys())
         print '    chose random seed unique id %s' % args.seed_unique_id
 
-    if args.n_random_queries is not None:
-        included_queries = set()  # only for dbg printing
-        uids_to_choose_from = input_info.keys()
-        if args.seed_unique_id is not None:
-            uids_to_choose_from.remove(args.seed_unique_id)
-            included_queries.add(args.seed_unique_id)
-        if args.queries_to_include is not None:
-            for uid in args.queries_to_include:
-                if args.seed_unique_id is not None and uid == args.seed_unique_id:
-                    continue
-                if uid not in uids_to_choose_from:
-                    raise Exception('couldn\'t find requested query %s in %s' % (uid, infname))
-                uids_to_choose_from.remove(uid)
-                included_queries.add(uid)
-        if args.n_random_queries >= len(input_info):
+    if args.n_random_queries is not None:  # the actual sampling happens while reading the file (in read_sequence_file()), here we just check that we got the ones we needed
+        included_queries = forced_queries(args)  # only for dbg printing
+        for uid in included_queries:
+            if uid not in input_info:
+                raise Exception('couldn\'t find requested query %s in %s' % (uid, infname))
+        n_removed = n_sampled_from - len(input_info)
+        if n_removed <= 0:
             print '  %s --n-random-queries %d >= number of queries read from %s (so just keeping everybody)' % (utils.color('yellow', 'warning'), args.n_random_queries, infname)
         else:
-            uids_to_remove = numpy.random.choice(uids_to_choose_from, len(input_info) - args.n_random_queries, replace=False)
-            for uid in uids_to_remove:
-                del input_info[uid]
-                if reco_info is not None:
-                    del reco_info[uid]
-            print '  --n-random-queries: keeping %d / %d sequences from input file (removed %d%s)' % (len(input_info), len(input_info) + len(uids_to_remove), len(uids_to_remove),
+            print '  --n-random-queries: keeping %d / %d sequences from input file (removed %d%s)' % (len(input_info), n_sampled_from, n_removed,
                                                                                                       (' and specifically kept %s' % ' '.join(included_queries)) if len(included_queries) > 0 else '')
 
+# ----------------------------------------------------------------------------------------
+def forced_queries(args):  # uids that --n-random-queries should always keep
+    fqueries = []
+    if args.seed_unique_id is not None:
+        fqueries.append(args.seed_unique_id)
+    if args.queries_to_include is not None:
+        fqueries += [u for u in args.queries_to_include if u not in fqueries]
+    return fqueries
+
 # ----------------------------------------------------------------------------------------
 def get_seqfile_info(x, is_data=False):
     raise Exception('renamed and changed returned vals (see below)')
@@ -138,11 +134,15 @@ def read_sequence_file(infname, is_data, n_max_queries=-1, args=None, simglfo=No
     # NOTE renamed this from get_seqfile_info() since I'm changing the return values, but I don't want to update the calls everywhere (e.g. in compareutils)
     yaml_glfo = None
     suffix = utils.getsuffix(infname)
+    if suffix in utils.compressed_suffixes:
+        suffix = utils.get_fastx_suffix(infname)
+        if suffix not in fastx_suffixes:
+            raise Exception('compressed input files (%s) are only supported for fasta and fastq, but got %s' % (' '.join(utils.compressed_suffixes), infname))
     if suffix in delimit_info:
         seqfile = open(infname)  # closes on function exit. no, this isn't the best way to do this
         reader = csv.DictReader(seqfile, delimiter=delimit_info[suffix])
-    elif suffix in ['.fa', '.fasta', '.fastx']:
-        reader = utils.read_fastx(infname, name_key='unique_ids', seq_key='input_seqs', add_info=False, sanitize=True, n_max_queries=n_max_queries,  # NOTE don't use istarstop kw arg here, 'cause it fucks with the istartstop treatment in the loop below
+    elif suffix in fastx_suffixes:
+        reader = utils.iter_fastx(infname, name_key='unique_ids', seq_key='input_seqs', add_info=False, sanitize=True, n_max_queries=n_max_queries,  # NOTE don't use istarstop kw arg here, 'cause it fucks with the istartstop treatment in the loop below
                                   queries=(args.queries if (args is not None and not args.abbreviate) else None))  # NOTE also can't filter on args.queries here if we're also translating
     elif suffix == '.yaml':
         yaml_glfo, reader, _ = utils.read_yaml_output(infname, n_max_queries=n_max_queries, synth_single_seqs=True, dont_add_implicit_info=True)  # not really sure that long term I want to synthesize single seq lines, but for backwards compatibility it's nice a.t.m.
@@ -161,6 +161,13 @@ def read_sequence_file(infname, is_data, n_max_queries=-1, args=None, simglfo=No
     potential_names, used_names = None, None  # for abbreviating
     iname = None  # line number -- used as sequence id if there isn't a name column in the file
     iline = -1
+    all_uids_read = set()  # with --n-random-queries this is a lot bigger than <input_info>, but it's only the uid strings
+    if args is not None and args.n_random_queries is not None:  # single-pass reservoir sampling, so we only ever keep --n-random-queries sequences in memory (plus their uids)
+        uids_to_always_keep = set(forced_queries(args))
+        n_to_sample = max(0, args.n_random_queries - len(uids_to_always_keep))  # forced queries count toward --n-random-queries
+        sampling_rng = random.Random(args.seed)
+        sampled_uids = []  # reservoir of uids (excluding <uids_to_always_keep>) that we're currently keeping
+        n_sampleable_seen = 0
     for line in reader:
         iline += 1
         if args is not None:
@@ -189,10 +196,10 @@ def read_sequence_file(infname, is_data, n_max_queries=-1, args=None, simglfo=No
         if len(line['unique_ids']) > 1:
             raise Exception('can\'t yet handle multi-seq csv input files')
         uid = line['unique_ids'][0]
-        if uid in input_info:
+        if uid in all_uids_read:
             new_uid = uid
             iid = 2
-            while new_uid in input_info:
+            while new_uid in all_uids_read:
                 new_uid = uid + '-' + str(iid)
                 iid += 1
             print '  %s uid %s already read from input file %s, so replacing with new uid %s' % (utils.color('yellow', 'warning'), uid, infname, new_uid)
@@ -212,30 +219,45 @@ def read_sequence_file(infname, is_data, n_max_queries=-1, args=None, simglfo=No
             if args.seed_unique_id is not None and uid == args.seed_unique_id:
                 found_seed = True
 
-        if uid in input_info:
+        if uid in all_uids_read:
             raise Exception('found uid \'%s\' twice in input file %s' % (uid, infname))
+        all_uids_read.add(uid)
 
         if any(c not in utils.alphabet for c in inseq):
             unexpected_chars = set([ch for ch in inseq if ch not in utils.alphabet])
             raise Exception('unexpected character%s %s (not among %s) in input sequence with id %s:\n  %s' % (utils.plural(len(unexpected_chars)), ', '.join([('\'%s\'' % ch) for ch in unexpected_chars]), utils.nukes + utils.ambiguous_bases, uid, inseq))
 
+        keep_this_one = True
+        if args is not None and args.n_random_queries is not None and uid not in uids_to_always_keep:
+            ires = utils.reservoir_index(n_sampleable_seen, n_to_sample, sampling_rng)
+            n_sampleable_seen += 1
+            keep_this_one = ires is not None
+            if keep_this_one and ires == len(sampled_uids):
+                sampled_uids.append(uid)
+            elif keep_this_one:  # kick out the one that was there (since it's an OrderedDict, and we only ever add the newest uid, <input_info> stays in file order)
+                del input_info[sampled_uids[ires]]
+                if reco_info is not None:
+                    del reco_info[sampled_uids[ires]]
+                sampled_uids[ires] = uid
+
         # da business
-        input_info[uid] = {'unique_ids' : [uid, ], 'seqs' : [inseq, ]}
+        if keep_this_one:
+            input_info[uid] = {'unique_ids' : [uid, ], 'seqs' : [inseq, ]}
 
-        if not is_data:
-            if 'v_gene' not in line:
-                raise Exception('simulation info not found in %s' % infname)
-            reco_info[uid] = copy.deepcopy(line)
-            if simglfo is not None:
-                utils.add_implicit_info(simglfo, reco_info[uid])
-            for line_key in utils.input_metafile_keys.values():
-                if line_key in reco_info[uid]:  # this is kind of weird to copy from sim info to input info, but it makes sense because affinity is really meta info (the only other place affinity could come from is --input-metafname below). Where i'm defining meta info more or less as any input info besides name and sequence (i think the distinction is only really important because we want to support fastas, which can't [shouldn't!] handle anything else))
-                    input_info[uid][line_key] = copy.deepcopy(reco_info[uid][line_key])  # note that the args.input_metafname stuff below should print a warning if you've also specified that (which you shouldn't, if it's simulation)
+            if not is_data:
+                if 'v_gene' not in line:
+                    raise Exception('simulation info not found in %s' % infname)
+                reco_info[uid] = copy.deepcopy(line)
+                if simglfo is not None:
+                    utils.add_implicit_info(simglfo, reco_info[uid])
+                for line_key in utils.input_metafile_keys.values():
+                    if line_key in reco_info[uid]:  # this is kind of weird to copy from sim info to input info, but it makes sense because affinity is really meta info (the only other place affinity could come from is --input-metafname below). Where i'm defining meta info more or less as any input info besides name and sequence (i think the distinction is only really important because we want to support fastas, which can't [shouldn't!] handle anything else))
+                        input_info[uid][line_key] = copy.deepcopy(reco_info[uid][line_key])  # note that the args.input_metafname stuff below should print a warning if you've also specified that (which you shouldn't, if it's simulation)
 
         n_queries_added += 1
         if n_max_queries > 0 and n_queries_added >= n_max_queries:
             if not quiet:  # just adding <quiet>, and too lazy to decide what other print statements it should effect, this is the only one I care about right now
-                print '  --n-max-queries: stopped after reading %d queries from input file' % len(input_info)
+                print '  --n-max-queries: stopped after reading %d queries from input file' % n_queries_added
             break
 
     if more_input_info is not None:  # if you use this on simulation, the extra queries that aren't in <reco_info> may end up breaking something down the line (but I don't imagine this really getting used on simulation)
@@ -244,9 +266,10 @@ def read_sequence_file(infname, is_data, n_max_queries=-1, args=None, simglfo=No
         if args is not None and args.seed_unique_id is not None and args.seed_unique_id in more_input_info:
             found_seed = True
         input_info.update(more_input_info)
+        all_uids_read |= set(more_input_info)
     if args is not None and args.input_metafname is not None:
         read_input_metafo(args.input_metafname, input_info.values(), debug=True)
-    post_process(input_info, reco_info, args, infname, found_seed, is_data, iline)
+    post_process(input_info, reco_info, args, infname, found_seed, is_data, iline, n_sampled_from=len(all_uids_read))
 
     if len(input_info) == 0:
         raise Exception('didn\'t read any sequences from %s' % infname)
@@ -0,0 +1,72 @@
+import os
+import json
+import hashlib
+import sqlite3
+
+import utils
+
+# ----------------------------------------------------------------------------------------
+class SWSequenceCache(object):
+    """
+    Per-sequence, content-addressed smith-waterman results, stored in an sqlite file.
+    Each entry is keyed on a hash of the (input) sequence, the germline set, and the sw-relevant arguments, so unlike the per-input-file sw cache it stays valid when you add sequences to (or remove them from) your input file.
+    """
+    version = 1  # increment this if you change what's stored, or how it's keyed (old entries then just become unreachable)
+    arg_keys = ['locus', 'gap_open_penalty', 'no_indel_gap_open_penalty', 'n_max_per_region', 'max_vj_mut_freq', 'skip_unproductive', 'no_sw_vsearch', 'is_data']  # anything in Waterer (or vsearch) that changes a single sequence's result (as opposed to stuff that happens in finalize(), which we rerun every time)
+
+    def __init__(self, fname, glfo, args):
+        self.fname = fname
+        if not os.path.exists(os.path.dirname(os.path.abspath(self.fname))):
+            os.makedirs(os.path.dirname(os.path.abspath(self.fname)))
+        self.db = sqlite3.connect(self.fname, timeout=300)  # long timeout since several partis processes may be writing to the same file
+        self.db.execute('CREATE TABLE IF NOT EXISTS swfo (key TEXT PRIMARY KEY, status TEXT NOT NULL, line TEXT)')  # <status> is 'passed', 'failed', or 'unproductive' (<line> is only set for 'passed')
+        self.db.commit()
+        self.base_hash = self.get_base_hash(glfo, args)
+
+    # ----------------------------------------------------------------------------------------
+    def get_base_hash(self, glfo, args):  # hash of everything except the sequence
+        hfo = hashlib.sha1()
+        hfo.update('v%d' % self.version)
+        for key in self.arg_keys:
+            hfo.update('%s:%s;' % (key, repr(getattr(args, key, None))))
+        hfo.update(glfo['locus'])
+        for region in utils.regions:
+            for gene in sorted(glfo['seqs'][region]):
+                hfo.update('%s:%s;' % (gene, glfo['seqs'][region][gene]))
+        for codon in utils.conserved_codons[glfo['locus']].values():
+            for gene in sorted(glfo[codon + '-positions']):
+                hfo.update('%s:%d;' % (gene, glfo[codon + '-positions'][gene]))
+        return hfo.hexdigest()
+
+    # ----------------------------------------------------------------------------------------
+    def key(self, seq):
+        return hashlib.sha1(self.base_hash + seq).hexdigest()
+
+    # ----------------------------------------------------------------------------------------
+    def read(self, seqs):  # <seqs>: dict from uid to input seq. Returns dict from uid to (status, line) for the ones we have, where <line> is still missing uid-specific info (see Waterer.read_seq_cache())
+        keys = {uid : self.key(seq) for uid, seq in seqs.items()}
+        uids_for_keys = {}
+        for uid, key in keys.items():
+            if key not in uids_for_keys:
+                uids_for_keys[key] = []
+            uids_for_keys[key].append(uid)
+        cachefo = {}
+        keylist = uids_for_keys.keys()
+        chunksize = 500  # sqlite has a limit on the number of variables in one statement
+        for ichunk in range(0, len(keylist), chunksize):
+            keychunk = keylist[ichunk : ichunk + chunksize]
+            query = 'SELECT key, status, line FROM swfo WHERE key IN (%s)' % ','.join('?' for _ in keychunk)
+            for key, status, linestr in self.db.execute(query, keychunk):
+                for uid in uids_for_keys[key]:
+                    cachefo[uid] = (str(status), json.loads(linestr) if linestr is not None else None)  # need a separate line for each uid, since the caller modifies them
+        return cachefo
+
+    # ----------------------------------------------------------------------------------------
+    def write(self, entries):  # <entries>: list of (seq, status, line), where <line> is None unless <status> is 'passed'
+        with self.db:  # one transaction for the whole lot
+            self.db.executemany('INSERT OR REPLACE INTO swfo (key, status, line) VALUES (?, ?, ?)',
+                                [(self.key(seq), status, None if line is None else json.dumps(utils.get_yamlfo_for_output(line, utils.sw_cache_headers))) for seq, status, line in entries])
+
+    # ----------------------------------------------------------------------------------------
+    def close(self):
+        self.db.close()
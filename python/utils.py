@@ -13,6 +13,9 @@ import itertools
 import ast
 import math
 import glob
+import gzip
+import bz2
+import io
 from collections import Counter
 from collections import OrderedDict
 import csv
@@ -24,6 +27,11 @@ import json
 import types
 import collections
 import operator
+import shutil
+import hashlib
+import threading
+import Queue
+import errno
 
 import indelutils
 import clusterpath
@@ -51,8 +59,9 @@ def timeprinter(fcn):
     def wrapper(*args, **kwargs):
         start = time.time()
         # print fcn.__name__,
-        fcn(*args, **kwargs)
+        retval = fcn(*args, **kwargs)
         print '    %s: (%.1f sec)' % (fcn.__name__, time.time()-start)
+        return retval
     return wrapper
 
 # ----------------------------------------------------------------------------------------
@@ -162,6 +171,7 @@ nukes = ['A', 'C', 'G', 'T']
 ambiguous_bases = ['N', ]
 alphabet = set(nukes + ambiguous_bases)  # NOTE not the greatest naming distinction, but note difference to <expected_characters>
 gap_chars = ['.', '-']
+compressed_suffixes = ['.gz', '.bz2']
 expected_characters = set(nukes + ambiguous_bases + gap_chars)  # NOTE not the greatest naming distinction, but note difference to <alphabet>
 conserved_codons = {l : {'v' : 'cyst',
                           'j' : 'tryp' if l == 'igh' else 'phen'}  # e.g. heavy chain has tryp, light chain has phen
@@ -340,7 +350,7 @@ extra_annotation_headers = [  # you can specify additional columns (that you wan
     'linearham-info',
 ] + list(implicit_linekeys)  # NOTE some of the ones in <implicit_linekeys> are already in <annotation_headers>
 sw_cache_headers = [h for h in annotation_headers if h not in linekeys['hmm']] + linekeys['sw']
-partition_cachefile_headers = ('unique_ids', 'logprob', 'naive_seq', 'naive_hfrac', 'errors')  # these have to match whatever bcrham is expecting (in packages/ham/src/glomerator.cc, ReadCacheFile() and WriteCacheFile())
+partition_cachefile_headers = ('unique_ids', 'logprob', 'naive_seq', 'naive_hfrac', 'errors')  # these have to match whatever bcrham is expecting (in packages/ham/src/glomerator.cc, ReadCacheFile() and WriteCacheFile(), and the binary format in hmmcachefile.py)
 bcrham_dbgstrs = {
     'partition' : {  # corresponds to stdout from glomerator.cc
         'read-cache' : ['logprobs', 'naive-seqs'],
@@ -355,8 +365,8 @@ bcrham_dbgstrs = {
 }
 bcrham_dbgstr_types = {
     'partition' : {
-        'sum' : ['calcd', 'merged'],  # for these ones, sum over all procs
-        'same' : ['read-cache', ],  # check that these are the same for all procs
+        'sum' : ['calcd', 'merged', 'read-cache'],  # for these ones, sum over all procs (bcrham only reads the cached info it needs for its own clusters, so this is the total over all procs)
+        'same' : [],  # check that these are the same for all procs
         'min-max' : ['time', ]
     },
     'annotate' : {  # strict subset of the 'partition' ones
@@ -1305,14 +1315,153 @@ def is_functional(line, iseq):  # NOTE code duplication with is_functional_dbg_s
     return True
 
 # ----------------------------------------------------------------------------------------
-def add_functional_info(locus, line, input_codon_positions):
+def get_functional_info(locus, line):  # returns a dict with values for <functional_columns> (so add_implicit_info() can either add them right away, or wait until they're needed)
     nseqs = len(line['seqs'])  # would normally use 'unique_ids', but this gets called during simulation before the point at which we choose the uids
-    line['mutated_invariants'] = [not both_codons_unmutated(locus, line['input_seqs'][iseq], input_codon_positions[iseq])
-                                  for iseq in range(nseqs)]
-    line['in_frames'] = [in_frame(line['input_seqs'][iseq], input_codon_positions[iseq], line['fv_insertion'], line['v_5p_del'])
-                         for iseq in range(nseqs)]
-    line['stops'] = [is_there_a_stop_codon(line['input_seqs'][iseq], line['fv_insertion'], line['jf_insertion'], line['v_5p_del'])
-                     for iseq in range(nseqs)]
+    input_codon_positions = [indelutils.get_codon_positions_with_indels_reinstated(line, iseq, line['codon_positions']) for iseq in range(nseqs)]
+    return {'mutated_invariants' : [not both_codons_unmutated(locus, line['input_seqs'][iseq], input_codon_positions[iseq]) for iseq in range(nseqs)],
+            'in_frames' : [in_frame(line['input_seqs'][iseq], input_codon_positions[iseq], line['fv_insertion'], line['v_5p_del']) for iseq in range(nseqs)],
+            'stops' : [is_there_a_stop_codon(line['input_seqs'][iseq], line['fv_insertion'], line['jf_insertion'], line['v_5p_del']) for iseq in range(nseqs)]}
+
+# ----------------------------------------------------------------------------------------
+def get_mutation_info(line):  # same idea as get_functional_info()
+    distances, lengths = hamming_to_many(line['naive_seq'], line['seqs'])
+    return {'mut_freqs' : packed_hfracs(distances, lengths).tolist(), 'n_mutations' : distances.tolist()}
+
+# ----------------------------------------------------------------------------------------
+lazy_implicit_key_groups = {  # implicit keys that add_implicit_info() can put off calculating until they're accessed (for ImplicitInfoLines): they're relatively slow, and don't affect the 'invalid' key
+    'functional' : functional_columns,
+    'mutations' : ['mut_freqs', 'n_mutations'],
+}
+
+# ----------------------------------------------------------------------------------------
+class ImplicitInfoLine(dict):
+    """
+    Annotation dict for which add_implicit_info() (with <lazy> set) doesn't calculate the keys in <lazy_implicit_key_groups> until they're first accessed (after which they're stored like any other key).
+    Keys that haven't been calculated yet act like they're there for single-key access (line[key], get(), in, del...) and key iteration (for key in line, keys(), len()), but anything that needs all the values (items(), values(), ==, copy, deepcopy, pickling) calculates them all first.
+    NOTE things that access the underlying dict directly (dict(line), otherdict.update(line), json.dumps(line)) won't see the uncalculated keys, so call fill_lazy_keys() before doing that.
+    """
+    def __init__(self, *args, **kwargs):
+        if len(args) > 0 and isinstance(args[0], ImplicitInfoLine):
+            args[0].fill_lazy_keys()
+        dict.__init__(self, *args, **kwargs)
+        self.lazy_keys = {}  # map from each key that we haven't calculated yet to the name of its group in <lazy_implicit_key_groups>
+        self.locus = None
+
+    def set_lazy_groups(self, locus, group_names):  # discards any existing values for the keys in these groups
+        self.locus = locus
+        for gname in group_names:
+            for key in lazy_implicit_key_groups[gname]:
+                dict.pop(self, key, None)
+                self.lazy_keys[key] = gname
+
+    def calculate_group(self, gname):
+        if gname == 'functional':
+            newvals = get_functional_info(self.locus, self)
+        elif gname == 'mutations':
+            newvals = get_mutation_info(self)
+        else:
+            raise Exception('unhandled lazy key group %s' % gname)
+        for key in [k for k, g in self.lazy_keys.items() if g == gname]:  # only set the ones that are still lazy (i.e. don't overwrite any that were set from outside in the meantime)
+            del self.lazy_keys[key]
+            dict.__setitem__(self, key, newvals[key])
+
+    def fill_lazy_keys(self):
+        for gname in set(self.lazy_keys.values()):
+            self.calculate_group(gname)
+
+    def __missing__(self, key):  # only gets called by dict.__getitem__() if <key> isn't in the underlying dict
+        if key not in self.lazy_keys:
+            raise KeyError(key)
+        self.calculate_group(self.lazy_keys[key])
+        return dict.__getitem__(self, key)
+
+    def __setitem__(self, key, val):
+        self.lazy_keys.pop(key, None)
+        dict.__setitem__(self, key, val)
+
+    def __delitem__(self, key):
+        if key in self.lazy_keys:
+            del self.lazy_keys[key]
+        else:
+            dict.__delitem__(self, key)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.lazy_keys
+
+    def has_key(self, key):
+        return key in self
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def pop(self, key, *args):
+        if key in self.lazy_keys:
+            self[key]
+        return dict.pop(self, key, *args)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        if len(args) > 0 and isinstance(args[0], ImplicitInfoLine):
+            args[0].fill_lazy_keys()
+        for key, val in dict(*args, **kwargs).items():
+            self[key] = val
+
+    def clear(self):
+        self.lazy_keys = {}
+        dict.clear(self)
+
+    def __iter__(self):
+        return itertools.chain(dict.__iter__(self), list(self.lazy_keys))
+
+    def iterkeys(self):
+        return iter(self)
+
+    def keys(self):
+        return list(self)
+
+    def __len__(self):
+        return dict.__len__(self) + len(self.lazy_keys)
+
+    def items(self):
+        self.fill_lazy_keys()
+        return dict.items(self)
+
+    def iteritems(self):
+        self.fill_lazy_keys()
+        return dict.iteritems(self)
+
+    def values(self):
+        self.fill_lazy_keys()
+        return dict.values(self)
+
+    def itervalues(self):
+        self.fill_lazy_keys()
+        return dict.itervalues(self)
+
+    def copy(self):
+        self.fill_lazy_keys()
+        return ImplicitInfoLine(dict.copy(self))
+
+    def __eq__(self, other):
+        self.fill_lazy_keys()
+        if isinstance(other, ImplicitInfoLine):
+            other.fill_lazy_keys()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        self.fill_lazy_keys()
+        return dict.__repr__(self)
+
+    def __reduce__(self):  # for copy, deepcopy, and pickle
+        self.fill_lazy_keys()
+        return (ImplicitInfoLine, (dict(self), ))
 
 # ----------------------------------------------------------------------------------------
 def remove_all_implicit_info(line):
@@ -1503,8 +1652,8 @@ def get_linearham_bounds(sw_info, line, vj_flexbounds_shift=10, debug=False):
     return {'flexbounds' : fbounds, 'relpos' : rpos}
 
 # ----------------------------------------------------------------------------------------
-def add_implicit_info(glfo, line, aligned_gl_seqs=None, check_line_keys=False, reset_indel_genes=False):  # should turn on <check_line_keys> for a bit if you change anything
-    """ Add to <line> a bunch of things that are initially only implicit. """
+def add_implicit_info(glfo, line, aligned_gl_seqs=None, check_line_keys=False, reset_indel_genes=False, lazy=False):  # should turn on <check_line_keys> for a bit if you change anything
+    """ Add to <line> a bunch of things that are initially only implicit. If <lazy> is set and <line> is an ImplicitInfoLine, wait to calculate the keys in <lazy_implicit_key_groups> until they're accessed. """
     if line['v_gene'] == '':
         raise Exception('can\'t add implicit info to line with failed annotation:\n%s' % (''.join(['  %+20s  %s\n' % (k, v) for k, v in line.items()])))
 
@@ -1567,18 +1716,17 @@ def add_implicit_info(glfo, line, aligned_gl_seqs=None, check_line_keys=False, r
         line['invalid'] = True
         return
 
-    input_codon_positions = [indelutils.get_codon_positions_with_indels_reinstated(line, iseq, line['codon_positions']) for iseq in range(len(line['seqs']))]
     if 'indel_reversed_seqs' not in line:  # everywhere internally, we refer to 'indel_reversed_seqs' as simply 'seqs'. For interaction with outside entities, however (i.e. writing files) we use the more explicit 'indel_reversed_seqs'
         line['indel_reversed_seqs'] = line['seqs']
 
     # add regional query seqs
     add_qr_seqs(line)
 
-    add_functional_info(glfo['locus'], line, input_codon_positions)
-
-    hfracfo = [hamming_fraction(line['naive_seq'], mature_seq, also_return_distance=True) for mature_seq in line['seqs']]
-    line['mut_freqs'] = [hfrac for hfrac, _ in hfracfo]
-    line['n_mutations'] = [n_mutations for _, n_mutations in hfracfo]
+    if lazy and isinstance(line, ImplicitInfoLine):
+        line.set_lazy_groups(glfo['locus'], lazy_implicit_key_groups)
+    else:
+        line.update(get_functional_info(glfo['locus'], line))
+        line.update(get_mutation_info(line))
 
     # set validity (alignment addition [below] can also set invalid)  # it would be nice to clean up this checking stuff
     line['invalid'] = False
@@ -2056,6 +2204,111 @@ def hamming_fraction(seq1, seq2, extra_bases=None, also_return_distance=False):
     else:
         return fraction
 
+# ----------------------------------------------------------------------------------------
+# 2-bit packed nucleotide sequences, so we can calculate lots of hamming distances at once with numpy (it's the same encoding that bcrham uses for its naive hfracs)
+#  - four bases per uint8: each base gets two bits with its index in <nukes>, and the low bit of its slot in the mask is set if it's *not* ambiguous (or a gap)
+#  - as in hamming_distance(), positions at which either sequence is ambiguous are skipped
+packed_nuke_codes = numpy.zeros(256, dtype=numpy.uint8)
+packed_nuke_codes[[ord(n) for n in nukes]] = range(len(nukes))
+packed_valid_codes = numpy.zeros(256, dtype=numpy.uint8)
+packed_valid_codes[[ord(n) for n in nukes]] = 1
+packed_allowed_chars = ''.join(nukes + ambiguous_bases + gap_chars)
+popcount_table = numpy.array([bin(i).count('1') for i in range(256)], dtype=numpy.uint8)
+min_packed_seqs = 3  # below this many seqs, hamming_to_many() uses the scalar hamming_distance(), since the packing overhead is bigger than what it saves (e.g. single-sequence sw annotations are about twice as fast with hamming_distance())
+
+def unpackable_chars(seqstr):
+    """ return set of characters in <seqstr> (all the seqs joined together) that can't be represented in the packed encoding """
+    return set(seqstr.translate(None, packed_allowed_chars))  # deletes the allowed characters in a single pass, so whatever's left is bad
+
+def pack_seqs(seqs, seqstr=None):
+    """ return (bits, mask) for the equal-length sequences in <seqs>, each a uint8 array of shape (len(seqs), ceil(seq length / 4)). If you've already joined <seqs> together (and checked for bad characters), pass it in as <seqstr>. """
+    seq_lengths = set(len(s) for s in seqs)
+    if len(seq_lengths) > 1:
+        raise Exception('unequal length sequences in pack_seqs(): %s' % ' '.join(str(l) for l in sorted(seq_lengths)))
+    seq_len = seq_lengths.pop() if len(seq_lengths) > 0 else 0
+    if seqstr is None:
+        seqstr = str(''.join(seqs))
+        bad_chars = unpackable_chars(seqstr)
+        if len(bad_chars) > 0:
+            raise Exception('unexpected characters in pack_seqs(): %s' % ' '.join(sorted(bad_chars)))
+    chars = numpy.frombuffer(seqstr, dtype=numpy.uint8).reshape(len(seqs), seq_len)
+    n_padded = 4 * int(math.ceil(seq_len / 4.))
+    codes = numpy.zeros((len(seqs), n_padded), dtype=numpy.uint8)  # padding positions have zero mask, so they're ignored
+    valid = numpy.zeros((len(seqs), n_padded), dtype=numpy.uint8)
+    codes[:, :seq_len] = packed_nuke_codes[chars]
+    valid[:, :seq_len] = packed_valid_codes[chars]
+    bits = numpy.zeros((len(seqs), n_padded / 4), dtype=numpy.uint8)
+    mask = numpy.zeros((len(seqs), n_padded / 4), dtype=numpy.uint8)
+    for ibase in range(4):
+        bits |= codes[:, ibase::4] << (2 * ibase)
+        mask |= valid[:, ibase::4] << (2 * ibase)
+    return bits, mask
+
+def packed_hamming_distances(bits_a, mask_a, bits_b, mask_b):
+    """ hamming distances and lengths excluding ambiguous positions between packed seq(s) a and b (numpy broadcasting rules apply, e.g. a single packed seq against many) """
+    valid = mask_a & mask_b
+    diff = bits_a ^ bits_b
+    diff = (diff | (diff >> 1)) & valid  # collapse each base's two bits onto its low bit, and only keep positions at which neither seq is ambiguous
+    return popcount_table[diff].sum(axis=-1, dtype=numpy.int64), popcount_table[valid].sum(axis=-1, dtype=numpy.int64)
+
+def packed_hfracs(distances, lengths):
+    """ convert distances and lengths excluding ambiguous positions into hamming fractions (zero where there's no non-ambiguous positions, like hamming_fraction()) """
+    hfracs = numpy.zeros(distances.shape, dtype=numpy.float64)
+    nonzero = lengths > 0
+    hfracs[nonzero] = distances[nonzero] / lengths[nonzero].astype(numpy.float64)
+    return hfracs
+
+# ----------------------------------------------------------------------------------------
+def hamming_matrix(seqs_a, seqs_b=None, max_chunk_bytes=2**26):
+    """
+    Return (distances, lengths excluding ambiguous positions) between each pair of sequences in <seqs_a> and <seqs_b> (or <seqs_a> with itself, if <seqs_b> isn't set), same conventions as hamming_distance().
+    Both are numpy arrays of shape (len(seqs_a), len(seqs_b)), with the smallest unsigned int type that fits the sequence length.
+    Rows are calculated in chunks, so the temporary arrays are never bigger than about <max_chunk_bytes>.
+    """
+    seqs_a = list(seqs_a)
+    seqs_b = seqs_a if seqs_b is None else list(seqs_b)
+    seq_len = max(len(s) for s in seqs_a + seqs_b) if len(seqs_a + seqs_b) > 0 else 0
+    distances = numpy.zeros((len(seqs_a), len(seqs_b)), dtype=numpy.min_scalar_type(seq_len))
+    lengths = numpy.zeros((len(seqs_a), len(seqs_b)), dtype=numpy.min_scalar_type(seq_len))
+    if len(seqs_a) == 0 or len(seqs_b) == 0:
+        return distances, lengths
+
+    seqstr_a = str(''.join(seqs_a))
+    seqstr_b = seqstr_a if seqs_b is seqs_a else str(''.join(seqs_b))
+    if len(unpackable_chars(seqstr_a)) > 0 or (seqs_b is not seqs_a and len(unpackable_chars(seqstr_b)) > 0):  # fall back to the slow way (this won't happen for anything that made it through seqfileopener)
+        for ia, seq_a in enumerate(seqs_a):
+            for ib, seq_b in enumerate(seqs_b):
+                distances[ia, ib], lengths[ia, ib] = hamming_distance(seq_a, seq_b, return_len_excluding_ambig=True)
+        return distances, lengths
+
+    if len(seqs_a[0]) != len(seqs_b[0]):  # pack_seqs() checks the lengths within each list
+        raise Exception('unequal length sequences in hamming_matrix(): %d %d' % (len(seqs_a[0]), len(seqs_b[0])))
+    bits_a, mask_a = pack_seqs(seqs_a, seqstr=seqstr_a)
+    bits_b, mask_b = (bits_a, mask_a) if seqs_b is seqs_a else pack_seqs(seqs_b, seqstr=seqstr_b)
+    n_rows_per_chunk = max(1, max_chunk_bytes / max(1, len(seqs_b) * bits_b.shape[1]))
+    for istart in range(0, len(seqs_a), n_rows_per_chunk):
+        istop = min(istart + n_rows_per_chunk, len(seqs_a))
+        chunk_distances, chunk_lengths = packed_hamming_distances(bits_a[istart : istop, numpy.newaxis, :], mask_a[istart : istop, numpy.newaxis, :], bits_b[numpy.newaxis, :, :], mask_b[numpy.newaxis, :, :])
+        distances[istart : istop] = chunk_distances
+        lengths[istart : istop] = chunk_lengths
+    return distances, lengths
+
+def hamming_to_many(seq, seqs):
+    """ return (distances, lengths excluding ambiguous positions) between <seq> and each sequence in <seqs>, as numpy arrays of length len(seqs) """
+    if len(seqs) < min_packed_seqs:
+        dists_and_lengths = [hamming_distance(seq, s, return_len_excluding_ambig=True) for s in seqs]
+        return numpy.array([d for d, _ in dists_and_lengths], dtype=numpy.int64), numpy.array([l for _, l in dists_and_lengths], dtype=numpy.int64)
+    distances, lengths = hamming_matrix([seq], seqs)
+    return distances[0], lengths[0]
+
+def hfrac_to_many(seq, seqs):
+    """ return numpy array with the hamming fraction between <seq> and each sequence in <seqs> (all must be the same length) """
+    return packed_hfracs(*hamming_to_many(seq, seqs))
+
+def hfrac_matrix(seqs_a, seqs_b=None):
+    """ return numpy array of shape (len(seqs_a), len(seqs_b)) with the hamming fraction between each pair (if <seqs_b> isn't set, use <seqs_a>) """
+    return packed_hfracs(*hamming_matrix(seqs_a, seqs_b=seqs_b))
+
 # ----------------------------------------------------------------------------------------
 def subset_sequences(line, restrict_to_region=None, exclusion_3p=None, iseq=None):
     # NOTE don't call with <iseq> directly, instead use subset_iseq() below
@@ -2410,6 +2663,49 @@ def merge_csvs(outfname, csv_list, cleanup=True):
 
     return n_event_list
 
+# ----------------------------------------------------------------------------------------
+def stream_merge_csvs(infnames, outfname, dereplicate=False, bufsize=2**20):
+    """
+    Merge the csv files <infnames> (which must all exist, and have the same header line) into <outfname>, without reading any of them into memory, and writing the header only once.
+    If <outfname> is in <infnames>, we append the others to it (unless <dereplicate> is set, in which case we have to rewrite it, with its lines first).
+    If <dereplicate> is set, we skip any line that we've already written (keeping the first one, so unlike sort | uniq we don't change the order). We only keep a digest of each line, to save memory.
+    """
+    header = None
+    def check_header(fname, infile):
+        headline = infile.readline()
+        if header is not None and headline != header:
+            raise Exception('header in %s doesn\'t match the one in the other files:\n  %s  %s' % (fname, headline, header))
+        return headline
+
+    tmpfname = None
+    if outfname in infnames:
+        infnames = [outfname] + [fn for fn in infnames if fn != outfname]
+        if dereplicate:
+            tmpfname = outfname + '.tmp'
+        else:
+            with open(outfname) as infile:
+                header = check_header(outfname, infile)
+            infnames = infnames[1:]
+    seen_digests = set()
+    with open(outfname if tmpfname is None else tmpfname, 'a' if header is not None else 'w', bufsize) as outfile:
+        for fname in infnames:
+            with open(fname, 'r', bufsize) as infile:
+                headline = check_header(fname, infile)
+                if header is None:
+                    header = headline
+                    outfile.write(header)
+                if dereplicate:
+                    for line in infile:
+                        digest = hashlib.md5(line).digest()
+                        if digest in seen_digests:
+                            continue
+                        seen_digests.add(digest)
+                        outfile.write(line)
+                else:
+                    shutil.copyfileobj(infile, outfile, bufsize)
+    if tmpfname is not None:
+        os.rename(tmpfname, outfname)
+
 # ----------------------------------------------------------------------------------------
 def merge_yamls(outfname, yaml_list, headers, cleanup=True, use_pyyaml=False):
     """ NOTE copy of merge_csvs(), which is (apparently) a copy of merge_hmm_outputs in partitiondriver, I should really combine the two functions """
@@ -2790,12 +3086,32 @@ def run_cmd(cmdfo, batch_system=None, batch_options=None, shell=False):
     if not os.path.exists(cmdfo['logdir']):
         os.makedirs(cmdfo['logdir'])
 
-    proc = subprocess.Popen(cstr if shell else cstr.split(),
-                            stdout=None if fout is None else open(fout, 'w'),
-                            stderr=None if ferr is None else open(ferr, 'w'),
-                            env=cmdfo.get('env'), shell=shell)
+    outfiles = {tstr : None if fn is None else open(fn, 'w') for tstr, fn in [('out', fout), ('err', ferr)]}
+    proc = subprocess.Popen(cstr if shell else cstr.split(), stdout=outfiles['out'], stderr=outfiles['err'], env=cmdfo.get('env'), shell=shell)
+    for ofile in [f for f in outfiles.values() if f is not None]:  # the child has its own copies, so we don't need to keep ours open (with lots of procs, and lots of steps, these add up)
+        ofile.close()
     return proc
 
+# ----------------------------------------------------------------------------------------
+# run in its own thread for each process started by run_cmds(): block until <proc> finishes, then put it (and the cpu time it used) on <finished_queue>
+lost_exit_status = -1000  # returncode that wait_for_proc() sets if it couldn't get the exit status (so finish_process() treats it as a failure, rather than assuming it succeeded). Can't be a real returncode, since those are either exit statuses (0 to 255) or minus a signal number
+def wait_for_proc(iproc, proc, finished_queue):
+    cpu_time = None
+    while True:
+        try:
+            _, status, rusage = os.wait4(proc.pid, 0)  # unlike os.wait(), this doesn't reap other children (e.g. multiprocessing workers), and unlike Popen.wait() it gets us resource usage
+            proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)  # same convention as Popen (we have to set it ourselves, since we reaped the process)
+            cpu_time = rusage.ru_utime + rusage.ru_stime  # NOTE for batch systems this is just the cpu used by srun/qsub/whatever, not the actual job
+            break
+        except OSError as err:
+            if err.errno == errno.EINTR:
+                continue
+            if err.errno == errno.ECHILD:  # someone else already reaped it, so we can't get its exit status (Popen assumes success in this case, but we'd rather rerun it)
+                proc.returncode = lost_exit_status
+                break
+            raise
+    finished_queue.put((iproc, cpu_time))
+
 # ----------------------------------------------------------------------------------------
 # <cmdfos> list of dicts, each dict specifies how to run one process, entries:
 cmdfo_required_keys = [
@@ -2814,7 +3130,8 @@ cmdfo_defaults = {  # None means by default it's absent
 
 # ----------------------------------------------------------------------------------------
 # notes:
-#  - set sleep to False if your commands are going to run really really really quickly
+#  - set sleep to False if your commands are going to run really really really quickly (it's only used to stagger process starts)
+#  - returns a list (one for each cmdfo) of dicts with the process's wall and cpu time (summed over retries) and number of tries
 #  - unlike everywhere else, <debug> is not a boolean, and is either None (swallow out, print err)), 'print' (print out and err), 'write' (write out and err to file called 'log' in logdir), or 'write:<log file name>' (same as 'write', but you set your own base name)
 #  - <proc_limit_str> must be set if <n_max_procs> is set
 def run_cmds(cmdfos, shell=False, n_max_tries=None, clean_on_success=False, batch_system=None, batch_options=None, batch_config_fname=None,
@@ -2838,27 +3155,43 @@ def run_cmds(cmdfos, shell=False, n_max_tries=None, clean_on_success=False, batc
     if batch_system == 'slurm' and batch_config_fname is not None:
         set_slurm_nodelist(cmdfos, batch_config_fname)
 
-    procs, n_tries_list = [], []
+    # each process gets a thread that blocks until it finishes and then puts it on <finished_queue>, so we sit here blocking on the queue instead of polling every process over and over
+    finished_queue = Queue.Queue()
+    procs, n_tries_list = [None for _ in cmdfos], [0 for _ in cmdfos]
+    timefos = [{'wall' : None, 'cpu' : 0., 'start' : None} for _ in cmdfos]  # per-process wall and cpu time (summed over all tries), which we return
+    def start_proc(iproc):
+        procs[iproc] = run_cmd(cmdfos[iproc], batch_system=batch_system, batch_options=batch_options, shell=shell)
+        n_tries_list[iproc] += 1
+        if timefos[iproc]['start'] is None:
+            timefos[iproc]['start'] = time.time()
+        waiter = threading.Thread(target=wait_for_proc, args=(iproc, procs[iproc], finished_queue))
+        waiter.daemon = True  # don't hang on exit if we're raising an exception while other procs are still running
+        waiter.start()
+
     for iproc in range(len(cmdfos)):
-        procs += [run_cmd(cmdfos[iproc], batch_system=batch_system, batch_options=batch_options, shell=shell)]
-        n_tries_list.append(1)
+        start_proc(iproc)
         if sleep:
             time.sleep(per_proc_sleep_time)
         if n_max_procs is not None:
             limit_procs(proc_limit_str, n_max_procs)
 
-    while procs.count(None) != len(procs):  # we set each proc to None when it finishes
-        for iproc in range(len(cmdfos)):
-            if procs[iproc] is None:  # already finished
-                continue
-            if procs[iproc].poll() is not None:  # it just finished
-                status = finish_process(iproc, procs, n_tries_list[iproc], cmdfos[iproc], n_max_tries, dbgfo=cmdfos[iproc].get('dbgfo'), batch_system=batch_system, debug=debug, ignore_stderr=ignore_stderr, clean_on_success=clean_on_success)
-                if status == 'restart':
-                    procs[iproc] = run_cmd(cmdfos[iproc], batch_system=batch_system, batch_options=batch_options, shell=shell)
-                    n_tries_list[iproc] += 1
+    n_running = len(cmdfos)
+    while n_running > 0:
+        try:
+            iproc, cpu_time = finished_queue.get(timeout=60)  # python 2 doesn't let you ctrl-c out of a queue get() that has no timeout
+        except Queue.Empty:
+            continue
+        if cpu_time is not None:
+            timefos[iproc]['cpu'] += cpu_time
+        status = finish_process(iproc, procs, n_tries_list[iproc], cmdfos[iproc], n_max_tries, dbgfo=cmdfos[iproc].get('dbgfo'), batch_system=batch_system, debug=debug, ignore_stderr=ignore_stderr, clean_on_success=clean_on_success)
+        if status == 'restart':
+            start_proc(iproc)
+        else:
+            timefos[iproc]['wall'] = time.time() - timefos[iproc]['start']
+            n_running -= 1
         sys.stdout.flush()
-        if sleep:
-            time.sleep(per_proc_sleep_time)
+
+    return [{'wall' : tfo['wall'], 'cpu' : tfo['cpu'], 'n_tries' : ntries} for tfo, ntries in zip(timefos, n_tries_list)]
 
 # ----------------------------------------------------------------------------------------
 def pad_lines(linestr, padwidth=8):
@@ -2919,6 +3252,8 @@ def finish_process(iproc, procs, n_tried, cmdfo, n_max_tries, dbgfo=None, batch_
     print '    proc %d try %d' % (iproc, n_tried),
     if procs[iproc].returncode == 0 and not os.path.exists(cmdfo['outfname']):  # don't really need both the clauses
         print 'succeded but output is missing'
+    elif procs[iproc].returncode == lost_exit_status:
+        print 'exit status was lost (some other code reaped the process) (output %s)' % (('exists: %s' % cmdfo['outfname']) if os.path.exists(cmdfo['outfname']) else 'is missing')
     else:
         print 'failed with exit code %d (output %s)' % (procs[iproc].returncode, ('exists: %s' % cmdfo['outfname']) if os.path.exists(cmdfo['outfname']) else 'is missing')
     if batch_system == 'slurm':  # cmdfo['cmd_str'].split()[0] == 'srun' and
@@ -3778,62 +4113,77 @@ def write_fasta(fname, seqfos, name_key='name', seq_key='seq'):  # should have w
             seqfile.write('>%s\n%s\n' % (sfo[name_key], sfo[seq_key]))
 
 # ----------------------------------------------------------------------------------------
-def read_fastx(fname, name_key='name', seq_key='seq', add_info=True, dont_split_infostrs=False, sanitize=False, queries=None, n_max_queries=-1, istartstop=None, ftype=None, n_random_queries=None):  # Bio.SeqIO takes too goddamn long to import
+def open_fastx_file(fname, buffer_size=2**20):
+    """ open <fname> for reading, transparently decompressing it if it's gzip or bz2 (detected from the first few bytes, not the suffix) """
+    with open(fname, 'rb') as testfile:
+        magic = testfile.read(3)
+    if magic[:2] == '\x1f\x8b':
+        return io.BufferedReader(gzip.GzipFile(fname, 'rb'), buffer_size=buffer_size)
+    elif magic == 'BZh':
+        return bz2.BZ2File(fname, 'r', buffering=buffer_size)
+    else:
+        return open(fname, 'r', buffer_size)
+
+# ----------------------------------------------------------------------------------------
+def get_fastx_suffix(fname):  # like getsuffix(), but skips over a compression suffix (e.g. returns '.fa' for 'x.fa.gz')
+    suffix = getsuffix(fname)
+    if suffix in compressed_suffixes:
+        suffix = getsuffix(fname[ : -len(suffix)])
+    return suffix
+
+# ----------------------------------------------------------------------------------------
+def iter_fastx(fname, name_key='name', seq_key='seq', add_info=True, dont_split_infostrs=False, sanitize=False, queries=None, n_max_queries=-1, istartstop=None, ftype=None):
+    """ generator version of read_fastx(), which reads (and yields) one sequence at a time, so memory doesn't depend on the file size """
     if ftype is None:
-        suffix = getsuffix(fname)
+        suffix = get_fastx_suffix(fname)
         if suffix == '.fa' or suffix == '.fasta':
             ftype = 'fa'
         elif suffix == '.fq' or suffix == '.fastq':
             ftype = 'fq'
         else:
             raise Exception('unhandled file type: %s' % suffix)
+    if ftype not in ['fa', 'fq']:
+        raise Exception('unhandled ftype %s' % ftype)
 
-    finfo = []
-    iline = -1  # index of the query/seq that we're currently reading in the fasta
-    n_fasta_queries = 0  # number of queries so far added to <finfo> (I guess I could just use len(finfo) at this point)
-    missing_queries = set(queries) if queries is not None else None
-    already_printed_forbidden_character_warning = False
-    with open(fname) as fastafile:
-        startpos = None
-        while True:
-            if startpos is not None:  # rewind since the last time through we had to look to see when the next header line appeared
-                fastafile.seek(startpos)
-            headline = fastafile.readline()
-            if not headline:
-                break
-            if headline.strip() == '':  # skip a blank line
+    # ----------------------------------------------------------------------------------------
+    def read_raw_entries(fastafile):  # yields (headline, seqline) for each entry, without looking at the contents
+        if ftype == 'fa':
+            headline, seqlines = None, []
+            for line in fastafile:
+                if line[0] == '>':
+                    if headline is not None:
+                        yield headline, ''.join(seqlines)
+                    headline, seqlines = line[1:], []
+                elif headline is None:
+                    if line.strip() == '':  # skip blank lines before the first header
+                        continue
+                    raise Exception('invalid fasta header line in %s:\n    %s' % (fname, line))
+                else:
+                    seqlines.append(line.strip())
+            if headline is not None:
+                yield headline, ''.join(seqlines)
+        elif ftype == 'fq':
+            while True:
                 headline = fastafile.readline()
-
-            if ftype == 'fa':
-                if headline[0] != '>':
-                    raise Exception('invalid fasta header line in %s:\n    %s' % (fname, headline))
-                headline = headline.lstrip('>')
-
-                seqlines = []
-                nextline = fastafile.readline()
-                while True:
-                    if not nextline:
-                        break
-                    if nextline[0] == '>':
-                        break
-                    else:
-                        startpos = fastafile.tell()  # i.e. very line that doesn't begin with '>' increments <startpos>
-                    seqlines.append(nextline)
-                    nextline = fastafile.readline()
-                seqline = ''.join([l.strip() for l in seqlines]) if len(seqlines) > 0 else None
-            elif ftype == 'fq':
+                while headline and headline.strip() == '':  # skip blank lines
+                    headline = fastafile.readline()
+                if not headline:
+                    break
                 if headline[0] != '@':
                     raise Exception('invalid fastq header line in %s:\n    %s' % (fname, headline))
-                headline = headline.lstrip('@')
-
                 seqline = fastafile.readline()  # NOTE .fq with multi-line entries isn't supported, since delimiter characters are allowed to occur within the quality string
                 plusline = fastafile.readline().strip()
-                if plusline[0] != '+':
+                if plusline[:1] != '+':
                     raise Exception('invalid fastq quality header in %s:\n    %s' % (fname, plusline))
-                qualityline = fastafile.readline()
-            else:
-                raise Exception('unhandled ftype %s' % ftype)
+                fastafile.readline()  # quality line
+                yield headline[1:], seqline
 
+    iline = -1  # index of the query/seq that we're currently reading in the fasta
+    n_fasta_queries = 0  # number of queries so far yielded
+    missing_queries = set(queries) if queries is not None else None
+    already_printed_forbidden_character_warning = False
+    with open_fastx_file(fname) as fastafile:
+        for headline, seqline in read_raw_entries(fastafile):
             if not seqline:
                 break
 
@@ -3842,7 +4192,7 @@ def read_fastx(fname, name_key='name', seq_key='seq', add_info=True, dont_split_
                 if iline < istartstop[0]:
                     continue
                 elif iline >= istartstop[1]:
-                    continue
+                    break
 
             if not dont_split_infostrs:  # by default, we split by everything that could be a separator, which isn't really ideal, but we're reading way too many different kinds of fasta files at this point to change the default
                 infostrs = [s3.strip() for s1 in headline.split(' ') for s2 in s1.split('\t') for s3 in s2.split('|')]  # NOTE the uid is left untranslated in here
@@ -3864,7 +4214,7 @@ def read_fastx(fname, name_key='name', seq_key='seq', add_info=True, dont_split_
             seqfo = {name_key : uid, seq_key : seqline.strip().upper()}
             if add_info:
                 seqfo['infostrs'] = infostrs
-            finfo.append(seqfo)
+            yield seqfo
 
             n_fasta_queries += 1
             if n_max_queries > 0 and n_fasta_queries >= n_max_queries:
@@ -3872,10 +4222,35 @@ def read_fastx(fname, name_key='name', seq_key='seq', add_info=True, dont_split_
             if queries is not None and len(missing_queries) == 0:
                 break
 
-    if n_random_queries is not None:
-        finfo = numpy.random.choice(finfo, n_random_queries, replace=False)
+# ----------------------------------------------------------------------------------------
+def reservoir_index(n_seen, n_samples, rng):  # reservoir sampling (algorithm R): return the index in the reservoir at which to put the <n_seen>th (zero-indexed) item, or None if it should be skipped
+    if n_seen < n_samples:
+        return n_seen  # reservoir isn't full yet, so append it
+    ireplace = rng.randint(0, n_seen)
+    return ireplace if ireplace < n_samples else None
+
+# ----------------------------------------------------------------------------------------
+def reservoir_sample(items, n_samples, random_seed=None):  # choose <n_samples> items uniformly at random from iterable <items> in a single pass (i.e. without holding all of them in memory), returning them in their original order
+    rng = random.Random(random_seed)
+    reservoir = []  # list of (index in <items>, item)
+    for iitem, item in enumerate(items):
+        ires = reservoir_index(iitem, n_samples, rng)
+        if ires is None:
+            continue
+        if ires == len(reservoir):
+            reservoir.append((iitem, item))
+        else:
+            reservoir[ires] = (iitem, item)
+    return [item for _, item in sorted(reservoir, key=operator.itemgetter(0))]
+
+# ----------------------------------------------------------------------------------------
+def read_fastx(fname, name_key='name', seq_key='seq', add_info=True, dont_split_infostrs=False, sanitize=False, queries=None, n_max_queries=-1, istartstop=None, ftype=None, n_random_queries=None, random_seed=None):  # Bio.SeqIO takes too goddamn long to import
+    finfo = iter_fastx(fname, name_key=name_key, seq_key=seq_key, add_info=add_info, dont_split_infostrs=dont_split_infostrs, sanitize=sanitize, queries=queries, n_max_queries=n_max_queries, istartstop=istartstop, ftype=ftype)
 
-    return finfo
+    if n_random_queries is not None:  # NOTE unlike numpy.random.choice(), if there's fewer than <n_random_queries> in the file, this just returns all of them
+        return reservoir_sample(finfo, n_random_queries, random_seed=random_seed)
+
+    return list(finfo)
 
 # ----------------------------------------------------------------------------------------
 def output_exists(args, outfname, outlabel=None, offset=22, debug=True):
@@ -4259,7 +4634,7 @@ def get_chimera_max_abs_diff(line, iseq, chunk_len=75, max_ambig_frac=0.1, debug
     return imax, max_abs_diff  # <imax> is break point
 
 # ----------------------------------------------------------------------------------------
-def write_annotations(fname, glfo, annotation_list, headers, synth_single_seqs=False, failed_queries=None, partition_lines=None, use_pyyaml=False):
+def write_annotations(fname, glfo, annotation_list, headers, synth_single_seqs=False, failed_queries=None, partition_lines=None, use_pyyaml=False, write_index=False):
     if os.path.exists(fname):
         os.remove(fname)
     elif not os.path.exists(os.path.dirname(os.path.abspath(fname))):
@@ -4269,7 +4644,9 @@ def write_annotations(fname, glfo, annotation_list, headers, synth_single_seqs=F
         assert partition_lines is None
         write_csv_annotations(fname, headers, annotation_list, synth_single_seqs=synth_single_seqs, glfo=glfo, failed_queries=failed_queries)
     elif getsuffix(fname) == '.yaml':
-        write_yaml_output(fname, headers, glfo=glfo, annotation_list=annotation_list, synth_single_seqs=synth_single_seqs, failed_queries=failed_queries, partition_lines=partition_lines, use_pyyaml=use_pyyaml)
+        write_yaml_output(fname, headers, glfo=glfo, annotation_list=annotation_list, synth_single_seqs=synth_single_seqs, failed_queries=failed_queries, partition_lines=partition_lines, use_pyyaml=use_pyyaml, write_index=write_index)
+    elif getsuffix(fname) == '.npz':
+        write_npz_output(fname, headers, glfo=glfo, annotation_list=annotation_list, failed_queries=failed_queries, partition_lines=partition_lines)
     else:
         raise Exception('unhandled file extension %s' % getsuffix(fname))
 
@@ -4305,25 +4682,253 @@ def get_yamlfo_for_output(line, headers, glfo=None):
     return yamlfo
 
 # ----------------------------------------------------------------------------------------
-def write_yaml_output(fname, headers, glfo=None, annotation_list=None, synth_single_seqs=False, failed_queries=None, partition_lines=None, use_pyyaml=False):
+class JsonOutputWriter(object):
+    """
+    Write partis yaml output (well, the json version) incrementally: version, germline, and partition info when it's opened, then each event as you add it, and the closing brackets in close().
+    This way we only ever have the output version of one annotation (from get_yamlfo_for_output()) in memory at a time, rather than building them all (plus everything else) into one big dict and dumping it at the end.
+    If <write_index> is set, close() also writes a sidecar index file with the byte offsets of each top-level value and each event (see get_json_output_index()), so LazyAnnotationList can later read single events without scanning the whole file.
+    Use it as a context manager, or call close() yourself. If there's an exception in the with block, we remove the partially-written file (rather than closing the brackets, which would leave a valid, but truncated, output file).
+    """
+    def __init__(self, fname, headers, glfo=None, partition_lines=None, write_index=False):
+        self.fname = fname
+        self.headers = headers
+        self.glfo = glfo
+        self.n_events = 0
+        self.index = {'top-level' : {}, 'events' : []} if write_index else None
+        self.outfile = open(fname, 'w')
+        self.outfile.write('{')
+        for key, val in [('version-info', yaml_version_info), ('germline-info', glfo), ('partitions', partition_lines if partition_lines is not None else [])]:
+            self.outfile.write('%s: ' % json.dumps(key))
+            start = self.outfile.tell()
+            json.dump(val, self.outfile)  # json.dump() (unlike dumps()) writes it in chunks as it goes
+            if self.index is not None:
+                self.index['top-level'][key] = [start, self.outfile.tell() - start]
+            self.outfile.write(', ')
+        self.outfile.write('"events": [')
+
+    def add_event(self, line, is_yamlfo=False):  # set <is_yamlfo> if <line> is already in output form (e.g. the failed query dicts)
+        if self.n_events > 0:
+            self.outfile.write(', ')
+        yamlfo = line if is_yamlfo else get_yamlfo_for_output(line, self.headers, glfo=self.glfo)
+        start = self.outfile.tell()
+        json.dump(yamlfo, self.outfile)
+        if self.index is not None:
+            self.index['events'].append(get_json_event_index_entry(yamlfo, start, self.outfile.tell() - start))
+        self.n_events += 1
+
+    def close(self):
+        self.outfile.write(']}')
+        self.outfile.close()
+        if self.index is not None:  # write the index after closing the output file, so its modification time is later (see get_json_output_index())
+            self.index['yaml-size'] = os.path.getsize(self.fname)
+            with open(get_json_output_index_fname(self.fname), 'w') as indexfile:
+                json.dump(self.index, indexfile)
+
+    def __enter__(self):
+        return self
+
+    def abort(self):  # close and remove the partially-written file
+        self.outfile.close()
+        os.remove(self.fname)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+# ----------------------------------------------------------------------------------------
+def get_json_output_index_fname(fname):  # sidecar index file written by JsonOutputWriter
+    return os.path.splitext(fname)[0] + '-event-index.json'
+
+# ----------------------------------------------------------------------------------------
+def get_json_event_index_entry(yamlfo, start, length):  # byte offset and length of the event, plus the info we need to decide which events to read without having to read them (see PartitionDriver.select_lazy_annotations())
+    return [start, length, yamlfo['unique_ids'], bool(yamlfo.get('invalid', False) or yamlfo.get('v_gene') == '')]  # the empty v gene is how old files marked failed queries
+
+# ----------------------------------------------------------------------------------------
+class JsonScanBuffer(object):
+    """
+    For scan_json_output(): reads a json file in chunks, keeping only the part that we haven't yet parsed (plus the next chunk), and keeping track of byte offsets in the file.
+    So memory depends on the size of the biggest single value that we decode (e.g. the germline info, or one event), rather than the size of the file.
+    """
+    def __init__(self, jfile, fname, chunk_size):
+        self.jfile = jfile
+        self.fname = fname
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.buf_start = 0  # file offset of self.buf[0]
+        self.ipos = 0  # position in self.buf up to which we've parsed
+        self.eof = False
+
+    def read_more(self, n_bytes):  # drop what we've already parsed, and read (up to) <n_bytes> more
+        self.buf_start += self.ipos
+        self.buf = self.buf[self.ipos : ]
+        self.ipos = 0
+        chunk = self.jfile.read(n_bytes)
+        if chunk == '':
+            self.eof = True
+        self.buf += chunk
+
+    def skip_ws(self):
+        while True:
+            self.ipos = json.decoder.WHITESPACE.match(self.buf, self.ipos).end()
+            if self.ipos < len(self.buf) or self.eof:
+                return
+            self.read_more(self.chunk_size)
+
+    def peek(self):  # next non-whitespace character ('' at end of file)
+        self.skip_ws()
+        return self.buf[self.ipos] if self.ipos < len(self.buf) else ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('expected \'%s\' at byte %d in %s' % (char, self.buf_start + self.ipos, self.fname))
+        self.ipos += 1
+
+    def decode(self, decoder):  # returns (value, file offset, length) for the next json value
+        self.skip_ws()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buf, self.ipos)
+                if end < len(self.buf) or self.eof:  # if it ends right at the end of the buffer, it could be a truncated number (or whatever), so read more and try again
+                    break
+            except ValueError:  # presumably it's not all in the buffer yet
+                if self.eof:
+                    raise
+            self.read_more(max(self.chunk_size, len(self.buf)))  # at least double the buffer each time, so big values don't take a quadratic number of tries
+        start = self.buf_start + self.ipos
+        self.ipos = end
+        return value, start, end - (start - self.buf_start)
+
+# ----------------------------------------------------------------------------------------
+def scan_json_output(fname, chunk_size=2**20):
+    """
+    Build the same index that JsonOutputWriter writes (if <write_index> is set), but by scanning the (json) yaml output file <fname>.
+    We read the file in chunks of <chunk_size> bytes, and decode the events one at a time (keeping only their byte offsets, uids, and whether they're invalid), so we only have one event (or one of the other top-level values, e.g. germline info) in memory at a time.
+    Raises ValueError if the file isn't the json subset of yaml (e.g. if it was written with --write-full-yaml-output).
+    """
+    decoder = json.JSONDecoder()
+    index = {'top-level' : {}, 'events' : [], 'yaml-size' : os.path.getsize(fname)}
+    with open(fname) as yamlfile:
+        jbuf = JsonScanBuffer(yamlfile, fname, chunk_size)
+        jbuf.expect('{')
+        while jbuf.peek() not in ['}', '']:
+            key, _, _ = jbuf.decode(decoder)
+            jbuf.expect(':')
+            if key == 'events':
+                jbuf.expect('[')
+                while jbuf.peek() not in [']', '']:
+                    yamlfo, start, length = jbuf.decode(decoder)
+                    index['events'].append(get_json_event_index_entry(yamlfo, start, length))
+                    if jbuf.peek() == ',':
+                        jbuf.expect(',')
+                jbuf.expect(']')
+            else:
+                _, start, length = jbuf.decode(decoder)
+                index['top-level'][key] = [start, length]
+            if jbuf.peek() == ',':
+                jbuf.expect(',')
+        jbuf.expect('}')
+
+    return index
+
+# ----------------------------------------------------------------------------------------
+def get_json_output_index(fname, debug=False):  # use the sidecar index file if it's there and up to date, otherwise scan <fname>
+    indexfname = get_json_output_index_fname(fname)
+    if os.path.exists(indexfname) and os.path.getmtime(indexfname) >= os.path.getmtime(fname):
+        with open(indexfname) as indexfile:
+            index = json.load(indexfile)
+        if index['yaml-size'] == os.path.getsize(fname):
+            if debug:
+                print '  read index for %d events from %s' % (len(index['events']), indexfname)
+            return index
+    if debug:
+        print '  no up to date index file for %s, so scanning it' % fname
+    return scan_json_output(fname)
+
+# ----------------------------------------------------------------------------------------
+def read_json_value(jsonfile, start, length):
+    jsonfile.seek(start)
+    return json.loads(jsonfile.read(length))
+
+# ----------------------------------------------------------------------------------------
+class LazyAnnotationList(object):
+    """
+    Read-only list of the annotations in a (json) yaml output file that only reads, and adds implicit info to, each event when you access it (using the byte offsets from get_json_output_index()).
+    Parsed events are kept, so modifications to them stick around, and accessing them again is fast.
+    Use unique_ids() and is_invalid() to decide which events you want without reading any of them, and get_annotation_for_cluster() to get the event for a particular cluster.
+    """
+    def __init__(self, fname, glfo, event_index, dont_add_implicit_info=False):
+        self.fname = fname
+        self.glfo = glfo
+        self.event_index = event_index  # list of [byte offset, length, uids, invalid] (see get_json_event_index_entry())
+        self.dont_add_implicit_info = dont_add_implicit_info
+        self.parsed_events = {}
+        self.ievents_by_uidstr = {':'.join(ientry[2]) : ievent for ievent, ientry in enumerate(self.event_index)}  # key by the whole cluster, since a uid can be in more than one event (e.g. with --write-additional-cluster-annotations or --calculate-alternative-annotations)
+
+    def __len__(self):
+        return len(self.event_index)
+
+    def __getitem__(self, ievent):
+        if isinstance(ievent, slice):
+            return [self[i] for i in range(*ievent.indices(len(self)))]
+        if ievent < 0:
+            ievent += len(self)
+        if ievent not in self.parsed_events:
+            self.parsed_events[ievent] = self.read_event(ievent)
+        return self.parsed_events[ievent]
+
+    def __iter__(self):
+        for ievent in range(len(self)):
+            yield self[ievent]
+
+    def unique_ids(self, ievent):
+        return self.event_index[ievent][2]
+
+    def is_invalid(self, ievent):
+        return self.event_index[ievent][3]
+
+    def get_annotation_for_cluster(self, cluster):  # raises KeyError if there's no event with exactly the uids in <cluster> (in the same order)
+        return self[self.ievents_by_uidstr[':'.join(cluster)]]
+
+    def read_event(self, ievent):  # same as what parse_yaml_annotations() does to each event
+        start, length = self.event_index[ievent][:2]
+        with open(self.fname) as yamlfile:
+            line = read_json_value(yamlfile, start, length)
+        if not line['invalid']:
+            transfer_indel_reversed_seqs(line)
+            if not self.dont_add_implicit_info:
+                line = ImplicitInfoLine(line)
+                add_implicit_info(self.glfo, line, lazy=True)
+        return line
+
+# ----------------------------------------------------------------------------------------
+yaml_version_info = {'partis-yaml' : 0.1}
+def write_yaml_output(fname, headers, glfo=None, annotation_list=None, synth_single_seqs=False, failed_queries=None, partition_lines=None, use_pyyaml=False, write_index=False):  # <annotation_list> can be any iterable (e.g. a generator), since we only go through it once
+    if os.path.exists(get_json_output_index_fname(fname)):  # make sure we don't leave an index for a previous version of the file lying around (it'd get ignored anyway because of the size and modification time checks, but still)
+        os.remove(get_json_output_index_fname(fname))
     if annotation_list is None:
         annotation_list = []
+    if failed_queries is None:
+        failed_queries = []
     if partition_lines is None:
         partition_lines = []
 
-    version_info = {'partis-yaml' : 0.1}
-    yaml_annotations = [get_yamlfo_for_output(l, headers, glfo=glfo) for l in annotation_list]
-    if failed_queries is not None:
-        yaml_annotations += failed_queries
-    yamldata = {'version-info' : version_info,
-                'germline-info' : glfo,
-                'partitions' : partition_lines,
-                'events' : yaml_annotations}
-    with open(fname, 'w') as yamlfile:
-        if use_pyyaml:  # slower, but easier to read by hand for debugging (use this instead of the json version to make more human-readable files)
+    if use_pyyaml:  # slower, but easier to read by hand for debugging (use this instead of the json version to make more human-readable files)
+        if write_index:
+            print '  %s can\'t write an event index file for full yaml output, so not writing one' % color('yellow', 'warning')
+        yamldata = {'version-info' : yaml_version_info,
+                    'germline-info' : glfo,
+                    'partitions' : partition_lines,
+                    'events' : [get_yamlfo_for_output(l, headers, glfo=glfo) for l in annotation_list] + failed_queries}
+        with open(fname, 'w') as yamlfile:
             yaml.dump(yamldata, yamlfile, width=400, Dumper=yaml.CDumper, default_flow_style=False, allow_unicode=False)  # set <allow_unicode> to false so the file isn't cluttered up with !!python.unicode stuff
-        else:  # way tf faster than full yaml (only lost information is ordering in ordered dicts, but that's only per-gene support and germline info, neither of whose order we care much about)
-            json.dump(yamldata, yamlfile) #, sort_keys=True, indent=4)
+    else:  # way tf faster than full yaml (only lost information is ordering in ordered dicts, but that's only per-gene support and germline info, neither of whose order we care much about)
+        with JsonOutputWriter(fname, headers, glfo=glfo, partition_lines=partition_lines, write_index=write_index) as writer:
+            for line in annotation_list:
+                writer.add_event(line)
+            for failfo in failed_queries:
+                writer.add_event(failfo, is_yamlfo=True)
 
 # ----------------------------------------------------------------------------------------
 def parse_yaml_annotations(glfo, yamlfo, n_max_queries, synth_single_seqs, dont_add_implicit_info):
@@ -4333,7 +4938,8 @@ def parse_yaml_annotations(glfo, yamlfo, n_max_queries, synth_single_seqs, dont_
         if not line['invalid']:
             transfer_indel_reversed_seqs(line)
             if not dont_add_implicit_info:  # it's kind of slow, although most of the time you probably want all the extra info
-                add_implicit_info(glfo, line)  # don't use the germline info in <yamlfo>, in case we decide we want to modify it in the calling fcn
+                line = ImplicitInfoLine(line)  # so the slowest parts only get calculated if they're used
+                add_implicit_info(glfo, line, lazy=True)  # don't use the germline info in <yamlfo>, in case we decide we want to modify it in the calling fcn
         if synth_single_seqs and len(line['unique_ids']) > 1:
             for iseq in range(len(line['unique_ids'])):
                 annotation_list.append(synthesize_single_seq_line(line, iseq))
@@ -4347,7 +4953,7 @@ def parse_yaml_annotations(glfo, yamlfo, n_max_queries, synth_single_seqs, dont_
     return annotation_list
 
 # ----------------------------------------------------------------------------------------
-def read_output(fname, n_max_queries=-1, synth_single_seqs=False, dont_add_implicit_info=False, seed_unique_id=None, cpath=None, skip_annotations=False, glfo=None, debug=False):
+def read_output(fname, n_max_queries=-1, synth_single_seqs=False, dont_add_implicit_info=False, seed_unique_id=None, cpath=None, skip_annotations=False, glfo=None, lazy=False, debug=False):  # if <lazy> is set, and it's a json yaml file, <annotation_list> is a LazyAnnotationList
     annotation_list = None
 
     if getsuffix(fname) == '.csv':
@@ -4366,7 +4972,8 @@ def read_output(fname, n_max_queries=-1, synth_single_seqs=False, dont_add_impli
                 for line in csv.DictReader(csvfile):
                     process_input_line(line, skip_literal_eval=dont_add_implicit_info)  # NOTE kind of weird to equate implicit info adding and literal eval skipping... but in the end they're both mostly speed optimizations
                     if not dont_add_implicit_info:
-                        add_implicit_info(glfo, line)
+                        line = ImplicitInfoLine(line)
+                        add_implicit_info(glfo, line, lazy=True)
                     annotation_list.append(line)
                     n_queries_read += 1
                     if n_max_queries > 0 and n_queries_read >= n_max_queries:
@@ -4374,14 +4981,26 @@ def read_output(fname, n_max_queries=-1, synth_single_seqs=False, dont_add_impli
 
     elif getsuffix(fname) == '.yaml':  # NOTE this replaces any <glfo> that was passed (well, only within the local name table of this fcn, unless the calling fcn replaces it themselves, since we return this glfo)
         glfo, annotation_list, cpath = read_yaml_output(fname, n_max_queries=n_max_queries, synth_single_seqs=synth_single_seqs,
-                                                        dont_add_implicit_info=dont_add_implicit_info, seed_unique_id=seed_unique_id, cpath=cpath, skip_annotations=skip_annotations, debug=debug)
+                                                        dont_add_implicit_info=dont_add_implicit_info, seed_unique_id=seed_unique_id, cpath=cpath, skip_annotations=skip_annotations, lazy=lazy, debug=debug)
+    elif getsuffix(fname) == '.npz':  # same note as for .yaml
+        glfo, annotation_list, cpath = read_npz_output(fname, n_max_queries=n_max_queries, synth_single_seqs=synth_single_seqs, dont_add_implicit_info=dont_add_implicit_info,
+                                                       seed_unique_id=seed_unique_id, cpath=cpath, skip_annotations=skip_annotations, debug=debug)
     else:
         raise Exception('unhandled file extension %s' % getsuffix(fname))
 
     return glfo, annotation_list, cpath
 
 # ----------------------------------------------------------------------------------------
-def read_yaml_output(fname, n_max_queries=-1, synth_single_seqs=False, dont_add_implicit_info=False, seed_unique_id=None, cpath=None, skip_annotations=False, debug=False):
+def read_yaml_output(fname, n_max_queries=-1, synth_single_seqs=False, dont_add_implicit_info=False, seed_unique_id=None, cpath=None, skip_annotations=False, lazy=False, debug=False):
+    if lazy and not skip_annotations:
+        if synth_single_seqs or n_max_queries > 0:  # these need to look at all the events, so there's no point in being lazy
+            print '  %s can\'t read lazily with synth_single_seqs or n_max_queries set, so reading all events from %s' % (color('yellow', 'warning'), fname)
+        else:
+            try:
+                return read_lazy_json_output(fname, dont_add_implicit_info=dont_add_implicit_info, seed_unique_id=seed_unique_id, cpath=cpath, debug=debug)
+            except ValueError:  # probably a full yaml file
+                print '  %s couldn\'t read %s lazily (probably not the json subset of yaml), so reading all events' % (color('yellow', 'warning'), fname)
+
     with open(fname) as yamlfile:
         try:
             yamlfo = json.load(yamlfile)  # way tf faster than full yaml (only lost information is ordering in ordered dicts, but that's only per-gene support and germline info, neither of whose order we care much about)
@@ -4397,12 +5016,158 @@ def read_yaml_output(fname, n_max_queries=-1, synth_single_seqs=False, dont_add_
     if not skip_annotations:  # may not really be worthwhile, but oh well
         annotation_list = parse_yaml_annotations(glfo, yamlfo, n_max_queries, synth_single_seqs, dont_add_implicit_info)
 
-    partition_lines = yamlfo['partitions']
+    cpath = read_yaml_partitions(yamlfo['partitions'], seed_unique_id=seed_unique_id, cpath=cpath)
+
+    return glfo, annotation_list, cpath
+
+# ----------------------------------------------------------------------------------------
+def read_yaml_partitions(partition_lines, seed_unique_id=None, cpath=None):
     if cpath is None:   # allowing the caller to pass in <cpath> is kind of awkward, but it's used for backward compatibility in clusterpath.readfile()
         cpath = clusterpath.ClusterPath(seed_unique_id=seed_unique_id)  # NOTE I'm not sure if I really want to pass in the seed here -- it should be stored in the file -- but if it's in both places it should be the same. um, should.
     if len(partition_lines) > 0:  # *don't* combine this with the cluster path constructor, since then we won't modify the path passed in the arguments
         cpath.readlines(partition_lines)
+    return cpath
 
+# ----------------------------------------------------------------------------------------
+def read_lazy_json_output(fname, dont_add_implicit_info=False, seed_unique_id=None, cpath=None, debug=False):  # same as read_yaml_output(), but the returned annotation list only reads events when you access them (see LazyAnnotationList)
+    index = get_json_output_index(fname, debug=debug)
+    with open(fname) as yamlfile:
+        yamlfo = {key : read_json_value(yamlfile, start, length) for key, (start, length) in index['top-level'].items()}
+    if debug:
+        print '  read yaml version %s from %s' % (yamlfo['version-info']['partis-yaml'], fname)
+    glfo = yamlfo['germline-info']
+    annotation_list = LazyAnnotationList(fname, glfo, index['events'], dont_add_implicit_info=dont_add_implicit_info)
+    cpath = read_yaml_partitions(yamlfo['partitions'], seed_unique_id=seed_unique_id, cpath=cpath)
+    return glfo, annotation_list, cpath
+
+# ----------------------------------------------------------------------------------------
+# Columnar (numpy .npz) output format, selected by an --outfname suffix of .npz.
+# Each key in the output events (i.e. what get_yamlfo_for_output() returns) is stored as a separate set of arrays, so analysis code can use read_npz_columns() to load only the keys it needs, as typed numpy arrays, without building any annotation dicts:
+#   - per-event keys have one value for each event that has that key, while per-sequence keys (those in linekeys['per_seq']) are flattened, with one value for each sequence in each event that has the key (split them back up using 'event-n-seqs')
+#   - bools, ints, and floats are stored as numpy arrays of that type, while strings are stored either dictionary-encoded (unique values plus integer codes, e.g. gene names) or packed (all strings concatenated into one byte array, plus offsets, e.g. sequences), depending on how many unique values there are. Anything else (dicts, lists of lists, None...) is packed as json strings
+#   - if some events are missing a key (e.g. failed queries only have a few keys), its column also has a 'present' array
+# Version, germline, and partition info are stored as json in the 'meta' array.
+npz_encodings = ['bool', 'int', 'float', 'dict', 'str', 'json']
+
+# ----------------------------------------------------------------------------------------
+def pack_npz_strings(strlist):
+    strlist = [s.encode('utf-8') if isinstance(s, unicode) else s for s in strlist]
+    return {'data' : numpy.frombuffer(''.join(strlist), dtype=numpy.uint8), 'offsets' : numpy.cumsum([0] + [len(s) for s in strlist], dtype=numpy.int64)}
+
+# ----------------------------------------------------------------------------------------
+def unpack_npz_strings(data, offsets):
+    datastr = data.tostring()
+    offsets = offsets.tolist()
+    return [datastr[offsets[i] : offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+# ----------------------------------------------------------------------------------------
+def get_npz_column(vals):  # choose an encoding for the column values <vals>, and return it along with the column's arrays
+    if all(isinstance(v, bool) for v in vals):
+        return 'bool', {'values' : numpy.array(vals, dtype=numpy.bool_)}
+    if all(isinstance(v, (int, long)) and not isinstance(v, bool) for v in vals):
+        return 'int', {'values' : numpy.array(vals, dtype=numpy.int64)}
+    if all(isinstance(v, (int, long, float)) and not isinstance(v, bool) for v in vals):
+        return 'float', {'values' : numpy.array(vals, dtype=numpy.float64)}
+    if all(isinstance(v, basestring) for v in vals):
+        uniques = sorted(set(vals))
+        if len(uniques) <= len(vals) / 2:  # lots of repeats (e.g. gene names), so store each unique value once
+            code_map = {u : i for i, u in enumerate(uniques)}
+            return 'dict', dict(pack_npz_strings(uniques), codes=numpy.array([code_map[v] for v in vals], dtype=numpy.int32))
+        return 'str', pack_npz_strings(vals)
+    return 'json', pack_npz_strings([json.dumps(v) for v in vals])
+
+# ----------------------------------------------------------------------------------------
+def decode_npz_column(npzfile, key, encoding):  # returns a numpy array for 'bool', 'int', and 'float' columns, and a list for the others
+    if encoding in ['bool', 'int', 'float']:
+        return npzfile[key + '.values']
+    strlist = unpack_npz_strings(npzfile[key + '.data'], npzfile[key + '.offsets'])
+    if encoding == 'dict':
+        return [strlist[i] for i in npzfile[key + '.codes'].tolist()]
+    elif encoding == 'str':
+        return strlist
+    elif encoding == 'json':
+        return [json.loads(s) for s in strlist]
+    else:
+        raise Exception('unhandled npz column encoding %s' % encoding)
+
+# ----------------------------------------------------------------------------------------
+def write_npz_output(fname, headers, glfo=None, annotation_list=None, failed_queries=None, partition_lines=None):  # NOTE unlike the json version, this has to have the output version of every event in memory at once
+    if annotation_list is None:
+        annotation_list = []
+    if failed_queries is None:
+        failed_queries = []
+    if partition_lines is None:
+        partition_lines = []
+
+    yamlfos = [get_yamlfo_for_output(l, headers, glfo=glfo) for l in annotation_list] + failed_queries
+    n_seq_list = [len(yf['unique_ids']) for yf in yamlfos]
+    arrays = {'event-n-seqs' : numpy.array(n_seq_list, dtype=numpy.int64)}
+    columns = []  # list of [key, per_seq, encoding] (a list rather than a dict so we keep the order)
+    for key in OrderedDict([(k, None) for yf in yamlfos for k in yf]):
+        ievents = [i for i, yf in enumerate(yamlfos) if key in yf]
+        per_seq = key in linekeys['per_seq'] and all(isinstance(yamlfos[i][key], list) and len(yamlfos[i][key]) == n_seq_list[i] for i in ievents)
+        vals = [v for i in ievents for v in yamlfos[i][key]] if per_seq else [yamlfos[i][key] for i in ievents]
+        encoding, colarrays = get_npz_column(vals)
+        if len(ievents) < len(yamlfos):
+            colarrays['present'] = numpy.array([key in yf for yf in yamlfos], dtype=numpy.bool_)
+        arrays.update({'%s.%s' % (key, name) : array for name, array in colarrays.items()})
+        columns.append([key, per_seq, encoding])
+
+    meta = {'version-info' : yaml_version_info, 'germline-info' : glfo, 'partitions' : partition_lines, 'columns' : columns}
+    arrays['meta'] = numpy.array(json.dumps(meta))
+    with open(fname, 'wb') as npzfile:  # pass an open file so numpy doesn't add another .npz suffix
+        numpy.savez(npzfile, **arrays)
+
+# ----------------------------------------------------------------------------------------
+def read_npz_columns(fname, keys):
+    """
+    Read only the columns for <keys> from .npz output file <fname>, without building any annotation dicts.
+    Returns the meta info (version, germline, and partition info, plus the list of columns) and a dict with, for each key:
+      {'values' : (numpy array for bool/int/float columns, otherwise a list), 'per-seq' : bool, 'ievents' : numpy array with the index of the event corresponding to each entry in 'values'}
+    """
+    with numpy.load(fname) as npzfile:
+        meta = json.loads(npzfile['meta'].item())
+        colinfo = {key : (per_seq, encoding) for key, per_seq, encoding in meta['columns']}
+        n_seqs = npzfile['event-n-seqs']
+        colfo = {}
+        for key in keys:
+            if key not in colinfo:
+                raise Exception('key \'%s\' not among columns in %s (choose from: %s)' % (key, fname, ' '.join(k for k, _, _ in meta['columns'])))
+            per_seq, encoding = colinfo[key]
+            ievents = numpy.flatnonzero(npzfile[key + '.present']) if key + '.present' in npzfile.files else numpy.arange(len(n_seqs))
+            if per_seq:
+                ievents = numpy.repeat(ievents, n_seqs[ievents])
+            colfo[key] = {'values' : decode_npz_column(npzfile, key, encoding), 'per-seq' : per_seq, 'ievents' : ievents}
+    return meta, colfo
+
+# ----------------------------------------------------------------------------------------
+def read_npz_output(fname, n_max_queries=-1, synth_single_seqs=False, dont_add_implicit_info=False, seed_unique_id=None, cpath=None, skip_annotations=False, debug=False):  # same as read_yaml_output(), but for .npz files
+    with numpy.load(fname) as npzfile:
+        yamlfo = json.loads(npzfile['meta'].item())
+        if debug:
+            print '  read npz version %s from %s' % (yamlfo['version-info']['partis-yaml'], fname)
+        if not skip_annotations:  # rebuild the event dicts, so they look just like the ones we get from the json version
+            n_seq_list = npzfile['event-n-seqs'].tolist()
+            yamlfo['events'] = [{} for _ in n_seq_list]
+            for key, per_seq, encoding in yamlfo['columns']:
+                vals = decode_npz_column(npzfile, key, encoding)
+                if isinstance(vals, numpy.ndarray):
+                    vals = vals.tolist()
+                ievents = numpy.flatnonzero(npzfile[key + '.present']).tolist() if key + '.present' in npzfile.files else range(len(n_seq_list))
+                ival = 0
+                for ievent in ievents:
+                    if per_seq:
+                        yamlfo['events'][ievent][key] = vals[ival : ival + n_seq_list[ievent]]
+                        ival += n_seq_list[ievent]
+                    else:
+                        yamlfo['events'][ievent][key] = vals[ival]
+                        ival += 1
+
+    glfo = yamlfo['germline-info']
+    annotation_list = None
+    if not skip_annotations:
+        annotation_list = parse_yaml_annotations(glfo, yamlfo, n_max_queries, synth_single_seqs, dont_add_implicit_info)
+    cpath = read_yaml_partitions(yamlfo['partitions'], seed_unique_id=seed_unique_id, cpath=cpath)
     return glfo, annotation_list, cpath
 
 # ----------------------------------------------------------------------------------------
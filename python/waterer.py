@@ -3,14 +3,15 @@ import copy
 import sys
 import math
 import os
-import itertools
-import operator
-import pysam
-import contextlib
+import re
 from collections import OrderedDict
 import csv
 import numpy
 import traceback
+import subprocess
+import threading
+import Queue
+import multiprocessing
 
 import utils
 import glutils
@@ -18,6 +19,7 @@ import indelutils
 from parametercounter import ParameterCounter
 from performanceplotter import PerformancePlotter
 import seqfileopener
+from swseqcache import SWSequenceCache
 
 # best mismatch (with a match score of 5):
 # mfreq     boundaries     mutation
@@ -30,12 +32,369 @@ import seqfileopener
 # -: [...]
 # mfreq was I think the sequence-wide mfreq, but was close enough to the v value that it doesn't matter
 
+# ----------------------------------------------------------------------------------------
+cigar_op_re = re.compile('([0-9]+)([MIDNSHP=X])')
+def parse_sam_line(line):
+    """ pull out just the bits of an ig-sw sam line that we use, in a tuple: (qname, is_secondary, gene, qstart, qend, pos, aend, score, cigarstr, seq), where the bounds have the same meaning as pysam's """
+    fields = line.split('\t')
+    pos = int(fields[3]) - 1
+    cigarstr = fields[5]
+    cigar = cigar_op_re.findall(cigarstr)
+    qstart = int(cigar[0][0]) if cigar[0][1] == 'S' else 0
+    query_length, ref_length = 0, 0
+    for length, code in cigar:
+        if code in 'MIS=X':
+            query_length += int(length)
+        if code in 'MDN=X':
+            ref_length += int(length)
+    qend = query_length - (int(cigar[-1][0]) if cigar[-1][1] == 'S' and len(cigar) > 1 else 0)  # NOTE pysam doesn't count the first cigar op here, i.e. if there's only a soft clip, qstart and qend are both the full length
+    score = int(fields[11][5:])  # AS:i:<score> is always the first tag
+    return (fields[0], bool(int(fields[1]) & 256), fields[2], qstart, qend, pos, pos + ref_length, score, cigarstr, fields[9])
+
+# ----------------------------------------------------------------------------------------
+def read_sam_queries(lines):  # generator over (query name, list of parsed matches) for each query in ig-sw sam output <lines> (ig-sw writes all the matches for each query together, in order of decreasing score)
+    qname, matches = None, []
+    for line in lines:
+        if line[0] == '@':
+            continue
+        match = parse_sam_line(line.rstrip('\n'))
+        if match[0] != qname:
+            if qname is not None:
+                yield qname, matches
+            qname, matches = match[0], []
+        matches.append(match)
+    if qname is not None:
+        yield qname, matches
+
+# ----------------------------------------------------------------------------------------
+summarizing_waterer = None  # set to the Waterer just before we fork the summary procs, so they inherit it (rather than having to pickle it)
+def summarize_query_matches(matches):  # run in a summary subprocess
+    return summarizing_waterer.summarize_query(summarizing_waterer.read_query(matches))
+
+# ----------------------------------------------------------------------------------------
+class IgSwWorkerPool(object):
+    """ Long-lived ig-sw processes (run with --server), each of which reads the germline set once and then aligns as many batches of queries as we send it """
+    batch_end = '#batch-end\n'  # has to match IG_ALIGN_BATCH_END in ig_align.h
+    n_err_lines = 20  # number of lines from the end of a failed worker's stderr to include in the exception
+
+    def __init__(self, workdir):
+        self.logdir = workdir + '/ig-sw-workers'  # each worker's stderr goes to a file in here (removed in close())
+        self.procs = []
+        self.errfnames = []  # stderr file for each proc in <self.procs>
+        self.signature = None  # command + germline set with which the current procs were started
+
+    # ----------------------------------------------------------------------------------------
+    def get_signature(self, cmd_str, glfo):
+        return (cmd_str, tuple((region, tuple(sorted(glfo['seqs'][region].items()))) for region in sorted(glfo['seqs'])))
+
+    # ----------------------------------------------------------------------------------------
+    def err_tail(self, errfname):
+        if not os.path.exists(errfname):
+            return '    (stderr file %s is missing)' % errfname
+        with open(errfname) as errfile:
+            lines = errfile.readlines()[-self.n_err_lines:]
+        if len(lines) == 0:
+            return '    (nothing in stderr file %s)' % errfname
+        return 'last %d lines of stderr (from %s):\n%s' % (len(lines), errfname, utils.pad_lines(''.join(lines).rstrip('\n'), padwidth=8))
+
+    # ----------------------------------------------------------------------------------------
+    def run_batch(self, ibatch, proc, errfname, batch, parse_fcn):
+        match, mismatch, gap_open, seqfos = batch
+        try:
+            proc.stdin.write('batch %d %d %d %d\n' % (match, mismatch, gap_open, len(seqfos)))
+            proc.stdin.write(''.join('>%s NUKES\n%s\n' % (name, seq) for name, seq in seqfos))
+            proc.stdin.flush()
+        except IOError:  # broken pipe, i.e. it already died
+            pass  # fall through to the check below, so we get the same error message
+        def batch_lines():
+            for line in iter(proc.stdout.readline, ''):
+                if line == self.batch_end:
+                    return
+                yield line
+            status = proc.wait()  # wait before reading stderr, so it's all there
+            raise Exception('ig-sw worker exited (with status %s) before finishing its batch (cmd: %s)\n%s' % (status, ' '.join(self.signature[0].split()), self.err_tail(errfname)))
+        return parse_fcn(ibatch, batch_lines())
+
+    # ----------------------------------------------------------------------------------------
+    def run(self, cmd_str, glfo, batches, parse_fcn, consume_fcn=None):
+        """
+        <batches>: list of (match, mismatch, gap open, [(name, seq), ...]).
+        Each worker's sam output lines are passed to <parse_fcn> (along with the batch index, in that worker's thread) as they arrive, and we return the list of its return values (one for each batch).
+        If <consume_fcn> is set, we call it in this thread while the workers are running (e.g. to process the queries that <parse_fcn> has finished with so far).
+        """
+        signature = self.get_signature(cmd_str, glfo)
+        if signature != self.signature:  # germline set (or command) changed, so the old procs have the wrong references loaded
+            self.close()
+            self.signature = signature
+        if not os.path.exists(self.logdir):
+            os.makedirs(self.logdir)
+        while len(self.procs) < len(batches):
+            errfname = '%s/err-%d' % (self.logdir, len(self.procs))
+            with open(errfname, 'w') as errfile:  # Popen dups the file descriptor, so we can close ours right away
+                self.procs.append(subprocess.Popen((cmd_str + ' --server').split(), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=errfile))
+            self.errfnames.append(errfname)
+
+        failures = []
+        results = [None for _ in batches]
+        def run_and_catch(ibatch, proc, errfname, batch):
+            try:
+                results[ibatch] = self.run_batch(ibatch, proc, errfname, batch, parse_fcn)
+            except Exception as exc:
+                failures.append(exc)
+        threads = [threading.Thread(target=run_and_catch, args=(ibatch, proc, errfname, batch)) for ibatch, (proc, errfname, batch) in enumerate(zip(self.procs, self.errfnames, batches))]
+        for thread in threads:
+            thread.start()
+        try:
+            if consume_fcn is not None:
+                consume_fcn()
+        finally:
+            for thread in threads:
+                thread.join()
+        if len(failures) > 0:
+            self.close(keep_logs=True)  # leave the stderr files, since the exception points to them
+            raise failures[0]
+        return results
+
+    # ----------------------------------------------------------------------------------------
+    def close(self, keep_logs=False):
+        for proc in self.procs:
+            try:
+                proc.stdin.close()  # ig-sw exits when it sees eof
+            except IOError:  # already died
+                pass
+            proc.wait()
+        if not keep_logs:
+            for errfname in self.errfnames:
+                os.remove(errfname)
+            if os.path.exists(self.logdir) and len(os.listdir(self.logdir)) == 0:
+                os.rmdir(self.logdir)
+        self.procs = []
+        self.errfnames = []
+        self.signature = None
+
+# ----------------------------------------------------------------------------------------
+def compact_str(val):  # json gives us unicode for everything, which (with our ucs4 python) takes four bytes per character, so switch back to str if it's ascii
+    if isinstance(val, unicode):
+        try:
+            return str(val)
+        except UnicodeEncodeError:
+            pass
+    return val
+
+# ----------------------------------------------------------------------------------------
+def compact_strs_in_place(obj, depth=0):  # NOTE modifies the list/dict's elements rather than making a new one, since other things may have references to it
+    if depth > 1:
+        return
+    for key in range(len(obj)) if isinstance(obj, list) else obj.keys():
+        if isinstance(obj[key], unicode):
+            obj[key] = compact_str(obj[key])
+        elif isinstance(obj[key], (list, dict)):
+            compact_strs_in_place(obj[key], depth=depth + 1)
+
+# ----------------------------------------------------------------------------------------
+def interned_str(val):  # there's only a few hundred genes, but we have a copy of each name (and gl seq) for every query
+    val = compact_str(val)
+    return intern(val) if isinstance(val, str) else val
+
+# ----------------------------------------------------------------------------------------
+def pack_all_matches(all_matches):
+    """
+    Convert per-seq list of dicts (region : gene : {'score', 'glbounds', 'qrbounds'}) to a tuple (one entry per seq) of ((region, (gene, score, gl start, gl end, qr start, qr end, gene, score...)), ...).
+    If it isn't in the form we expect (e.g. from an old sw cache file, with a list of genes for each region), we leave that seq's entry as it is.
+    """
+    if not isinstance(all_matches, list):
+        return all_matches
+    packed_matches = []
+    for matchfo in all_matches:
+        if not isinstance(matchfo, dict) or any(not isinstance(rmatches, dict) or any(not isinstance(gfo, dict) or len(gfo) != 3 or len(gfo.get('glbounds', ())) != 2 or len(gfo.get('qrbounds', ())) != 2 or 'score' not in gfo for gfo in rmatches.values()) for rmatches in matchfo.values()):
+            packed_matches.append(matchfo)
+            continue
+        packed_matches.append(tuple((interned_str(region), tuple(v for gene, gfo in rmatches.items() for v in [interned_str(gene), gfo['score']] + list(gfo['glbounds']) + list(gfo['qrbounds'])))
+                                    for region, rmatches in matchfo.items()))
+    return tuple(packed_matches)
+
+# ----------------------------------------------------------------------------------------
+def unpack_all_matches(packed_matches):
+    if not isinstance(packed_matches, tuple):
+        return packed_matches
+    all_matches = []
+    for packed_mfo in packed_matches:
+        if not isinstance(packed_mfo, tuple):  # wasn't in the standard form, so we didn't pack it
+            all_matches.append(packed_mfo)
+            continue
+        all_matches.append({region : {flatfo[i] : {'score' : flatfo[i + 1], 'glbounds' : flatfo[i + 2 : i + 4], 'qrbounds' : flatfo[i + 4 : i + 6]} for i in range(0, len(flatfo), 6)} for region, flatfo in packed_mfo})
+    return all_matches
+
+# ----------------------------------------------------------------------------------------
+class SWQueryInfo(object):
+    """
+    Per-query sw annotation (i.e. what's in Waterer.info[query]), which acts like the dict that it replaces (for partitiondriver, allelefinder, etc.), but uses a lot less memory.
+    For the sw annotations for test/example.fa (read from the sw cache file), this goes from about 25 KB to 8.5 KB per query (or, with 40 copies of each query, from 238 to 78 MB rss), which matters since we keep sw info for every query for the whole partis run.
+    Most of the savings are from:
+      - all_matches: stored packed into flat tuples (see pack_all_matches()), 8.2 --> 1.3 KB
+      - __slots__ rather than a dict for the known keys, 3.4 --> 0.5 KB (anything else goes in <self._extra>, which we only create if we need it)
+      - unicode strings (from reading json) converted to str, since ucs4 unicode is four bytes per base
+      - gene names and germline seqs are interned, so all queries share the same string objects (rather than having a separate copy of each gene's name and germline seq per query)
+    NOTE all_matches is unpacked into new dicts each time you access it (with bounds as tuples, even if they were lists when they were set), so if you modify it you have to set it again afterwards (swfo['all_matches'] = all_matches) for the change to stick.
+    NOTE we don't copy any lists or dicts that are passed in (we just convert their unicode elements to str in place), since other things rely on them being the same objects (e.g. info['indels'][query] is swfo['indelfos'][0]).
+    """
+    slot_keys = sorted(k for k in set(utils.sw_cache_headers) | utils.implicit_linekeys | set(['seqs', 'indelfos', 'duplicates']) if re.match('[a-zA-Z_][a-zA-Z0-9_]*$', k))
+    __slots__ = slot_keys + ['_extra']
+    slot_key_set = frozenset(slot_keys)
+    interned_keys = frozenset([r + '_gene' for r in utils.regions] + [r + '_gl_seq' for r in utils.regions])
+
+    def __init__(self, line=None):
+        self._extra = None
+        if line is not None:
+            for key, val in line.items():
+                self[key] = val
+
+    # ----------------------------------------------------------------------------------------
+    def __getitem__(self, key):
+        if key not in self.slot_key_set:
+            if self._extra is None:
+                raise KeyError(key)
+            return self._extra[key]
+        try:
+            val = getattr(self, key)
+        except AttributeError:  # slot hasn't been set
+            raise KeyError(key)
+        if key == 'all_matches':
+            return unpack_all_matches(val)
+        return val
+
+    # ----------------------------------------------------------------------------------------
+    def __setitem__(self, key, val):
+        if key not in self.slot_key_set:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = val
+            return
+        if key == 'all_matches':
+            val = pack_all_matches(val)
+        elif key in self.interned_keys:
+            val = interned_str(val)
+        elif isinstance(val, unicode):
+            val = compact_str(val)
+        elif isinstance(val, (list, dict)):
+            compact_strs_in_place(val)
+        setattr(self, key, val)
+
+    # ----------------------------------------------------------------------------------------
+    def __delitem__(self, key):
+        if key not in self.slot_key_set:
+            if self._extra is None:
+                raise KeyError(key)
+            del self._extra[key]
+            return
+        try:
+            delattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    # ----------------------------------------------------------------------------------------
+    def __contains__(self, key):
+        if key in self.slot_key_set:
+            return hasattr(self, key)
+        return self._extra is not None and key in self._extra
+
+    # ----------------------------------------------------------------------------------------
+    def has_key(self, key):
+        return key in self
+
+    # ----------------------------------------------------------------------------------------
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    # ----------------------------------------------------------------------------------------
+    def pop(self, key, *args):
+        if key not in self:
+            if len(args) > 0:
+                return args[0]
+            raise KeyError(key)
+        val = self[key]
+        del self[key]
+        return val
+
+    # ----------------------------------------------------------------------------------------
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    # ----------------------------------------------------------------------------------------
+    def update(self, *args, **kwargs):
+        for key, val in dict(*args, **kwargs).items():
+            self[key] = val
+
+    # ----------------------------------------------------------------------------------------
+    def keys(self):
+        return [k for k in self.slot_keys if hasattr(self, k)] + ([] if self._extra is None else self._extra.keys())
+
+    # ----------------------------------------------------------------------------------------
+    def __iter__(self):
+        return iter(self.keys())
+
+    # ----------------------------------------------------------------------------------------
+    def iterkeys(self):
+        return iter(self.keys())
+
+    # ----------------------------------------------------------------------------------------
+    def __len__(self):
+        return len(self.keys())
+
+    # ----------------------------------------------------------------------------------------
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    # ----------------------------------------------------------------------------------------
+    def iteritems(self):
+        return iter(self.items())
+
+    # ----------------------------------------------------------------------------------------
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    # ----------------------------------------------------------------------------------------
+    def itervalues(self):
+        return iter(self.values())
+
+    # ----------------------------------------------------------------------------------------
+    def copy(self):  # shallow copy, as a regular dict
+        return dict(self.items())
+
+    # ----------------------------------------------------------------------------------------
+    def __eq__(self, other):
+        if isinstance(other, SWQueryInfo):
+            other = other.copy()
+        return self.copy() == other
+
+    # ----------------------------------------------------------------------------------------
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    # ----------------------------------------------------------------------------------------
+    def __repr__(self):
+        return repr(self.copy())
+
+    # ----------------------------------------------------------------------------------------
+    def __getstate__(self):  # for pickle and deepcopy (which otherwise don't know what to do with __slots__), NOTE keeps all_matches packed
+        return (dict((k, getattr(self, k)) for k in self.slot_keys if hasattr(self, k)), self._extra)
+
+    # ----------------------------------------------------------------------------------------
+    def __setstate__(self, state):
+        slotvals, self._extra = state
+        for key, val in slotvals.items():
+            setattr(self, key, val)
+
 # ----------------------------------------------------------------------------------------
 class Waterer(object):
     """ Run smith-waterman on the query sequences in <infname> """
     def __init__(self, args, glfo, input_info, simglfo, reco_info,
                  count_parameters=False, parameter_out_dir=None, plot_annotation_performance=False,
-                 duplicates=None, pre_failed_queries=None, aligned_gl_seqs=None, vs_info=None):
+                 duplicates=None, pre_failed_queries=None, aligned_gl_seqs=None, vs_info=None, worker_pool=None):
         self.args = args
         self.input_info = input_info  # NOTE do *not* modify this, since it's this original input info from partitiondriver
         self.reco_info = reco_info
@@ -48,6 +407,9 @@ class Waterer(object):
         self.debug = self.args.debug if self.args.sw_debug is None else self.args.sw_debug
         self.aligned_gl_seqs = aligned_gl_seqs
         self.vs_info = vs_info
+        self.worker_pool = worker_pool  # if set, we send queries to these long-lived ig-sw procs rather than starting new ones (and writing input files) each time through
+        self.seq_cache = None  # per-sequence cache (if --sw-seq-cachefname is set)
+        self.seq_cache_misses = None  # queries that weren't in <self.seq_cache>, i.e. that we actually run sw on
 
         self.absolute_max_insertion_length = 120  # but if it's longer than this, we always skip the annotation
 
@@ -91,28 +453,44 @@ class Waterer(object):
         start = time.time()
         base_infname = 'query-seqs.fa'
         base_outfname = 'query-seqs.sam'
+        self.ig_sw_time, self.processing_time, self.overlap_time = 0., 0., 0.
 
         if self.vs_info is not None:  # if we're reading a cache file, we should make sure to read the exact same info from there
             self.add_vs_indels()
+        if self.args.sw_seq_cachefname is not None:
+            self.read_seq_cache()
 
         itry = 0
-        while True:  # if we're not running vsearch, we still gotta run twice to get shm indeld sequences
+        while len(self.remaining_queries) > 0:  # if we're not running vsearch, we still gotta run twice to get shm indeld sequences
             mismatches, gap_opens, queries_for_each_proc = self.split_queries(self.args.n_procs)  # NOTE can tell us to run more than <self.args.n_procs> (we run at least one proc for each different mismatch score)
-            self.write_input_files(base_infname, queries_for_each_proc)
-
             print '    running %d proc%s for %d seq%s' % (len(mismatches), utils.plural(len(mismatches)), len(self.remaining_queries), utils.plural(len(self.remaining_queries)))
             sys.stdout.flush()
-            self.execute_commands(base_infname, base_outfname, mismatches, gap_opens)
-
-            processing_start = time.time()
-            self.read_output(base_outfname, len(mismatches))
+            summary_pool = self.get_summary_pool()  # NOTE has to happen before the worker pool starts any threads, since it forks
+            try:
+                if self.worker_pool is None:
+                    self.write_input_files(base_infname, queries_for_each_proc)
+                    self.execute_commands(base_infname, base_outfname, mismatches, gap_opens)
+                    processing_start = time.time()
+                    self.read_output(self.read_output_files(base_outfname, len(mismatches)), summary_pool=summary_pool)
+                    self.processing_time += time.time() - processing_start
+                else:
+                    self.run_pipelined_batches(mismatches, gap_opens, queries_for_each_proc, summary_pool=summary_pool)
+            finally:
+                if summary_pool is not None:
+                    summary_pool.terminate()  # they've already finished everything we gave them (or there was an exception)
+                    summary_pool.join()
 
             if itry > 1 or len(self.indel_reruns) == 0:
                 break
             itry += 1
 
+        if self.seq_cache is not None:
+            self.write_seq_cache()  # has to happen before finalize(), since that modifies the annotations (e.g. removing framework insertions)
+
+        finalize_start = time.time()
         self.finalize(cachefname)
-        print '    water time: %.1f  (ig-sw %.1f  processing %.1f)' % (time.time() - start, time.time() - processing_start, self.ig_sw_time)
+        self.processing_time += time.time() - finalize_start
+        print '    water time: %.1f  (ig-sw %.1f  processing %.1f%s)' % (time.time() - start, self.ig_sw_time, self.processing_time, ('  overlapped %.1f' % self.overlap_time) if self.worker_pool is not None else '')
 
     # ----------------------------------------------------------------------------------------
     def clean_cache(self, cache_path):
@@ -165,6 +543,49 @@ class Waterer(object):
         self.finalize(cachefname=None, just_read_cachefile=True)
         print '        water time: %.1f' % (time.time()-start)
 
+    # ----------------------------------------------------------------------------------------
+    def read_seq_cache(self):
+        start = time.time()
+        self.seq_cache = SWSequenceCache(self.args.sw_seq_cachefname, self.glfo, self.args)
+        cachefo = self.seq_cache.read({q : self.input_info[q]['seqs'][0] for q in self.remaining_queries})
+        for uid, (status, line) in cachefo.items():
+            if status == 'failed':
+                self.info['failed-queries'].add(uid)
+                self.remaining_queries.remove(uid)
+            elif status == 'unproductive':
+                self.skipped_unproductive_queries.add(uid)
+                self.remaining_queries.remove(uid)
+            elif status == 'passed':  # the cached line only knows about the sequence, so add the uid-specific stuff, then proceed as in read_cachefile()
+                line['unique_ids'] = [uid]
+                line['input_seqs'] = [self.input_info[uid]['seqs'][0]]
+                line['duplicates'] = [self.duplicates.get(uid, [])]
+                utils.transfer_indel_reversed_seqs(line)
+                utils.add_implicit_info(self.glfo, line, aligned_gl_seqs=self.aligned_gl_seqs)
+                if uid in self.info['indels']:  # i.e. if vsearch found an indel (the cached line has the final word on indels)
+                    del self.info['indels'][uid]
+                if indelutils.has_indels(line['indelfos'][0]):
+                    self.info['indels'][uid] = line['indelfos'][0]
+                self.add_to_info(line)
+            else:
+                raise Exception('unexpected status \'%s\' in sw sequence cache %s' % (status, self.args.sw_seq_cachefname))
+        self.seq_cache_misses = set(self.remaining_queries)
+        print '        read %d / %d queries from sw sequence cache %s (%.1f sec)' % (len(cachefo), len(cachefo) + len(self.seq_cache_misses), self.args.sw_seq_cachefname, time.time() - start)
+
+    # ----------------------------------------------------------------------------------------
+    def write_seq_cache(self):
+        entries = []
+        for uid in self.seq_cache_misses:
+            if uid in self.info['passed-queries']:
+                entries.append((self.input_info[uid]['seqs'][0], 'passed', self.info[uid]))
+            elif uid in self.skipped_unproductive_queries:
+                entries.append((self.input_info[uid]['seqs'][0], 'unproductive', None))
+            elif uid in self.remaining_queries:  # i.e. it failed
+                entries.append((self.input_info[uid]['seqs'][0], 'failed', None))
+        if len(entries) > 0:
+            print '        writing %d new entr%s to sw sequence cache %s' % (len(entries), 'ies' if len(entries) > 1 else 'y', self.args.sw_seq_cachefname)
+            self.seq_cache.write(entries)
+        self.seq_cache.close()
+
     # ----------------------------------------------------------------------------------------
     def write_cachefile(self, cachefname):
         if self.args.write_trimmed_and_padded_seqs_to_sw_cachefname:  # hackey workaround: (in case you want to use trimmed/padded seqs for something, but shouldn't be used in general)
@@ -300,7 +721,52 @@ class Waterer(object):
         for iproc in range(n_procs):
             os.remove(self.subworkdir(iproc, n_procs) + '/' + base_infname)
         sys.stdout.flush()
-        self.ig_sw_time = time.time() - start
+        self.ig_sw_time += time.time() - start
+
+    # ----------------------------------------------------------------------------------------
+    def get_summary_pool(self):
+        if self.args.n_sw_summary_procs <= 1 or self.debug:  # debug printing would be all jumbled up
+            return None
+        global summarizing_waterer
+        summarizing_waterer = self  # the subprocs get a (copy on write) copy of us, including e.g. glfo and the indel info from previous iterations
+        return multiprocessing.Pool(self.args.n_sw_summary_procs)
+
+    # ----------------------------------------------------------------------------------------
+    def run_pipelined_batches(self, mismatches, gap_opens, queries_for_each_proc, summary_pool=None):
+        # Each worker's thread parses its sam output as it arrives and puts each query's matches on its queue, while in this thread we pull them off and process them.
+        # We go through the procs' queues in order, so the results are exactly the same as if we waited for ig-sw to finish.
+        start = time.time()
+        batches = [(self.match_score, mismatch, gap_open, [(q, self.get_query_seq(q)) for q in queries]) for mismatch, gap_open, queries in zip(mismatches, gap_opens, queries_for_each_proc)]
+        queues = [Queue.Queue() for _ in batches]
+        finish_times = []
+
+        def queue_queries(ibatch, lines):
+            try:
+                for qname, matches in read_sam_queries(lines):
+                    queues[ibatch].put((qname, matches))
+            finally:
+                finish_times.append(time.time())
+                queues[ibatch].put(None)  # tells the consumer that this proc is finished
+
+        def still_aligning():
+            return len(finish_times) < len(batches)
+
+        def dequeue_queries():  # without a summary pool, the time between when we yield and when we get control back is time that read_output() spent processing
+            for queue in queues:
+                for qmatches in iter(queue.get, None):
+                    if summary_pool is not None:  # with a pool, this runs in the pool's task feeder thread, so timing the yield would only tell us how fast the pool takes tasks (read_output() does the timing instead)
+                        yield qmatches
+                        continue
+                    aligning = still_aligning()
+                    yield_time = time.time()
+                    yield qmatches
+                    self.processing_time += time.time() - yield_time
+                    if aligning:
+                        self.overlap_time += time.time() - yield_time
+
+        self.worker_pool.run(self.get_ig_sw_base_cmd_str(), self.glfo, batches, queue_queries, consume_fcn=lambda: self.read_output(dequeue_queries(), summary_pool=summary_pool, still_aligning_fcn=still_aligning))
+        sys.stdout.flush()
+        self.ig_sw_time += max(finish_times) - start
 
     # ----------------------------------------------------------------------------------------
     def split_queries_by_match_mismatch(self, input_queries, n_procs, debug=False):
@@ -384,6 +850,14 @@ class Waterer(object):
 
         return mismatches, gap_opens, queries_for_each_proc
 
+    # ----------------------------------------------------------------------------------------
+    def get_query_seq(self, query_name):
+        if query_name in self.info['indels']:
+            return self.info['indels'][query_name]['reversed_seq']  # use the query sequence with shm insertions and deletions reversed
+        else:
+            assert len(self.input_info[query_name]['seqs']) == 1  # sw can't handle multiple simultaneous sequences, but it's nice to have the same headers/keys everywhere, so we use the plural versions (with lists) even here (where "it's nice" means "it used to be the other way and it fucking sucked and a fuckton of effort went into synchronizing the treatments")
+            return self.input_info[query_name]['seqs'][0]
+
     # ----------------------------------------------------------------------------------------
     def write_input_files(self, base_infname, queries_for_each_proc):
         n_procs = len(queries_for_each_proc)
@@ -393,12 +867,7 @@ class Waterer(object):
                 utils.prep_dir(workdir)
             with open(workdir + '/' + base_infname, 'w') as sub_infile:
                 for query_name in queries_for_each_proc[iproc]:
-                    if query_name in self.info['indels']:
-                        seq = self.info['indels'][query_name]['reversed_seq']  # use the query sequence with shm insertions and deletions reversed
-                    else:
-                        assert len(self.input_info[query_name]['seqs']) == 1  # sw can't handle multiple simultaneous sequences, but it's nice to have the same headers/keys everywhere, so we use the plural versions (with lists) even here (where "it's nice" means "it used to be the other way and it fucking sucked and a fuckton of effort went into synchronizing the treatments")
-                        seq = self.input_info[query_name]['seqs'][0]
-                    sub_infile.write('>%s NUKES\n%s\n' % (query_name, seq))
+                    sub_infile.write('>%s NUKES\n%s\n' % (query_name, self.get_query_seq(query_name)))
 
     # # ----------------------------------------------------------------------------------------
     # def get_vdjalign_cmd_str(self, workdir, base_infname, base_outfname, mismatch):
@@ -415,15 +884,20 @@ class Waterer(object):
     #     return cmd_str
 
     # ----------------------------------------------------------------------------------------
-    def get_ig_sw_cmd_str(self, workdir, base_infname, base_outfname, mismatch, gap_open):
-        # large gap-opening penalty: we want *no* gaps in the middle of the alignments
-        # match score larger than (negative) mismatch score: we want to *encourage* some level of shm. If they're equal, we tend to end up with short unmutated alignments, which screws everything up
+    def get_ig_sw_base_cmd_str(self):  # the options that are the same for every proc (the worker pool passes the rest along with each batch of queries)
         cmd_str = self.args.ig_sw_binary
         cmd_str += ' -l ' + self.args.locus.upper()
         cmd_str += ' -d 50'  # max drop
+        cmd_str += ' -p ' + self.my_gldir + '/' + self.args.locus + '/'  # NOTE needs the trailing slash
+        return cmd_str
+
+    # ----------------------------------------------------------------------------------------
+    def get_ig_sw_cmd_str(self, workdir, base_infname, base_outfname, mismatch, gap_open):
+        # large gap-opening penalty: we want *no* gaps in the middle of the alignments
+        # match score larger than (negative) mismatch score: we want to *encourage* some level of shm. If they're equal, we tend to end up with short unmutated alignments, which screws everything up
+        cmd_str = self.get_ig_sw_base_cmd_str()
         cmd_str += ' -m ' + str(self.match_score) + ' -u ' + str(mismatch)
         cmd_str += ' -o ' + str(gap_open)
-        cmd_str += ' -p ' + self.my_gldir + '/' + self.args.locus + '/'  # NOTE needs the trailing slash
         cmd_str += ' ' + workdir + '/' + base_infname + ' ' + workdir + '/' + base_outfname
         return cmd_str
 
@@ -469,28 +943,13 @@ class Waterer(object):
     #     print '        time to rewrite same file: %.2f' % (time.time() - start)
 
     # ----------------------------------------------------------------------------------------
-    def read_output(self, base_outfname, n_procs=1):
-        if self.debug:
-            print '%s' % utils.color('green', 'reading output')
-
-        queries_read_from_file = set()  # should be able to remove this, eventually
+    def read_output_files(self, base_outfname, n_procs=1):  # generator over the parsed matches for each query in the sam files written by execute_commands() (removes the files when it's done)
         for iproc in range(n_procs):
             outfname = self.subworkdir(iproc, n_procs) + '/' + base_outfname
             # self.remove_length_discrepant_matches(outfname)
-            with contextlib.closing(pysam.Samfile(outfname)) as sam:  # changed bam to sam because ig-sw outputs sam files
-                grouped = itertools.groupby(iter(sam), operator.attrgetter('qname'))
-                for _, reads in grouped:  # loop over query sequences
-                    try:
-                        readlist = list(reads)
-                    except:  # should no longer happen (was a result of pysam barfing when ig-sw gave it cigar and query sequences that were different lengths, but now ig-sw should skip matches for which that's true) it would be better if ig-sw didn't make those matches to start with, but that would require understanding a lot more about ig-sw
-                        raise Exception('failed to convert sam reads')
-                    qinfo = self.read_query(sam.references, readlist)
-                    self.summarize_query(qinfo)  # returns before adding to <self.info> if it thinks we should rerun the query
-                    queries_read_from_file.add(qinfo['name'])
-
-        not_read = self.remaining_queries - queries_read_from_file
-        if len(not_read) > 0:  # ig-sw (now) doesn't write matches for cases in which cigar and read length differ, which means there are now queries for which it finds zero matches (well, it didn't seem to happen before... but not sure that it couldn't have)
-            print '\n%s didn\'t read %s from %s' % (utils.color('red', 'warning'), ' '.join(not_read), self.args.workdir)
+            with open(outfname) as samfile:
+                for qname, matches in read_sam_queries(samfile):
+                    yield qname, matches
 
         for iproc in range(n_procs):
             workdir = self.subworkdir(iproc, n_procs)
@@ -498,6 +957,33 @@ class Waterer(object):
             if n_procs > 1:  # still need the top-level workdir
                 os.rmdir(workdir)
 
+    # ----------------------------------------------------------------------------------------
+    def read_output(self, query_matches, summary_pool=None, still_aligning_fcn=None):  # <query_matches>: iterable over (query name, list of parsed sam matches) (see read_sam_queries()). If <still_aligning_fcn> is set (i.e. ig-sw is running while we read), we add the time spent applying summaries from <summary_pool> to the processing (and overlap) times
+        if self.debug:
+            print '%s' % utils.color('green', 'reading output')
+
+        if summary_pool is None:
+            summaries = (self.summarize_query(self.read_query(matches)) for _, matches in query_matches)
+        else:  # imap() returns them in order, so we apply them in the same order as we would without the pool
+            summaries = summary_pool.imap(summarize_query_matches, (matches for _, matches in query_matches), chunksize=50)
+
+        queries_read_from_file = set()  # should be able to remove this, eventually
+        time_it = summary_pool is not None and still_aligning_fcn is not None  # without a pool, run_pipelined_batches() times the summarizing as well (which happens as we pull from <query_matches>), whereas with a pool the summarizing happens in the pool's processes, so what's left to time in this process is applying the summaries
+        for summary in summaries:  # loop over query sequences
+            if time_it:
+                aligning = still_aligning_fcn()
+                apply_start = time.time()
+            self.apply_query_summary(summary)  # if it thinks we should rerun the query, this doesn't add it to <self.info>
+            queries_read_from_file.add(summary['name'])
+            if time_it:
+                self.processing_time += time.time() - apply_start
+                if aligning:
+                    self.overlap_time += time.time() - apply_start
+
+        not_read = self.remaining_queries - queries_read_from_file
+        if len(not_read) > 0:  # ig-sw (now) doesn't write matches for cases in which cigar and read length differ, which means there are now queries for which it finds zero matches (well, it didn't seem to happen before... but not sure that it couldn't have)
+            print '\n%s didn\'t read %s from %s' % (utils.color('red', 'warning'), ' '.join(not_read), self.args.workdir)
+
         sys.stdout.flush()
 
     # ----------------------------------------------------------------------------------------
@@ -517,12 +1003,12 @@ class Waterer(object):
         qinfo['glbounds'][dummy_d] = (1, 1)
 
     # ----------------------------------------------------------------------------------------
-    def read_query(self, references, reads):
-        """ convert bam crap to python dict """
-        primary = next((r for r in reads if not r.is_secondary), None)
+    def read_query(self, matches):
+        """ convert parsed sam matches (see parse_sam_line()) to python dict """
+        qname, _, _, _, _, _, _, _, _, qseq = next(m for m in matches if not m[1])  # only the primary match has the sequence
         qinfo = {
-            'name' : primary.qname,
-            'seq' : primary.seq,
+            'name' : qname,
+            'seq' : qseq,
             'matches' : {r : [] for r in utils.regions},
             'qrbounds' : {},
             'glbounds' : {},
@@ -530,13 +1016,10 @@ class Waterer(object):
         }
 
         last_scores = {r : None for r in utils.regions}
-        for read in reads:  # loop over the matches found for each query sequence
-            read.seq = qinfo['seq']  # only the first one has read.seq set by default, so we need to set the rest by hand
-            gene = references[read.tid]
+        for _, _, gene, qstart, qend, pos, aend, score, cigarstr, _ in matches:  # loop over the matches found for each query sequence
             region = utils.get_region(gene)
-            qrbounds = (read.qstart, read.qend)
-            glbounds = (read.pos, read.aend)
-            score = read.tags[0][1]
+            qrbounds = (qstart, qend)
+            glbounds = (pos, aend)
             if last_scores[region] is not None and score > last_scores[region]:
                 raise Exception('[sb]am file from smith-waterman not ordered by match score')
             last_scores[region] = score
@@ -547,7 +1030,7 @@ class Waterer(object):
                 assert len(qinfo['matches'][region]) == self.args.n_max_per_region[utils.regions.index(region)]  # there better not be a way to get more than we asked for
                 continue
 
-            indelfo = indelutils.get_indelfo_from_cigar(read.cigarstring, qinfo['seq'], qrbounds, self.glfo['seqs'][region][gene], glbounds, {region : gene}, uid=qinfo['name'])  # note that qinfo['seq'] differs from self.input_info[qinfo['name']]['seqs'][0] if we've already reversed an indel in this sequence
+            indelfo = indelutils.get_indelfo_from_cigar(cigarstr, qinfo['seq'], qrbounds, self.glfo['seqs'][region][gene], glbounds, {region : gene}, uid=qinfo['name'])  # note that qinfo['seq'] differs from self.input_info[qinfo['name']]['seqs'][0] if we've already reversed an indel in this sequence
             if indelutils.has_indels(indelfo):
                 if len(qinfo['matches'][region]) > 0:  # skip any gene matches with indels after the first one for each region (if we want to handle [i.e. reverse] an indel, we will have stored the indel info for the first match, and we'll be rerunning)
                     continue
@@ -862,7 +1345,7 @@ class Waterer(object):
         qname = line['unique_ids'][0]
 
         self.info['passed-queries'].add(qname)
-        self.info[qname] = line
+        self.info[qname] = SWQueryInfo(line)
 
         # add this query's matches into the overall gene match sets
         for region in utils.regions:
@@ -884,18 +1367,42 @@ class Waterer(object):
             self.kept_unproductive_queries.add(qname)
         self.remaining_queries.remove(qname)
 
+    # ----------------------------------------------------------------------------------------
+    def apply_query_summary(self, summary):  # apply the changes described by <summary> (from summarize_query()) to <self.info> and friends
+        qname = summary['name']
+        if 'indelfo' in summary:
+            if summary['indelfo'] is None:
+                del self.info['indels'][qname]
+            else:
+                self.info['indels'][qname] = summary['indelfo']
+        if summary['indel_rerun']:
+            self.indel_reruns.add(qname)
+        if summary['skipped_unproductive']:
+            self.skipped_unproductive_queries.add(qname)
+            self.remaining_queries.remove(qname)
+        if summary['line'] is not None:
+            line = summary['line']
+            if qname in self.info['indels']:  # if the summary came back from a subprocess, these are copies, so we have to restore the identities that convert_qinfo() set up
+                self.info['indels'][qname] = line['indelfos'][0]
+            if qname in self.duplicates:
+                line['duplicates'][0] = self.duplicates[qname]
+            self.add_to_info(line)
+
     # ----------------------------------------------------------------------------------------
     def summarize_query(self, qinfo):
         """
         Fiddle with a few things, but mostly decide whether we're satisfied with the current matches.
-        If not, return without calling add_to_info().
+        Doesn't modify <self> (so it can run in a subprocess), but instead returns a summary of what apply_query_summary() should do, where if we're not satisfied, 'line' is None.
         """
-        def dbgfcn(dbgstr):  # doesn't return anything, but it makes things more concise
+        qname = qinfo['name']
+        qseq = qinfo['seq']
+        summary = {'name' : qname, 'indel_rerun' : False, 'skipped_unproductive' : False, 'line' : None}  # also 'indelfo', if we need to set (or, if None, remove) this query's entry in self.info['indels']
+
+        def dbgfcn(dbgstr):  # returns <summary>, which makes things more concise
             if self.debug:
                 print '      rerun: %s' % dbgstr
+            return summary
 
-        qname = qinfo['name']
-        qseq = qinfo['seq']
         assert qname not in self.info
         if self.debug:
             print '  %s' % qname
@@ -913,7 +1420,7 @@ class Waterer(object):
             if overlap_status == 'overlap':
                 overlap_indel_fail = self.shift_overlapping_boundaries(rpair, qinfo, best)  #, debug=self.debug>1)  # this is kind of a crappy way to return the information, but I can't think of anything better a.t.m.
                 if overlap_indel_fail:
-                    self.indel_reruns.add(qname)
+                    summary['indel_rerun'] = True
                     return dbgfcn('overlap/indel fails')
             elif overlap_status == 'nonsense':
                 return dbgfcn('nonsense overlap bounds')
@@ -924,12 +1431,13 @@ class Waterer(object):
             if qname in self.info['indels']:  # no really necessary, but I'm nervous about it because I screwed it up once before
                 assert qname in self.vs_indels
             indelfo = self.combine_indels(qinfo, best)  # the next time through, when we're writing ig-sw input, we look to see if each query is in <self.info['indels']>, and if it is we pass ig-sw the indel-reversed sequence, rather than the <input_info> sequence
+            summary['indel_rerun'] = True
             if indelfo is None:
-                self.indel_reruns.add(qname)
+                if qinfo.get('used_vs_indel', False):  # combine_indels() got as far as using up the vsearch indel, so it has to go
+                    summary['indelfo'] = None
                 return dbgfcn('indel fails')
             else:
-                self.info['indels'][qinfo['name']] = indelfo
-                self.indel_reruns.add(qname)
+                summary['indelfo'] = indelfo
                 return dbgfcn(' new indels in %s' % ' '.join(qinfo['new_indels'].keys()))  # utils.pad_lines(indelutils.get_dbg_str(self.info['indels'][qinfo['name']]), 10)
 
         if self.debug >= 2:
@@ -979,9 +1487,8 @@ class Waterer(object):
             if self.args.skip_unproductive:
                 if self.debug:
                     print '      skipping unproductive (%s)' % utils.is_functional_dbg_str(line, iseq=0)
-                self.skipped_unproductive_queries.add(qname)
-                self.remaining_queries.remove(qname)
-                return
+                summary['skipped_unproductive'] = True
+                return summary
             else:
                 pass  # this is here so you don't forget that if neither of the above is true, we fall through and add the query to self.info
 
@@ -991,7 +1498,8 @@ class Waterer(object):
         line['k_v'] = kbounds['v']
         line['k_d'] = kbounds['d']
 
-        self.add_to_info(line)
+        summary['line'] = line
+        return summary
 
     # ----------------------------------------------------------------------------------------
     def get_kbounds(self, line, qinfo, best, debug=False):
@@ -1187,11 +1695,13 @@ class Waterer(object):
             for region in utils.regions:
                 swfo['regional_bounds'][region] = tuple([rb - fv_len for rb in swfo['regional_bounds'][region]])  # I kind of want to just use a list now, but a.t.m. don't much feel like changing it everywhere else
 
+            all_matches = swfo['all_matches']  # NOTE have to set it back afterwards (see SWQueryInfo)
             for region in utils.regions:
-                if isinstance(swfo['all_matches'][0][region], list):  # if we just read an old sw cache file, it'll be a list of genes sorted by score, rather than a dict keyed by gene that includes scores and bounds, so there's no bounds to adjust
+                if isinstance(all_matches[0][region], list):  # if we just read an old sw cache file, it'll be a list of genes sorted by score, rather than a dict keyed by gene that includes scores and bounds, so there's no bounds to adjust
                     continue
-                for gene, gfo in swfo['all_matches'][0][region].items():
+                for gene, gfo in all_matches[0][region].items():
                     gfo['qrbounds'] = tuple(b - fv_len for b in gfo['qrbounds'])
+            swfo['all_matches'] = all_matches
 
             if debug:
                 print '    after %s' % swfo['seqs'][0]
@@ -1378,11 +1888,13 @@ class Waterer(object):
             for region in utils.regions:
                 swfo['regional_bounds'][region] = tuple([rb + padleft for rb in swfo['regional_bounds'][region]])  # I kind of want to just use a list now, but a.t.m. don't much feel like changing it everywhere else
 
+            all_matches = swfo['all_matches']  # NOTE have to set it back afterwards (see SWQueryInfo)
             for region in utils.regions:
-                if isinstance(swfo['all_matches'][0][region], list):  # if we just read an old sw cache file, it'll be a list of genes sorted by score, rather than a dict keyed by gene that includes scores and bounds, so there's no bounds to adjust
+                if isinstance(all_matches[0][region], list):  # if we just read an old sw cache file, it'll be a list of genes sorted by score, rather than a dict keyed by gene that includes scores and bounds, so there's no bounds to adjust
                     continue
-                for gene, gfo in swfo['all_matches'][0][region].items():
+                for gene, gfo in all_matches[0][region].items():
                     gfo['qrbounds'] = tuple(b + padleft for b in gfo['qrbounds'])
+            swfo['all_matches'] = all_matches
 
             swfo['padlefts'] = [padleft, ]
             swfo['padrights'] = [padright, ]
@@ -1429,7 +1941,7 @@ class Waterer(object):
                     for ifo in qinfo['new_indels'][region]['indels']:
                         ifo['pos'] += net_v_indel_length
             full_qrseq = self.input_info[qinfo['name']]['seqs'][0]  # should in principle replace qinfo['seq'] as well, since it's the reversed seq from vsearch, but see note below
-            del self.info['indels'][qinfo['name']]
+            qinfo['used_vs_indel'] = True  # i.e. the caller has to remove it from self.info['indels'] (we don't do it here, since we may be in a subprocess)
             regional_indelfos['v'] = vs_indelfo
         elif 'v' in qinfo['new_indels']:
             regional_indelfos['v'] = qinfo['new_indels']['v']